@@ -0,0 +1,17 @@
+import tempstore.engine as ts_e
+import tempstore.webapp as ts_wa
+
+import os
+
+# WSGI app served by gunicorn for the HTTP benchmarks. The datastore and
+# the database are created by the benchmark in the directory passed in
+# the environment.
+BENCHMARK_DIR = os.environ['TEMPSTORE_BENCHMARK_DIR']
+
+engine = ts_e.Engine(
+    os.path.join(BENCHMARK_DIR, 'datastore'),
+    os.path.join(BENCHMARK_DIR, 'database'),
+    30*24*60*60,
+    database_pool_size=8, datastore_fanout=2, cache_size=10000)
+
+app = ts_wa.App(engine, 'http://localhost', page_cache_size=1000)
@@ -0,0 +1,500 @@
+import tempstore.database as ts_db
+import tempstore.datastore as ts_ds
+import tempstore.engine as ts_e
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Sizes of the blobs of the datastore and HTTP benchmarks.
+BLOB_SIZES = [4 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+
+# Bytes written per blob size by each datastore benchmark run, within
+# bounds on the number of blobs.
+DATASTORE_BYTES = 256 * 1024 * 1024
+MIN_BLOBS = 16
+MAX_BLOBS = 2000
+
+# Numbers of concurrent threads, and of operations split across them.
+THREADS = [1, 4, 16]
+DATABASE_OPERATIONS = 4000
+
+# Numbers of blobs of the synthetic stores of the cleanup benchmarks.
+# Half of the blobs belong to obsolete versions.
+CLEANUP_SIZES = [10**4, 10**5, 10**6]
+
+# Number of gunicorn workers, and of concurrent HTTP clients.
+HTTP_WORKERS = 4
+HTTP_CLIENTS = 16
+HTTP_BYTES = 64 * 1024 * 1024
+
+# Number of runs of each benchmark. The median run is kept.
+REPEAT = 3
+
+# Relative slowdown over which a result is a regression.
+TOLERANCE = 0.2
+
+# Seed of the generated contents, so that the runs are reproducible.
+SEED = 0
+
+# Smaller settings for a smoke run.
+QUICK_SETTINGS = {
+    'blob_sizes': [4 * 1024, 1024 * 1024],
+    'datastore_bytes': 16 * 1024 * 1024,
+    'threads': [1, 4],
+    'database_operations': 1000,
+    'cleanup_sizes': [10**4],
+    'http_bytes': 16 * 1024 * 1024,
+    'repeat': 1}
+
+SECONDS = 1
+DAYS = 24 * 60 * 60 * SECONDS
+
+class BenchmarkException(Exception):
+    pass
+
+# Collects the results (name -> value, unit). All the results are
+# throughputs: higher is better.
+class Results:
+
+    def __init__(self):
+        self.results = {}
+
+    # Records a result and prints it.
+    def add(self, name, value, unit):
+        self.results[name] = {'value': value, 'unit': unit}
+        print('%-48s %12.1f %s' % (name, value, unit), flush=True)
+
+# Runs a benchmark several times. The benchmark returns a throughput,
+# the median of the runs is returned.
+def measure(benchmark, repeat):
+    return statistics.median(benchmark() for i in range(repeat))
+
+# Runs a function on items in a pool of threads. Returns the elapsed
+# time in seconds.
+def run_threads(function, items, threads):
+    start_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        # Raises the first exception, if any.
+        for result in executor.map(function, items):
+            pass
+    return time.monotonic() - start_time
+
+# Formats a size in bytes for the results names.
+def format_size(size):
+    if size >= 1024 * 1024:
+        return '%dMiB' % (size // (1024 * 1024))
+    return '%dKiB' % (size // 1024)
+
+# Returns distinct contents of a size, generated from the seed.
+def generate_contents(size, count):
+    buffer = random.Random(SEED).randbytes(size + count)
+    return [buffer[i:i + size] for i in range(count)]
+
+# Measures the datastore blobs creation and retrieval throughput in MB/s,
+# per blob size and number of threads. The retrieved blobs are in the
+# page cache.
+def benchmark_datastore(work_dir, settings, results):
+    for size in settings['blob_sizes']:
+        count = min(MAX_BLOBS, max(
+            MIN_BLOBS, settings['datastore_bytes'] // size))
+        contents = generate_contents(size, count)
+        megabytes = size * count / 1e6
+        for threads in settings['threads']:
+            create_speeds = []
+            retrieve_speeds = []
+            for i in range(settings['repeat']):
+                datastore = ts_ds.Datastore(
+                    os.path.join(work_dir, 'datastore'), fanout=2)
+                datastore.create()
+                try:
+                    sha256s = []
+                    def create(content):
+                        sha256s.append(
+                            datastore.create_blob(io.BytesIO(content)))
+                    create_speeds.append(
+                        megabytes / run_threads(create, contents, threads))
+                    def retrieve(sha256):
+                        with datastore.retrieve_blob(sha256) as stream:
+                            while stream.read(ts_ds.BUFFER_SIZE):
+                                pass
+                    retrieve_speeds.append(
+                        megabytes / run_threads(retrieve, sha256s, threads))
+                finally:
+                    datastore.delete()
+            name = 'datastore.%%s.%s.threads%d' % (format_size(size), threads)
+            results.add(
+                name % 'create_blob', statistics.median(create_speeds),
+                'MB/s')
+            results.add(
+                name % 'retrieve_blob', statistics.median(retrieve_speeds),
+                'MB/s')
+
+# Measures the database files creation and retrieval throughput in
+# operations per second, per number of threads sharing a connection pool.
+def benchmark_database(work_dir, settings, results):
+    operations = settings['database_operations']
+    sha256 = hashlib.sha256(b'').hexdigest()
+    for threads in settings['threads']:
+        # Each thread creates files in its own version.
+        files = [
+            ('v%d' % (i % threads), 'f%d' % i) for i in range(operations)]
+        lookups = random.Random(SEED).choices(files, k=operations)
+        speeds = {
+            'create_file': [],
+            'retrieve_file_sha256': [],
+            'retrieve_files': []}
+        for i in range(settings['repeat']):
+            database = ts_db.Database(
+                os.path.join(work_dir, 'database'), threads)
+            database.create()
+            try:
+                def create_file(file):
+                    database.create_file('Project', file[0], file[1], sha256)
+                speeds['create_file'].append(
+                    operations / run_threads(create_file, files, threads))
+                def retrieve_file_sha256(file):
+                    database.retrieve_file_sha256(
+                        'Project', file[0], file[1])
+                speeds['retrieve_file_sha256'].append(
+                    operations / run_threads(
+                        retrieve_file_sha256, lookups, threads))
+                def retrieve_files(file):
+                    database.retrieve_files('Project', file[0], limit=100)
+                speeds['retrieve_files'].append(
+                    operations / run_threads(
+                        retrieve_files, lookups, threads))
+            finally:
+                database.delete()
+        for method, values in speeds.items():
+            results.add(
+                'database.%s.threads%d' % (method, threads),
+                statistics.median(values), 'ops/s')
+
+# Measures the throughput of the small blobs and files creations in
+# operations per second, per durability level and number of threads. The
+# database uses the synchronous setting matching the durability.
+def benchmark_durability(work_dir, settings, results):
+    size = min(settings['blob_sizes'])
+    operations = settings['database_operations']
+    contents = generate_contents(size, operations)
+    for durability in ts_ds.DURABILITIES:
+        for threads in settings['threads']:
+            speeds = {'create_blob': [], 'create_file': []}
+            for i in range(settings['repeat']):
+                engine = ts_e.Engine(
+                    os.path.join(work_dir, 'datastore'),
+                    os.path.join(work_dir, 'database'),
+                    DAYS, database_pool_size=threads, datastore_fanout=2,
+                    durability=durability)
+                engine.create()
+                try:
+                    sha256s = []
+                    def create_blob(content):
+                        sha256s.append(engine.datastore.create_blob(
+                            io.BytesIO(content)))
+                    speeds['create_blob'].append(operations / run_threads(
+                        create_blob, contents, threads))
+                    def create_file(i):
+                        engine.database.create_file(
+                            'Project', 'v%d' % (i % threads), 'f%d' % i,
+                            sha256s[i])
+                    speeds['create_file'].append(operations / run_threads(
+                        create_file, range(operations), threads))
+                finally:
+                    engine.delete()
+            results.add(
+                'durability.create_blob.%s.threads%d.%s' % (
+                    format_size(size), threads, durability),
+                statistics.median(speeds['create_blob']), 'ops/s')
+            results.add(
+                'durability.create_file.threads%d.%s' % (
+                    threads, durability),
+                statistics.median(speeds['create_file']), 'ops/s')
+
+# Creates a synthetic store of blobs, written directly in the datastore
+# and older than the deletion grace period. Half of the blobs belong to
+# obsolete versions, the other half to recent versions.
+def seed_store(engine, count, batch_size=1000):
+    timestamp = time.time() - DAYS
+    for start in range(0, count, batch_size):
+        files = []
+        for i in range(start, min(start + batch_size, count)):
+            content = b'%d' % i
+            sha256 = hashlib.sha256(content).hexdigest()
+            file_path = engine.datastore.blob_path(sha256)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            os.utime(file_path, (timestamp, timestamp))
+            files.append(('f%d' % i, sha256))
+        age = 2 * DAYS if start // batch_size % 2 == 0 else 0
+        engine.database.create_files(
+            'Project', 'v%d' % start, files, age)
+
+# Measures the cleanups throughput in blobs per second, per store size:
+# the cleanup deleting the blobs of the obsolete versions, then the full
+# cleanup scanning the remaining blobs. Each size runs once, seeding the
+# store takes longer than the cleanups.
+def benchmark_cleanup(work_dir, settings, results):
+    for count in settings['cleanup_sizes']:
+        engine = ts_e.Engine(
+            os.path.join(work_dir, 'datastore'),
+            os.path.join(work_dir, 'database'),
+            DAYS, datastore_fanout=2)
+        engine.create()
+        try:
+            seed_store(engine, count)
+            start_time = time.monotonic()
+            counts = engine.cleanup()
+            elapsed = time.monotonic() - start_time
+            if counts['deleted'] == 0:
+                raise BenchmarkException('No blob deleted')
+            results.add(
+                'cleanup.cleanup.blobs%d' % count,
+                counts['deleted'] / elapsed, 'blobs/s')
+            start_time = time.monotonic()
+            counts = engine.full_cleanup()
+            elapsed = time.monotonic() - start_time
+            results.add(
+                'cleanup.full_cleanup.blobs%d' % count,
+                counts['scanned'] / elapsed, 'blobs/s')
+        finally:
+            engine.delete()
+
+# Returns a free local TCP port.
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Launches gunicorn serving the benchmark app on a local port. Returns
+# the process and the port.
+def start_server(work_dir, gunicorn):
+    port = free_port()
+    env = dict(os.environ, TEMPSTORE_BENCHMARK_DIR=work_dir)
+    process = subprocess.Popen(
+        [gunicorn,
+            '--workers', str(HTTP_WORKERS),
+            '--bind', '127.0.0.1:%d' % port,
+            '--log-level', 'warning',
+            'benchmarks.app:app'],
+        env=env)
+    # Waits for the server to accept connections.
+    deadline = time.monotonic() + 30
+    while True:
+        if process.poll() is not None:
+            raise BenchmarkException('Unable to start gunicorn')
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process, port
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise BenchmarkException('Unable to start gunicorn')
+            time.sleep(0.1)
+
+# Performs an HTTP request. Returns the response body.
+def http_request(port, method, path, body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status >= 400:
+            raise BenchmarkException(
+                'Request failed: %s %s %d' % (method, path, response.status))
+        return data
+    finally:
+        connection.close()
+
+# Measures the end-to-end HTTP throughput against a local gunicorn:
+# raw uploads and downloads in MB/s per blob size, and version pages in
+# requests per second.
+def benchmark_http(work_dir, settings, results, gunicorn):
+    engine = ts_e.Engine(
+        os.path.join(work_dir, 'datastore'),
+        os.path.join(work_dir, 'database'),
+        DAYS)
+    engine.create()
+    process, port = start_server(work_dir, gunicorn)
+    try:
+        for size in settings['blob_sizes']:
+            count = min(MAX_BLOBS, max(
+                MIN_BLOBS, settings['http_bytes'] // size))
+            contents = generate_contents(size, count)
+            megabytes = size * count / 1e6
+            upload_speeds = []
+            download_speeds = []
+            for run in range(settings['repeat']):
+                version = '%s-%d' % (format_size(size), run)
+                paths = [
+                    '/%%s/Project/%s/f%d' % (version, i)
+                    for i in range(count)]
+                def upload(i):
+                    http_request(
+                        port, 'PUT', paths[i] % 'upload', contents[i])
+                upload_speeds.append(megabytes / run_threads(
+                    upload, range(count), HTTP_CLIENTS))
+                def download(path):
+                    http_request(port, 'GET', path % 'download')
+                download_speeds.append(megabytes / run_threads(
+                    download, paths, HTTP_CLIENTS))
+            results.add(
+                'http.upload.%s' % format_size(size),
+                statistics.median(upload_speeds), 'MB/s')
+            results.add(
+                'http.download.%s' % format_size(size),
+                statistics.median(download_speeds), 'MB/s')
+        # Shows the page of the last uploaded version.
+        path = '/version/Project/%s-%d' % (
+            format_size(settings['blob_sizes'][-1]), settings['repeat'] - 1)
+        requests = settings['database_operations']
+        def run():
+            def page(i):
+                http_request(port, 'GET', path)
+            return requests / run_threads(
+                page, range(requests), HTTP_CLIENTS)
+        results.add(
+            'http.version_page', measure(run, settings['repeat']),
+            'requests/s')
+    finally:
+        process.terminate()
+        process.wait()
+        engine.delete()
+
+# Compares results with a baseline. Returns the regressions as (name,
+# baseline value, value) tuples.
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for name, result in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result['value'] < reference['value'] * (1 - tolerance):
+            regressions.append((name, reference['value'], result['value']))
+    return regressions
+
+# Prints the comparison of the results with a baseline.
+def print_comparison(results, baseline):
+    print()
+    print('%-48s %12s %12s %8s' % ('', 'baseline', 'current', 'change'))
+    for name, result in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None or reference['value'] == 0:
+            continue
+        change = result['value'] / reference['value'] - 1
+        print('%-48s %12.1f %12.1f %+7.1f%%' % (
+            name, reference['value'], result['value'], 100 * change))
+
+# Returns a description of the machine and interpreter. Results are only
+# comparable with a baseline recorded on the same environment.
+def describe_environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()}
+
+# Runs the benchmarks from the command line, from the repository root.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--suite',
+        help='run only some benchmarks suites',
+        choices=['datastore', 'database', 'durability', 'cleanup', 'http'],
+        action='append')
+    parser.add_argument(
+        '--quick',
+        help='run smaller benchmarks, as a smoke test',
+        action='store_true')
+    parser.add_argument(
+        '--output',
+        help='write the results to a JSON file',
+        default='benchmark-results.json')
+    parser.add_argument(
+        '--baseline',
+        help='compare the results with a JSON results file, '
+            'fail on regressions')
+    parser.add_argument(
+        '--tolerance',
+        help='relative slowdown tolerated before failing',
+        type=float,
+        default=TOLERANCE)
+    parser.add_argument(
+        '--work-dir',
+        help='directory of the temporary stores, on the production '
+            'file system',
+        default='.')
+    parser.add_argument(
+        '--gunicorn',
+        help='gunicorn executable of the HTTP benchmarks',
+        default=shutil.which('gunicorn') or 'gunicorn')
+    args = parser.parse_args()
+    settings = {
+        'blob_sizes': BLOB_SIZES,
+        'datastore_bytes': DATASTORE_BYTES,
+        'threads': THREADS,
+        'database_operations': DATABASE_OPERATIONS,
+        'cleanup_sizes': CLEANUP_SIZES,
+        'http_bytes': HTTP_BYTES,
+        'repeat': REPEAT}
+    if args.quick:
+        settings.update(QUICK_SETTINGS)
+    suites = args.suite or [
+        'datastore', 'database', 'durability', 'cleanup', 'http']
+    # The stores are created in a temporary directory of the work
+    # directory, as /tmp may be a memory file system.
+    work_dir = tempfile.mkdtemp(
+        prefix='tempstore-benchmark-', dir=args.work_dir)
+    results = Results()
+    try:
+        if 'datastore' in suites:
+            benchmark_datastore(work_dir, settings, results)
+        if 'database' in suites:
+            benchmark_database(work_dir, settings, results)
+        if 'durability' in suites:
+            benchmark_durability(work_dir, settings, results)
+        if 'cleanup' in suites:
+            benchmark_cleanup(work_dir, settings, results)
+        if 'http' in suites:
+            benchmark_http(work_dir, settings, results, args.gunicorn)
+    finally:
+        shutil.rmtree(work_dir)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'environment': describe_environment(),
+            'settings': settings,
+            'results': results.results}, f, indent=2, sort_keys=True)
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['environment'] != describe_environment():
+        print('Warning: the baseline was recorded on another environment')
+    if baseline['settings'] != settings:
+        print('Warning: the baseline was recorded with other settings')
+    print_comparison(results.results, baseline['results'])
+    regressions = compare(
+        results.results, baseline['results'], args.tolerance)
+    for name, reference, value in regressions:
+        print('Regression: %s %.1f -> %.1f' % (name, reference, value))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,61 @@
+import tempstore.asgiapp as ts_aa
 import tempstore.engine as ts_e
+import tempstore.metrics as ts_m
 import tempstore.webapp as ts_wa
 
 import argparse
 
 BASE_URL = 'http://localhost:8000'
 
+# Serves the downloads from the app. Set to 'x-accel-redirect' to
+# offload them to nginx, or to 'x-sendfile' for other front servers.
+DOWNLOAD_MODE = 'direct'
+OFFLOAD_LOCATION = None
+
+# Stores the new blobs as they are. Set to 'gzip' or 'lzma' to compress
+# them when they compress.
+COMPRESSION = None
+
+# Compresses at the default level of the codec, 6 for gzip and 1 for
+# lzma. Set to a level from 1 to 9 for gzip, or from 0 to 9 for lzma, to
+# trade the upload throughput for the compression ratio.
+COMPRESSION_LEVEL = None
+
+# Stores each blob as a single file. Set to True to split the blobs into
+# content-defined chunks shared by the similar blobs instead.
+CHUNKING = False
+
+# Directory where each process writes its metrics, summed by the
+# /metrics route. The files of the terminated processes are merged when
+# scraped.
+METRICS_DIR = 'metrics'
+
+# Flushes each blob and its directory to disk before acknowledging its
+# upload. Set to 'group' to batch the flushes of the concurrent uploads,
+# or to 'relaxed' to leave them to the operating system.
+DURABILITY = 'strict'
+
 # Instantiates the engine.
-engine = ts_e.Engine('datastore', 'database', 30*24*60*60)
+# Each worker keeps up to 8 database connections open.
+# The blobs are fanned out in two levels of directories.
+# Each worker caches up to 10000 metadata queries results.
+engine = ts_e.Engine(
+    'datastore', 'database', 30*24*60*60,
+    database_pool_size=8, datastore_fanout=2, cache_size=10000,
+    datastore_compression=COMPRESSION, datastore_chunking=CHUNKING,
+    durability=DURABILITY, datastore_compression_level=COMPRESSION_LEVEL)
 
 # Instantiates the WSGI app.
-app = ts_wa.App(engine, BASE_URL)
+# The templates bytecode is cached on disk, and each worker caches up to
+# 1000 rendered pages. The metrics of the workers and of the command line
+# are shared.
+app = ts_wa.App(
+    engine, BASE_URL, DOWNLOAD_MODE, OFFLOAD_LOCATION,
+    bytecode_cache_dir='bytecode-cache', page_cache_size=1000,
+    metrics_dir=METRICS_DIR)
+
+# Instantiates the ASGI app, serving the same routes.
+asgi_app = ts_aa.AsgiApp(app)
 
 # Uses the engine from the command line.
 if __name__ == "__main__":
@@ -18,12 +64,83 @@ if __name__ == "__main__":
         '--init',
         help='bootstrap or reset the contents',
         action='store_true')
+    parser.add_argument(
+        '--import',
+        help='import a tree of project/version/file files',
+        dest='import_dir',
+        metavar='DIR')
+    parser.add_argument(
+        '--import-workers',
+        help='number of processes hashing the imported files',
+        type=int)
+    parser.add_argument(
+        '--import-no-link',
+        help='never hard-link the imported files, copy them instead',
+        action='store_true')
     parser.add_argument(
         '--cleanup',
         help='clean up the obsolete versions and unreferrenced blobs',
         action='store_true')
+    parser.add_argument(
+        '--full-cleanup',
+        help='clean up and scan the whole datastore for unreferenced blobs',
+        action='store_true')
+    parser.add_argument(
+        '--scrub',
+        help='verify the integrity of the blobs',
+        action='store_true')
+    parser.add_argument(
+        '--scrub-rate',
+        help='limit the scrubbing reads in MB/s',
+        type=float)
+    parser.add_argument(
+        '--quarantine',
+        help='move the corrupted blobs to quarantine when scrubbing',
+        action='store_true')
+    parser.add_argument(
+        '--upgrade',
+        help='upgrade the database schema',
+        action='store_true')
+    parser.add_argument(
+        '--migrate-datastore',
+        help='move the blobs to the configured fan-out layout',
+        action='store_true')
     args = parser.parse_args()
     if args.init:
         engine.create()
-    if args.cleanup:
-        engine.cleanup()
+    if args.upgrade:
+        engine.upgrade()
+    if args.import_dir:
+        statistics = engine.import_tree(
+            args.import_dir, args.import_workers,
+            link=not args.import_no_link)
+        print(
+            'Imported %(files)d files, %(bytes)d bytes: '
+            '%(reflink)d reflinked, %(link)d linked, %(copy)d copied, '
+            '%(existing)d deduplicated, skipped %(skipped)d'
+            % statistics)
+    if args.cleanup or args.full_cleanup:
+        if args.full_cleanup:
+            statistics = engine.full_cleanup()
+        else:
+            statistics = engine.cleanup()
+        print(
+            'Scanned %(scanned)d blobs, kept %(kept)d, '
+            'deleted %(deleted)d, freed %(bytes_freed)d bytes'
+            % statistics)
+    if args.scrub:
+        rate = None
+        if args.scrub_rate:
+            rate = args.scrub_rate * 1024 * 1024
+        statistics = engine.scrub(rate=rate, quarantine=args.quarantine)
+        print(
+            'Scrubbed %d blobs, %d bytes'
+            % (statistics['scanned'], statistics['bytes']))
+        for sha256 in statistics['corrupted']:
+            print('Corrupted blob %s' % sha256)
+        for sha256 in statistics['missing']:
+            print('Missing blob %s' % sha256)
+    if args.migrate_datastore:
+        count = engine.migrate_datastore()
+        print('Moved %d blobs' % count)
+    ts_m.REGISTRY.flush(force=True)
@@ -0,0 +1,242 @@
+import tempstore.webapp as ts_wa
+
+import werkzeug.exceptions
+import werkzeug.wrappers
+
+import asyncio
+import concurrent.futures
+import functools
+import io
+import sys
+import tempfile
+import time
+import traceback
+
+BUFFER_SIZE = 262144
+
+# Request bodies larger than this are spooled to disk.
+SPOOL_SIZE = 1024 * 1024
+
+# Builds a WSGI environment from an ASGI HTTP scope. The request body
+# input is set by the caller.
+def build_environ(scope):
+    # WSGI strings are the raw bytes decoded as Latin-1.
+    root_path = scope.get('root_path', '').encode().decode('latin-1')
+    path = scope['path'].encode().decode('latin-1')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': str(client[0]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper}
+    # Converts the headers, joining the repeated ones.
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+# WSGI file wrapper. Reads a file by blocks, the ASGI app reads each
+# block in its thread pool.
+class FileWrapper:
+
+    def __init__(self, filelike, block_size=BUFFER_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        buffer = self.filelike.read(self.block_size)
+        if not buffer:
+            raise StopIteration
+        return buffer
+
+    def close(self):
+        self.filelike.close()
+
+# ASGI front end for a WSGI app, serving the same routes. The request and
+# response bodies are transferred asynchronously, so slow clients do not
+# hold a thread. The blocking calls to the WSGI app (engine, database,
+# datastore, templates) run in a bounded thread pool.
+# The request bodies of the app streaming endpoints are passed to their
+# body consumers as they are received. The other request bodies are
+# spooled before calling the WSGI app.
+class AsgiApp:
+
+    def __init__(self, app, max_workers=16):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='tempstore')
+
+    # ASGI entry point.
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type: ' + scope['type'])
+        environ = build_environ(scope)
+        # Streams the request body to the endpoint body consumer.
+        endpoint, values = self.match_streaming_endpoint(environ)
+        if endpoint is not None:
+            await self.stream_body(environ, endpoint, values, receive, send)
+            return
+        # Receives the request body, then calls the WSGI app.
+        body = await self.receive_body(receive)
+        if body is None:
+            return
+        try:
+            # The body length is known even if the request was chunked.
+            environ['CONTENT_LENGTH'] = str(body.seek(0, 2))
+            body.seek(0)
+            environ['wsgi.input'] = body
+            await self.respond(self.app, environ, send)
+        finally:
+            body.close()
+
+    # Runs a blocking function in the thread pool.
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    # Handles the server startup and shutdown.
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Returns the matching streaming endpoint and the URL values, or None
+    # and None.
+    def match_streaming_endpoint(self, environ):
+        streaming_endpoints = getattr(self.app, 'streaming_endpoints', {})
+        adapter = self.app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, values = adapter.match()
+        except werkzeug.exceptions.HTTPException:
+            return None, None
+        if endpoint not in streaming_endpoints:
+            return None, None
+        return endpoint, values
+
+    # Passes the request body to the body consumer of a streaming endpoint
+    # as it is received, then sends the consumer response. Counts and
+    # times the requests, the request body included.
+    async def stream_body(self, environ, endpoint, values, receive, send):
+        create_consumer = self.app.streaming_endpoints[endpoint]
+        request = werkzeug.wrappers.Request(environ)
+        consumer = None
+        start_time = time.monotonic()
+        try:
+            consumer = await self.run(functools.partial(
+                create_consumer, request, **values))
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    await self.run(consumer.abort)
+                    # Client closed the request, as logged by nginx.
+                    await self.run(
+                        ts_wa.record_request, endpoint, 499, start_time)
+                    return
+                buffer = message.get('body', b'')
+                if buffer:
+                    await self.run(consumer.feed, buffer)
+                if not message.get('more_body', False):
+                    break
+            response = await self.run(consumer.finish)
+        except Exception:
+            traceback.print_exc()
+            if consumer is not None:
+                await self.run(consumer.abort)
+            response = werkzeug.wrappers.Response(status=500)
+        await self.run(
+            ts_wa.record_request, endpoint, response.status_code, start_time)
+        await self.respond(response, environ, send)
+
+    # Receives the request body into a spooled temporary file.
+    # Returns None if the client disconnected.
+    async def receive_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            buffer = message.get('body', b'')
+            if buffer:
+                await self.run(body.write, buffer)
+            if not message.get('more_body', False):
+                return body
+
+    # Calls a WSGI app. Returns the status, the headers, the response
+    # iterable, and its first block.
+    def call_app(self, app, environ):
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+        app_iter = app(environ, start_response)
+        # The app may only start the response when iterated.
+        iterator = iter(app_iter)
+        buffer = next(iterator, None)
+        return (
+            response['status'], response['headers'],
+            app_iter, iterator, buffer)
+
+    # Calls a WSGI app and sends its response.
+    async def respond(self, app, environ, send):
+        status, headers, app_iter, iterator, buffer = \
+            await self.run(self.call_app, app, environ)
+        try:
+            # Never sends more than the content length.
+            remaining = None
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    remaining = int(value)
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [
+                    (name.encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers]})
+            while buffer is not None:
+                if remaining is not None:
+                    buffer = buffer[:remaining]
+                    remaining -= len(buffer)
+                if buffer:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': buffer,
+                        'more_body': True})
+                if remaining == 0:
+                    break
+                buffer = await self.run(next, iterator, None)
+            await send({'type': 'http.response.body'})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await self.run(app_iter.close)
@@ -0,0 +1,45 @@
+import collections
+import threading
+
+# Thread-safe cache of bounded size, evicting the least recently used
+# entries. A cache with a maximum size of 0 never keeps anything.
+class LruCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented when the cache is cleared.
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the value of a key and marks it as recently used,
+    # or None if the key is not cached.
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Caches the value of a key, evicting the least recently used entries
+    # over the maximum size. The value is dropped if the cache was cleared
+    # since the epoch it was retrieved at: it may be outdated.
+    def put(self, key, value, epoch):
+        with self.lock:
+            if self.max_size <= 0 or epoch != self.epoch:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Removes all the entries.
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
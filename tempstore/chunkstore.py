@@ -0,0 +1,570 @@
+import tempstore.datastore as ts_ds
+import tempstore.metrics as ts_m
+
+import binascii
+import bisect
+import fcntl
+import hashlib
+import os
+import os.path
+import re
+import time
+import uuid
+
+# Chunk sizes. The chunks are cut at content-defined boundaries, so that
+# the chunks of similar blobs are the same, except around the changes.
+CHUNK_MIN_SIZE = 16384
+CHUNK_AVERAGE_SIZE = 65536
+CHUNK_MAX_SIZE = 262144
+
+# Number of successive bytes mixed into each byte of the mixed stream
+# the boundaries are searched in.
+MIX_WINDOW = 8
+
+# Substitution tables of the mixing, one per byte of the window: random
+# values derived from the bytes values, so that the boundaries never
+# change.
+MIX_TABLES = [
+    bytes(hashlib.sha256(bytes([k, i])).digest()[0] for i in range(256))
+    for k in range(MIX_WINDOW)]
+
+# Patterns of the mixed stream ending a chunk. A boundary is less likely
+# before the average size (one position in 2^17) and more likely after it
+# (one in 2^15), which narrows the chunks sizes distribution. Neither
+# matches a run of the same byte, e.g.: zeros.
+CHUNK_PATTERN_SMALL = re.compile(b'\x00\x01[\x00-\x7f]')
+CHUNK_PATTERN_LARGE = re.compile(b'\x00[\x01\x02]')
+
+# Prefix of the names of the temporary manifests, in the directory of the
+# temporary files.
+TEMP_MANIFEST_PREFIX = 'manifest-'
+
+# Returns the mixed stream of data: each byte is a hash of the window
+# of bytes starting at the same position, so that the boundaries only
+# depend on the nearby bytes. The mixing is done by whole buffers with
+# the builtin bytes and integers operations, as hashing in Python byte
+# by byte would be orders of magnitude slower.
+def mix(data):
+    size = len(data) - MIX_WINDOW + 1
+    if size <= 0:
+        return b''
+    value = 0
+    for k, table in enumerate(MIX_TABLES):
+        value ^= int.from_bytes(data[k:k+size].translate(table), 'big')
+    return value.to_bytes(size, 'big')
+
+# Position of the first byte of the window of the earliest match of a
+# boundary pattern ending past the minimum size. The bytes before it are
+# never mixed.
+MIX_START = CHUNK_MIN_SIZE - 3 - (MIX_WINDOW - 1)
+
+# Splits a stream into content-defined chunks. A chunk ends after the
+# window of the first match of a boundary pattern in the mixed stream,
+# past the minimum size.
+class Chunker:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Mixed stream of the buffer from MIX_START, and the position from
+        # which the patterns are not searched yet.
+        self.mixed = bytearray()
+        self.scanned = 0
+
+    # Appends data to the stream. Returns the completed chunks.
+    def feed(self, data):
+        self.buffer += data
+        chunks = []
+        while True:
+            cut = self.find_cut()
+            if cut is None:
+                return chunks
+            chunks.append(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+            self.mixed = bytearray()
+            self.scanned = 0
+
+    # Ends the stream. Returns the last chunk, if any.
+    def finish(self):
+        chunks = [bytes(self.buffer)] if self.buffer else []
+        self.buffer = bytearray()
+        self.mixed = bytearray()
+        self.scanned = 0
+        return chunks
+
+    # Returns the size of the chunk at the beginning of the buffer,
+    # or None if its boundary is not in the buffer yet.
+    def find_cut(self):
+        end = min(len(self.buffer), CHUNK_MAX_SIZE)
+        if end < CHUNK_MIN_SIZE:
+            return None
+        # Mixes the bytes received since the last search.
+        mixed_end = MIX_START + len(self.mixed)
+        if mixed_end < end - MIX_WINDOW + 1:
+            self.mixed += mix(self.buffer[mixed_end:end])
+        # Searches the matches whose window ends between the minimum and
+        # the average size, then up to the maximum size.
+        tail = MIX_WINDOW - 1
+        for pattern, length, start, stop in [
+                (CHUNK_PATTERN_SMALL, 3, CHUNK_MIN_SIZE, CHUNK_AVERAGE_SIZE),
+                (CHUNK_PATTERN_LARGE, 2, CHUNK_AVERAGE_SIZE + 1,
+                    CHUNK_MAX_SIZE)]:
+            match = pattern.search(
+                self.mixed,
+                max(self.scanned, start - length - tail - MIX_START),
+                min(len(self.mixed), stop - tail - MIX_START))
+            if match is not None:
+                return MIX_START + match.end() + tail
+        if end >= CHUNK_MAX_SIZE:
+            return CHUNK_MAX_SIZE
+        # The matches starting before the end of the mixed stream may
+        # still be incomplete.
+        self.scanned = max(self.scanned, len(self.mixed) - 2)
+        return None
+
+# Writes a blob as chunks while computing its SHA-256 hash. Each chunk is
+# stored once, named after its own SHA-256 hash. The list of the chunks
+# is written to a temporary manifest as they are stored, so that the
+# garbage collection keeps them, then the manifest is moved to its final
+# location once the blob hash is known. The new chunks are written to
+# temporary files, and only flushed to disk and installed along with the
+# manifest, so that a blob costs two flushes rather than two per chunk.
+class ChunkedBlobWriter:
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.sha256 = hashlib.sha256()
+        self.chunker = Chunker()
+        self.temp_file_path = datastore.create_temp_path(
+            TEMP_MANIFEST_PREFIX)
+        self.file = open(self.temp_file_path, 'x')
+        # Holds the temporary manifest, so that the cleanups keep it
+        # however long the write lasts.
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.size = 0
+        self.chunk_paths = []
+        # Temporary files of the new chunks, by final path.
+        self.temp_chunk_paths = {}
+
+    # Appends data to the blob.
+    def write(self, buffer):
+        self.sha256.update(buffer)
+        self.size += len(buffer)
+        for chunk in self.chunker.feed(buffer):
+            self.write_chunk(chunk)
+
+    # Appends the contents of a stream to the blob.
+    def write_stream(self, stream):
+        for buffer in iter(lambda: stream.read(ts_ds.BUFFER_SIZE), b''):
+            self.write(buffer)
+
+    # Stores a chunk unless it already exists, and adds it to the
+    # manifest. A new chunk is written to a temporary file named after
+    # its hash, which the garbage collection keeps while it is listed by
+    # the temporary manifest.
+    def write_chunk(self, chunk):
+        sha256 = hashlib.sha256(chunk).hexdigest()
+        file_path = self.datastore.chunk_path(sha256)
+        # Keeps the existing chunk if there is one. Only refreshes its
+        # timestamp so that it is not deleted before being referenced.
+        try:
+            if file_path not in self.temp_chunk_paths:
+                os.utime(file_path)
+            self.datastore.count_chunk_dedup_hit(len(chunk))
+        except FileNotFoundError:
+            temp_file_path = os.path.join(
+                self.datastore.chunks_dir,
+                'temp-%s-%s' % (sha256, uuid.uuid4().hex))
+            with open(temp_file_path, 'xb') as f:
+                f.write(chunk)
+            ts_m.DATASTORE_WRITTEN_BYTES.inc(amount=len(chunk))
+            self.temp_chunk_paths[file_path] = temp_file_path
+        self.chunk_paths.append(file_path)
+        self.file.write('%s %d\n' % (sha256, len(chunk)))
+        self.file.flush()
+
+    # Completes the blob. Returns its SHA-256 hash.
+    # The age in seconds should only be specified when testing.
+    def commit(self, age=0):
+        for chunk in self.chunker.finish():
+            self.write_chunk(chunk)
+        sha256 = binascii.hexlify(self.sha256.digest()).decode()
+        file_path = self.datastore.blob_path(sha256)
+        timestamp = int(time.time()) - age
+        # Keeps the existing manifest if there is one. Only refreshes its
+        # timestamp so that it is not deleted before being referenced.
+        # The new chunks are installed anyway, they may replace missing
+        # ones.
+        try:
+            os.utime(file_path, (timestamp, timestamp))
+            exists = True
+        except FileNotFoundError:
+            exists = False
+        # Flushes the new chunks and the temporary manifest to disk.
+        self.file.flush()
+        temp_paths = list(self.temp_chunk_paths.values())
+        if not exists:
+            temp_paths.append(self.temp_file_path)
+        self.datastore.sync_paths(temp_paths)
+        # Installs the new chunks, then the manifest, and flushes all their
+        # directories entries to disk.
+        modified_dirs = {}
+        for chunk_path, temp_chunk_path in self.temp_chunk_paths.items():
+            for modified_dir in self.datastore.move_file(
+                    temp_chunk_path, chunk_path):
+                modified_dirs[modified_dir] = True
+        self.temp_chunk_paths = {}
+        # Refreshes the timestamps of the chunks, so that none is deleted
+        # before the manifest is counted in the database, and fails if one
+        # was deleted meanwhile.
+        for chunk_path in set(self.chunk_paths):
+            try:
+                os.utime(chunk_path, (timestamp, timestamp))
+            except FileNotFoundError:
+                raise ts_ds.DatastoreException('Chunk not found')
+        if exists:
+            os.unlink(self.temp_file_path)
+            self.datastore.count_dedup_hit(self.size)
+        else:
+            # Fix the temporary manifest timestamp.
+            os.utime(self.temp_file_path, (timestamp, timestamp))
+            for modified_dir in self.datastore.move_file(
+                    self.temp_file_path, file_path):
+                modified_dirs[modified_dir] = True
+        self.file.close()
+        self.datastore.sync_paths(list(modified_dirs))
+        # Returns the SHA-256 hash.
+        return sha256
+
+    # Discards the blob, and the new chunks. The existing chunks are
+    # deleted by the garbage collection unless referenced by another blob.
+    def abort(self):
+        try:
+            os.unlink(self.temp_file_path)
+        finally:
+            self.file.close()
+        for temp_chunk_path in self.temp_chunk_paths.values():
+            os.unlink(temp_chunk_path)
+        self.temp_chunk_paths = {}
+
+# Reads a chunked blob. Supports seeking.
+class ChunkedBlob:
+
+    def __init__(self, datastore, chunks):
+        self.datastore = datastore
+        self.chunks = chunks
+        # Offsets of the chunks in the blob.
+        self.offsets = []
+        self.size = 0
+        for sha256, size in chunks:
+            self.offsets.append(self.size)
+            self.size += size
+        self.position = 0
+        self.file = None
+        self.file_index = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        buffers = []
+        while size > 0 and self.position < self.size:
+            # Opens the chunk at the current position.
+            index = bisect.bisect_right(self.offsets, self.position) - 1
+            if index != self.file_index:
+                self.close()
+                self.file = self.datastore.open_chunk(self.chunks[index][0])
+                self.file_index = index
+            # Reads up to the end of the chunk.
+            offset = self.position - self.offsets[index]
+            self.file.seek(offset)
+            buffer = self.file.read(
+                min(size, self.chunks[index][1] - offset))
+            if not buffer:
+                raise ts_ds.DatastoreException('Truncated chunk')
+            buffers.append(buffer)
+            self.position += len(buffer)
+            size -= len(buffer)
+        return b''.join(buffers)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Filesystem-backed datastore storing the blobs as content-defined
+# chunks, so that the similar blobs share most of their chunks.
+# Each blob is a manifest listing its chunks. The manifests and the
+# chunks are stored in their own directories, named after their SHA-256
+# hashes, with the fan-out depth of the datastore.
+class ChunkedDatastore(ts_ds.Datastore):
+
+    def __init__(
+            self, data_dir, fanout=0, compression=None,
+            durability=ts_ds.DURABILITY_STRICT, compression_level=None):
+        if compression is not None or compression_level is not None:
+            raise ts_ds.DatastoreException(
+                'Compression unsupported with chunks')
+        ts_ds.Datastore.__init__(
+            self, data_dir, fanout, durability=durability)
+        self.manifests_dir = os.path.join(data_dir, 'manifests')
+        self.chunks_dir = os.path.join(data_dir, 'chunks')
+        # Counts the chunks which already existed when stored.
+        self.chunk_dedup_hits = 0
+        self.chunk_dedup_bytes = 0
+
+    # Creates or resets the datastore.
+    def create(self):
+        ts_ds.Datastore.create(self)
+        os.mkdir(self.manifests_dir)
+        os.mkdir(self.chunks_dir)
+
+    # Creates a blob writer to write a blob incrementally.
+    def create_blob_writer(self):
+        return ChunkedBlobWriter(self)
+
+    # Records that a chunk of the specified size already existed.
+    def count_chunk_dedup_hit(self, size):
+        with self.dedup_lock:
+            self.chunk_dedup_hits += 1
+            self.chunk_dedup_bytes += size
+
+    # Returns the path of a blob manifest from its SHA-256 hash.
+    def blob_path(self, sha256, fanout=None):
+        if fanout is None:
+            fanout = self.fanout
+        shards = [sha256[2*i:2*i+2] for i in range(fanout)]
+        return os.path.join(self.manifests_dir, *shards, sha256)
+
+    # Returns the path of a chunk from its SHA-256 hash.
+    def chunk_path(self, sha256, fanout=None):
+        if fanout is None:
+            fanout = self.fanout
+        shards = [sha256[2*i:2*i+2] for i in range(fanout)]
+        return os.path.join(self.chunks_dir, *shards, sha256)
+
+    # Opens a chunk from its SHA-256 hash.
+    def open_chunk(self, sha256):
+        file_paths = [self.chunk_path(sha256)]
+        if self.fanout > 0:
+            file_paths.append(self.chunk_path(sha256, 0))
+        for file_path in file_paths:
+            try:
+                return open(file_path, 'rb')
+            except FileNotFoundError:
+                pass
+        raise ts_ds.DatastoreException('Chunk not found')
+
+    # The blobs are not stored as single files.
+    def locate_blob(self, sha256):
+        raise ts_ds.DatastoreException('Blob not stored as a file')
+
+    # Splits a complete file into the chunks of a blob, then deletes it.
+    # The chunked blob writer keeps the existing blob if there is one.
+    def adopt_blob(self, file_path, sha256, age=0):
+        self.copy_blob(file_path, sha256, age)
+        os.unlink(file_path)
+
+    # The chunks never share the data of the files.
+    def clone_blob(self, file_path, sha256, link=True):
+        self.copy_blob(file_path, sha256)
+        return 'copy'
+
+    # Opens a blob from its SHA-256 hash. Returns a stream and no codec.
+    # Raises an exception if the SHA-256 is invalid/unknown.
+    def open_blob(self, sha256):
+        stream, codec = ts_ds.Datastore.open_blob(self, sha256)
+        with stream:
+            chunks = parse_manifest(stream.read().decode())
+        return ChunkedBlob(self, chunks), None
+
+    # Retrieves a blob from its SHA-256 hash. Returns a stream.
+    # Raises an exception if the SHA-256 is invalid/unknown.
+    def retrieve_blob(self, sha256):
+        return self.open_blob(sha256)[0]
+
+    # Retrieves the SHA-256 hashes of the chunks of a blob.
+    # Raises an exception if the SHA-256 is invalid/unknown.
+    def retrieve_chunk_sha256s(self, sha256):
+        stream, codec = ts_ds.Datastore.open_blob(self, sha256)
+        with stream:
+            chunks = parse_manifest(stream.read().decode())
+        return [chunk_sha256 for chunk_sha256, size in chunks]
+
+    # Lists the manifests of the blobs. Yields their SHA-256 hashes and
+    # the SHA-256 hashes of their chunks.
+    def scan_manifests(self):
+        for entry in self.scan():
+            sha256, codec = ts_ds.parse_blob_name(entry.name)
+            if sha256 is None:
+                continue
+            try:
+                with open(entry.path) as f:
+                    chunks = parse_manifest(f.read())
+            except FileNotFoundError:
+                continue
+            yield sha256, [chunk_sha256 for chunk_sha256, size in chunks]
+
+    # Retrieves the SHA-256 hashes of the chunks listed by the temporary
+    # manifests of the blobs being written.
+    def retrieve_writing_chunk_sha256s(self):
+        sha256s = set()
+        temp_dir = os.path.join(self.data_dir, ts_ds.TEMP_DIR)
+        try:
+            with os.scandir(temp_dir) as iterator:
+                entries = list(iterator)
+        except FileNotFoundError:
+            return sha256s
+        for entry in entries:
+            if not entry.name.startswith(TEMP_MANIFEST_PREFIX):
+                continue
+            try:
+                with open(entry.path) as f:
+                    sha256s.update(
+                        sha256 for sha256, size in
+                        parse_manifest(f.read()))
+            except FileNotFoundError:
+                pass
+        return sha256s
+
+    # Deletes chunks from their SHA-256 hashes, unless listed by the
+    # manifest of a blob being written or modified less than 60 seconds
+    # ago. Returns the SHA-256 hashes of the deleted chunks, and the freed
+    # bytes.
+    def delete_chunks(self, sha256s):
+        now = int(time.time())
+        writing_sha256s = self.retrieve_writing_chunk_sha256s()
+        deleted_sha256s = []
+        freed_bytes = 0
+        for sha256 in sha256s:
+            # Validates the parameter.
+            ts_ds.validate_sha256(sha256)
+            if sha256 in writing_sha256s:
+                continue
+            # Deletes the chunk, wherever the layout stores it.
+            file_paths = [self.chunk_path(sha256)]
+            if self.fanout > 0:
+                file_paths.append(self.chunk_path(sha256, 0))
+            kept = False
+            for file_path in file_paths:
+                try:
+                    stat = os.stat(file_path)
+                    # The chunk may have just been stored again.
+                    if stat.st_mtime > now - 60:
+                        kept = True
+                        break
+                    os.unlink(file_path)
+                    freed_bytes += stat.st_size
+                except FileNotFoundError:
+                    pass
+            if not kept:
+                deleted_sha256s.append(sha256)
+        return deleted_sha256s, freed_bytes
+
+    # Deletes the unreferenced blobs manifests, then the chunks which are
+    # no longer referenced by any manifest. Returns the scanned, kept,
+    # linked, and deleted blobs counts and the freed bytes, chunks
+    # included.
+    def delete_unreferenced_blobs(self, sha256s, batch_size=1000):
+        statistics = ts_ds.Datastore.delete_unreferenced_blobs(
+            self, sha256s, batch_size)
+        statistics['bytes_freed'] += self.delete_unreferenced_chunks()
+        return statistics
+
+    # Deletes the chunks which are not referenced by any manifest, the
+    # temporary ones included, unless modified less than 60 seconds ago.
+    # Returns the freed bytes.
+    def delete_unreferenced_chunks(self):
+        now = int(time.time())
+        # Lists the referenced chunks.
+        sha256s = set()
+        for dir_path, dir_names, file_names in os.walk(self.manifests_dir):
+            for file_name in file_names:
+                try:
+                    with open(os.path.join(dir_path, file_name)) as f:
+                        sha256s.update(
+                            sha256 for sha256, size in
+                            parse_manifest(f.read()))
+                except FileNotFoundError:
+                    pass
+        sha256s.update(self.retrieve_writing_chunk_sha256s())
+        # Deletes the other chunks.
+        freed_bytes = 0
+        for dir_path, dir_names, file_names in os.walk(self.chunks_dir):
+            for file_name in file_names:
+                # The temporary chunks are named after their hash too.
+                sha256 = file_name
+                if file_name.startswith('temp-'):
+                    sha256 = file_name[len('temp-'):].partition('-')[0]
+                if sha256 in sha256s:
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(file_path)
+                    # The chunk may have just been stored again.
+                    if stat.st_mtime > now - 60:
+                        continue
+                    os.unlink(file_path)
+                    freed_bytes += stat.st_size
+                except FileNotFoundError:
+                    pass
+        return freed_bytes
+
+    # Scans the blobs manifests in the order of their names.
+    def scan(self, checkpoint='', dir_path=None, prefix=''):
+        if dir_path is None:
+            dir_path = self.manifests_dir
+        return ts_ds.Datastore.scan(self, checkpoint, dir_path, prefix)
+
+    # Scans the chunks, which are verified by the scrubbing instead of the
+    # blobs, in the order of their names, after a checkpoint.
+    def scan_scrub(self, checkpoint):
+        return ts_ds.Datastore.scan(self, checkpoint, self.chunks_dir)
+
+    # Returns whether a blob exists from its SHA-256 hash, with all its
+    # chunks.
+    def has_blob(self, sha256):
+        try:
+            stream, codec = ts_ds.Datastore.open_blob(self, sha256)
+        except ts_ds.DatastoreException:
+            return False
+        with stream:
+            chunks = parse_manifest(stream.read().decode())
+        return all(
+            os.path.isfile(self.chunk_path(chunk_sha256)) or
+            os.path.isfile(self.chunk_path(chunk_sha256, 0))
+            for chunk_sha256, size in chunks)
+
+    # Moves the manifests and the chunks stored with another fan-out
+    # depth to their expected location. Returns the number of blobs and
+    # chunks moved.
+    def migrate(self):
+        return \
+            self.migrate_dir(self.manifests_dir, self.blob_path) + \
+            self.migrate_dir(self.chunks_dir, self.chunk_path)
+
+# Parses a manifest. Returns the (SHA-256 hash, size) of its chunks.
+# Ignores the incomplete last line of a manifest being written.
+def parse_manifest(manifest):
+    chunks = []
+    for line in manifest.split('\n'):
+        sha256, _, size = line.partition(' ')
+        if ts_ds.is_sha256(sha256) and size.isdigit():
+            chunks.append((sha256, int(size)))
+    return chunks
@@ -1,14 +1,26 @@
+import tempstore.metrics as ts_m
+
 import contextlib
 import functools
 import os
 import re
 import shutil
 import sqlite3
+import threading
 import time
 
 class DatabaseException(Exception):
     pass
 
+# Busy timeout in milliseconds of the statements, i.e.: the longest they
+# wait for a lock held by another connection.
+BUSY_TIMEOUT = 10000
+
+# Busy timeout in milliseconds of each attempt to start a write
+# transaction. The attempts are retried up to the busy timeout, so that
+# the waits for the write lock are counted.
+BUSY_RETRY_TIMEOUT = 100
+
 # Checks that a value represents a valid project, version, or file name.
 def validate_name(name):
     if name in ('.', '..'):
@@ -23,41 +35,458 @@ def validate_sha256(sha256):
     if not sha256_regex.search(sha256):
         raise DatabaseException('Invalid SHA-256 hash')
 
+# Checks that the manifests of chunked blobs (SHA-256 hash, SHA-256
+# hashes of the chunks) are valid, if any.
+def validate_manifests(manifests):
+    for sha256, chunk_sha256s in manifests or []:
+        validate_sha256(sha256)
+        for chunk_sha256 in chunk_sha256s:
+            validate_sha256(chunk_sha256)
+
+# Checks that a value represents a valid page size.
+def validate_limit(limit):
+    if limit is not None and (type(limit) is not int or limit < 0):
+        raise DatabaseException('Invalid limit')
+
+# Parses a versions cursor (i.e.: '<timestamp>:<name>').
+# Returns the timestamp and the name.
+def parse_version_cursor(cursor):
+    timestamp, separator, name = cursor.partition(':')
+    if not separator or not timestamp.isdigit():
+        raise DatabaseException('Invalid cursor')
+    validate_name(name)
+    return int(timestamp), name
+
+# Checks that a value is a valid search query: a part of a name, at least
+# as long as the trigrams of the search indexes.
+def validate_search_query(query):
+    query_regex = re.compile('^[0-9a-zA-Z_.-]{3,}$')
+    if not query_regex.search(query):
+        raise DatabaseException('Invalid search query')
+
+# Parses a search cursor (i.e.: the row ID of the last result).
+def parse_search_cursor(cursor):
+    if not cursor.isdigit():
+        raise DatabaseException('Invalid cursor')
+    return int(cursor)
+
 # Checks that a value represents a valid star state.
 def validate_star(star):
     if star is not True and star is not False:
         raise DatabaseException('Invalid star state')
 
+# Schema migrations, each a list of SQL statements. The migrations are
+# applied in order and never modified once released. The first ones use
+# IF NOT EXISTS because they may run on the databases created before the
+# schema was versioned.
+MIGRATIONS = [
+    # Projects, versions, and files.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS projects(
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            CONSTRAINT unique_project UNIQUE (name)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS versions(
+            id INTEGER PRIMARY KEY,
+            project_id INTEGER,
+            name TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            star BOOLEAN DEFAULT 0,
+            FOREIGN KEY(project_id) REFERENCES projects(id),
+            CONSTRAINT unique_version UNIQUE (project_id, name)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS files(
+            id INTEGER PRIMARY KEY,
+            version_id INTEGER,
+            name TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            FOREIGN KEY(version_id) REFERENCES versions(id)
+                ON DELETE CASCADE,
+            CONSTRAINT unique_file UNIQUE (version_id, name)
+        )
+        '''],
+    # Counts the files referencing each blob. The blobs with no
+    # reference left are queued for deletion from the datastore.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS blobs(
+            sha256 TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS unreferenced_blobs
+        ON blobs(sha256) WHERE refs=0
+        ''',
+        # Maintains the reference counts, including when the files are
+        # deleted by cascade with their version.
+        '''
+        CREATE TRIGGER reference_blob
+        AFTER INSERT ON files
+        BEGIN
+            INSERT INTO blobs(sha256, refs) VALUES(NEW.sha256, 1)
+            ON CONFLICT(sha256) DO UPDATE SET refs=refs+1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER unreference_blob
+        AFTER DELETE ON files
+        BEGIN
+            UPDATE blobs SET refs=refs-1 WHERE sha256=OLD.sha256;
+        END
+        ''',
+        # Counts the references of the existing files.
+        '''
+        INSERT OR IGNORE INTO blobs(sha256, refs)
+        SELECT sha256, COUNT(*) FROM files GROUP BY sha256
+        '''],
+    # Indexes for the access paths which scanned whole tables.
+    [
+        # Obsolete versions (delete_obsolete_versions).
+        '''
+        CREATE INDEX obsolete_versions ON versions(star, timestamp)
+        ''',
+        # Versions of a project in reverse chronological order
+        # (retrieve_versions), covering the selected columns.
+        '''
+        CREATE INDEX chronological_versions
+        ON versions(project_id, timestamp, name, star)
+        ''',
+        # Distinct blobs hashes (retrieve_sha256s).
+        '''
+        CREATE INDEX files_sha256s ON files(sha256)
+        '''],
+    # Counts the manifests of the chunked blobs referencing each chunk,
+    # so that the chunks with no reference left are deleted without
+    # reading all the manifests. The manifests whose chunks are counted
+    # are recorded, so that each is counted once.
+    [
+        '''
+        CREATE TABLE chunks(
+            sha256 TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX unreferenced_chunks ON chunks(sha256) WHERE refs=0
+        ''',
+        '''
+        CREATE TABLE manifests(
+            sha256 TEXT PRIMARY KEY
+        )
+        '''],
+    # Records when the unreferenced blobs which the cleanups keep because
+    # they share the data of imported files are checked again, so that
+    # the cleanups do not check them each time.
+    [
+        '''
+        ALTER TABLE blobs ADD COLUMN recheck INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+        DROP INDEX unreferenced_blobs
+        ''',
+        '''
+        CREATE INDEX unreferenced_blobs ON blobs(recheck) WHERE refs=0
+        '''],
+]
+
+# Indexes of the trigrams of the projects, versions, and files names, so
+# that searching a part of a name does not scan the tables. The indexes
+# refer to the rows of the tables, and are maintained by triggers,
+# including when the files are deleted by cascade with their version.
+# They are created after the migrations, once, if SQLite supports them.
+SEARCH_INDEXES = [
+    '''
+    CREATE VIRTUAL TABLE projects_search USING fts5(
+        name, content='projects', content_rowid='id',
+        tokenize='trigram')
+    ''',
+    '''
+    CREATE VIRTUAL TABLE versions_search USING fts5(
+        name, content='versions', content_rowid='id',
+        tokenize='trigram')
+    ''',
+    '''
+    CREATE VIRTUAL TABLE files_search USING fts5(
+        name, content='files', content_rowid='id',
+        tokenize='trigram')
+    ''',
+    '''
+    CREATE TRIGGER projects_insert_search
+    AFTER INSERT ON projects
+    BEGIN
+        INSERT INTO projects_search(rowid, name)
+        VALUES(NEW.id, NEW.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER projects_delete_search
+    AFTER DELETE ON projects
+    BEGIN
+        INSERT INTO projects_search(projects_search, rowid, name)
+        VALUES('delete', OLD.id, OLD.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER versions_insert_search
+    AFTER INSERT ON versions
+    BEGIN
+        INSERT INTO versions_search(rowid, name)
+        VALUES(NEW.id, NEW.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER versions_delete_search
+    AFTER DELETE ON versions
+    BEGIN
+        INSERT INTO versions_search(versions_search, rowid, name)
+        VALUES('delete', OLD.id, OLD.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER files_insert_search
+    AFTER INSERT ON files
+    BEGIN
+        INSERT INTO files_search(rowid, name)
+        VALUES(NEW.id, NEW.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER files_delete_search
+    AFTER DELETE ON files
+    BEGIN
+        INSERT INTO files_search(files_search, rowid, name)
+        VALUES('delete', OLD.id, OLD.name);
+    END
+    ''',
+    # Indexes the existing names.
+    '''
+    INSERT INTO projects_search(projects_search) VALUES('rebuild')
+    ''',
+    '''
+    INSERT INTO versions_search(versions_search) VALUES('rebuild')
+    ''',
+    '''
+    INSERT INTO files_search(files_search) VALUES('rebuild')
+    ''']
+
+# Returns whether SQLite supports the search indexes: FTS5 with the
+# trigram tokenizer, from SQLite 3.34.
+def probe_search_indexes():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE probe USING fts5(name, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+SEARCH_INDEXES_SUPPORTED = probe_search_indexes()
+
+# Searches of the names containing a query, by kind of result. Each
+# selects the results among a page of the matching row IDs, in reverse
+# order of creation, before a row ID.
+SEARCH_QUERIES = {
+    'projects': '''
+        SELECT projects.id, projects.name FROM projects
+        WHERE projects.id IN (
+            SELECT rowid FROM projects_search
+            WHERE projects_search MATCH ? AND rowid<?
+            ORDER BY rowid DESC LIMIT ?)
+        ORDER BY projects.id DESC
+        ''',
+    'versions': '''
+        SELECT versions.id, projects.name, versions.name FROM versions
+        INNER JOIN projects ON projects.id=versions.project_id
+        WHERE versions.id IN (
+            SELECT rowid FROM versions_search
+            WHERE versions_search MATCH ? AND rowid<?
+            ORDER BY rowid DESC LIMIT ?)
+        ORDER BY versions.id DESC
+        ''',
+    'files': '''
+        SELECT files.id, projects.name, versions.name, files.name,
+            files.sha256
+        FROM files
+        INNER JOIN versions ON versions.id=files.version_id
+        INNER JOIN projects ON projects.id=versions.project_id
+        WHERE files.id IN (
+            SELECT rowid FROM files_search
+            WHERE files_search MATCH ? AND rowid<?
+            ORDER BY rowid DESC LIMIT ?)
+        ORDER BY files.id DESC
+        '''}
+
+# Searches of the names containing a query by scanning the tables, if
+# SQLite does not support the search indexes. The query is a LIKE pattern.
+SEARCH_SCAN_QUERIES = {
+    'projects': '''
+        SELECT projects.id, projects.name FROM projects
+        WHERE projects.name LIKE ? ESCAPE '\\' AND projects.id<?
+        ORDER BY projects.id DESC LIMIT ?
+        ''',
+    'versions': '''
+        SELECT versions.id, projects.name, versions.name FROM versions
+        INNER JOIN projects ON projects.id=versions.project_id
+        WHERE versions.name LIKE ? ESCAPE '\\' AND versions.id<?
+        ORDER BY versions.id DESC LIMIT ?
+        ''',
+    'files': '''
+        SELECT files.id, projects.name, versions.name, files.name,
+            files.sha256
+        FROM files
+        INNER JOIN versions ON versions.id=files.version_id
+        INNER JOIN projects ON projects.id=versions.project_id
+        WHERE files.name LIKE ? ESCAPE '\\' AND files.id<?
+        ORDER BY files.id DESC LIMIT ?
+        '''}
+
+# Names of the columns of the search results, after the row ID.
+SEARCH_COLUMNS = {
+    'projects': ['project'],
+    'versions': ['project', 'version'],
+    'files': ['project', 'version', 'file', 'sha256']}
+
+# SQLite synchronous settings. FULL flushes the write-ahead log at each
+# commit. NORMAL only flushes it at the checkpoints, the last commits may
+# be lost on a power failure, but never corrupted. OFF never flushes.
+SYNCHRONOUS_SETTINGS = ('FULL', 'NORMAL', 'OFF')
+
+# Opens a new connection to a database file and configures it.
+def connect(database_file, synchronous='FULL'):
+    connection = sqlite3.connect(
+        database_file, isolation_level=None, check_same_thread=False)
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=' + synchronous)
+    cursor.execute('PRAGMA busy_timeout=%d' % BUSY_TIMEOUT)
+    cursor.close()
+    return connection
+
+# Thread-safe pool of long-lived connections to a database file.
+# The connections are configured once and then reused. The pool is
+# fork-safe: a process never reuses the connections of its parent.
+class ConnectionPool:
+
+    def __init__(self, database_file, size, synchronous='FULL'):
+        self.database_file = database_file
+        self.size = size
+        self.synchronous = synchronous
+        self.lock = threading.Lock()
+        self.connections = []
+        self.pid = os.getpid()
+        # Connections inherited from a parent process. They are kept
+        # referenced and never closed, closing a SQLite connection
+        # across a fork may corrupt the parent locks.
+        self.inherited_connections = []
+
+    # Forgets the connections opened by a parent process.
+    def check_fork(self):
+        if self.pid != os.getpid():
+            self.inherited_connections.extend(self.connections)
+            self.connections = []
+            self.pid = os.getpid()
+
+    # Checks out a connection, opens a new one if none is idle.
+    def acquire(self):
+        with self.lock:
+            self.check_fork()
+            if self.connections:
+                return self.connections.pop()
+        return connect(self.database_file, self.synchronous)
+
+    # Checks in a connection. Closes it if the pool is full.
+    def release(self, connection):
+        # Rolls back any transaction left open by a failed method.
+        if connection.in_transaction:
+            connection.rollback()
+        with self.lock:
+            self.check_fork()
+            if len(self.connections) < self.size:
+                self.connections.append(connection)
+                return
+        connection.close()
+
+    # Closes all the idle connections.
+    def clear(self):
+        with self.lock:
+            self.check_fork()
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            connection.close()
+
 # SQLite-backed database to handle projects, versions, and files.
+# Connections are opened and closed for each method call unless a
+# pool size is specified, then they are reused across method calls.
+# The connections use the specified synchronous setting.
 class Database:
 
-    def __init__(self, database_dir):
+    def __init__(self, database_dir, pool_size=0, synchronous='FULL'):
         self.database_dir = database_dir
         self.database_file = os.path.join(
             self.database_dir, 'packages.db')
+        self.generation_file = os.path.join(
+            self.database_dir, 'generation')
+        if synchronous not in SYNCHRONOUS_SETTINGS:
+            raise DatabaseException('Invalid synchronous setting')
+        self.synchronous = synchronous
+        # Each thread works on its own connection and cursor.
+        self.local = threading.local()
+        self.pool = None
+        if pool_size > 0:
+            self.pool = ConnectionPool(
+                self.database_file, pool_size, synchronous)
+
+    # Connection used by the current thread.
+    @property
+    def connection(self):
+        return self.local.connection
+
+    # Cursor used by the current thread.
+    @property
+    def cursor(self):
+        return self.local.cursor
 
     # Creates or resets the database.
     def create(self):
         self.delete()
         os.mkdir(self.database_dir)
-        self.create_schema()
+        self.migrate()
 
     # Deletes the database.
     def delete(self):
+        if self.pool is not None:
+            self.pool.clear()
         shutil.rmtree(self.database_dir, ignore_errors=True)
 
     # Initializes the database connection.
     def open(self):
-        self.connection = sqlite3.connect(
-            self.database_file, isolation_level=None)
-        self.cursor = self.connection.cursor()
-        self.cursor.execute('PRAGMA foreign_keys=ON')
-        self.cursor.execute('PRAGMA journal_mode=WAL')
-        self.cursor.execute('PRAGMA busy_timeout=10000')
+        if self.pool is not None:
+            self.local.connection = self.pool.acquire()
+        else:
+            self.local.connection = connect(
+                self.database_file, self.synchronous)
+        self.local.cursor = self.local.connection.cursor()
 
     # Closes the database connection.
     def close(self):
-        self.connection.close()
+        self.local.cursor.close()
+        if self.pool is not None:
+            self.pool.release(self.local.connection)
+        else:
+            self.local.connection.close()
+        self.local.connection = None
+        self.local.cursor = None
 
     # Decorator for the methods working on an open database. Opens the
     # database before use and closes it afterwards, even if the method
@@ -66,62 +495,120 @@ class Database:
         @contextlib.contextmanager
         def context_manager(database):
             database.open()
-            yield database
-            database.close()
+            try:
+                yield database
+            finally:
+                database.close()
         @functools.wraps(method)
         def wrapper(self, *args, **kwargs):
-            with context_manager(self) as database:
-                return method(database, *args, **kwargs)
+            with ts_m.DATABASE_SECONDS.time(method.__name__):
+                self.local.method_name = method.__name__
+                with context_manager(self) as database:
+                    return method(database, *args, **kwargs)
         return wrapper
 
-    # Creates the database schema.
+    # Starts a write transaction, waiting for the write lock up to the
+    # busy timeout. Each attempt which finds the database busy is counted.
+    # Only called by the methods working on an open database.
+    def begin_immediate(self):
+        self.cursor.execute('PRAGMA busy_timeout=%d' % BUSY_RETRY_TIMEOUT)
+        try:
+            attempts = BUSY_TIMEOUT // BUSY_RETRY_TIMEOUT
+            for attempt in range(attempts):
+                try:
+                    self.cursor.execute('BEGIN IMMEDIATE')
+                    return
+                except sqlite3.OperationalError as e:
+                    if e.sqlite_errorcode & 0xff != sqlite3.SQLITE_BUSY:
+                        raise
+                    ts_m.DATABASE_BUSY.inc(self.local.method_name)
+                    if attempt == attempts - 1:
+                        raise
+        finally:
+            self.cursor.execute('PRAGMA busy_timeout=%d' % BUSY_TIMEOUT)
+
+    # Creates or upgrades the database schema. Applies the migrations
+    # missing from the database, each in its own transaction. The schema
+    # version is tracked with the SQLite user version.
     @database_context_manager
-    def create_schema(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS projects(
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                CONSTRAINT unique_project UNIQUE (name)
-            )''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS versions(
-                id INTEGER PRIMARY KEY,
-                project_id INTEGER,
-                name TEXT NOT NULL,
-                timestamp INTEGER NOT NULL,
-                star BOOLEAN DEFAULT 0,
-                FOREIGN KEY(project_id) REFERENCES projects(id),
-                CONSTRAINT unique_version UNIQUE (project_id, name)
-            )
-            ''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS files(
-                id INTEGER PRIMARY KEY,
-                version_id INTEGER,
-                name TEXT NOT NULL,
-                sha256 TEXT NOT NULL,
-                FOREIGN KEY(version_id) REFERENCES versions(id)
-                    ON DELETE CASCADE,
-                CONSTRAINT unique_file UNIQUE (version_id, name)
-            )
-            ''')
+    def migrate(self):
+        for version, migration in enumerate(MIGRATIONS, 1):
+            self.begin_immediate()
+            current_version = list(
+                self.cursor.execute('PRAGMA user_version'))[0][0]
+            if current_version >= version:
+                self.cursor.execute('ROLLBACK')
+                continue
+            for sql in migration:
+                self.cursor.execute(sql)
+            self.cursor.execute('PRAGMA user_version=%d' % version)
+            self.cursor.execute('COMMIT')
+        # Creates the search indexes if supported and missing.
+        if not SEARCH_INDEXES_SUPPORTED:
+            return
+        self.begin_immediate()
+        if not self.has_search_indexes():
+            for sql in SEARCH_INDEXES:
+                self.cursor.execute(sql)
+        self.cursor.execute('COMMIT')
+
+    # Returns whether the database has the search indexes.
+    # Only called by the methods working on an open database.
+    def has_search_indexes(self):
+        sql = '''
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name='files_search'
+            '''
+        return len(list(self.cursor.execute(sql))) > 0
 
     # Creates a new file.
     # Automatically creates the project and version if required.
     # The age in seconds should only be specified when testing.
+    # The manifests of the chunked blobs are counted in the same
+    # transaction, if specified.
     @database_context_manager
     def create_file(
             self, project_name, version_name, file_name,
-            sha256, age=0):
+            sha256, age=0, manifests=None):
+        self.insert_files(
+            project_name, version_name, [(file_name, sha256)], age,
+            manifests=manifests)
+
+    # Creates new files (name, sha256) in a version, all or none of
+    # them, in a single transaction.
+    # Automatically creates the project and version if required.
+    # The age in seconds should only be specified when testing. A created
+    # version takes the timestamp if specified, e.g.: when imported. The
+    # manifests of the chunked blobs are counted in the same transaction,
+    # if specified.
+    @database_context_manager
+    def create_files(
+            self, project_name, version_name, files, age=0,
+            timestamp=None, manifests=None):
+        self.insert_files(
+            project_name, version_name, files, age, timestamp, manifests)
+
+    # Inserts files in a single transaction.
+    # Only called by the methods working on an open database.
+    def insert_files(
+            self, project_name, version_name, files, age, timestamp=None,
+            manifests=None):
         # Validates the parameters.
         validate_name(project_name)
         validate_name(version_name)
-        validate_name(file_name)
-        validate_sha256(sha256)
+        if not files:
+            raise DatabaseException('No file')
+        for file_name, sha256 in files:
+            validate_name(file_name)
+            validate_sha256(sha256)
+        validate_manifests(manifests)
         # Initializes the timestamp.
-        timestamp = int(time.time()) - age
-        # Starts a transaction.
-        self.cursor.execute('BEGIN')
+        if timestamp is None:
+            timestamp = int(time.time()) - age
+        # Starts a write transaction. The search indexes triggers read
+        # before writing, which fails without waiting for the lock if
+        # another transaction wrote meanwhile.
+        self.begin_immediate()
         # Creates the project if it does not exist.
         sql = 'INSERT OR IGNORE INTO projects(name) VALUES(?)'
         params = [project_name]
@@ -149,18 +636,55 @@ class Database:
         rows = list(self.cursor.execute(sql, params))
         assert len(rows) == 1
         version_id = rows[0][0]
-        # Creates the file.
+        # Creates the files.
         sql = '''
             INSERT INTO files(version_id, name, sha256)
             VALUES(?, ?, ?)
             '''
-        params = [version_id, file_name, sha256]
+        params = [
+            [version_id, file_name, sha256]
+            for file_name, sha256 in files]
         try:
-            self.cursor.execute(sql, params)
-            self.cursor.execute('COMMIT')
+            self.cursor.executemany(sql, params)
         except sqlite3.IntegrityError:
             self.cursor.execute('ROLLBACK')
             raise DatabaseException('Unable to create file')
+        # Counts the chunks references of the manifests.
+        self.insert_manifests(manifests)
+        self.cursor.execute('COMMIT')
+        self.increment_generation()
+
+    # Increments the generation, once per committed transaction changing
+    # the projects, versions, or files, by appending a byte to the
+    # generation file. Only called by the methods working on an open
+    # database, after the commit.
+    def increment_generation(self):
+        fd = os.open(
+            self.generation_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644)
+        try:
+            os.write(fd, b'\n')
+        finally:
+            os.close(fd)
+
+    # Counts the chunks references of the manifests of chunked blobs
+    # (SHA-256 hash, SHA-256 hashes of the chunks), unless already
+    # counted. Only called by the methods working on an open database,
+    # in a transaction.
+    def insert_manifests(self, manifests):
+        for sha256, chunk_sha256s in manifests or []:
+            sql = 'INSERT OR IGNORE INTO manifests(sha256) VALUES(?)'
+            params = [sha256]
+            self.cursor.execute(sql, params)
+            if self.cursor.rowcount != 1:
+                continue
+            sql = '''
+                INSERT INTO chunks(sha256, refs) VALUES(?, 1)
+                ON CONFLICT(sha256) DO UPDATE SET refs=refs+1
+                '''
+            params = [
+                [chunk_sha256] for chunk_sha256 in sorted(set(chunk_sha256s))]
+            self.cursor.executemany(sql, params)
 
     # Retrieves the SHA-256 hash of a file.
     @database_context_manager
@@ -183,22 +707,41 @@ class Database:
         sha256 = rows[0][0]
         return sha256
 
-    # Retrieves all the projects.
-    # The results are in alphabetical order.
+    # Retrieves the projects.
+    # The results are in alphabetical order. They are paginated by
+    # keyset: only the projects after the cursor (a project name) are
+    # retrieved, up to the limit if specified.
     @database_context_manager
-    def retrieve_projects(self):
-        sql = 'SELECT name FROM projects ORDER BY name ASC'
-        rows = list(self.cursor.execute(sql))
+    def retrieve_projects(self, cursor=None, limit=None):
+        # Validates the parameters.
+        if cursor is not None:
+            validate_name(cursor)
+        validate_limit(limit)
+        # Retrieves the projects.
+        sql = '''
+            SELECT name FROM projects
+            WHERE name>? ORDER BY name ASC LIMIT ?
+            '''
+        params = [
+            cursor if cursor is not None else '',
+            limit if limit is not None else -1]
+        rows = list(self.cursor.execute(sql, params))
         projects = [{
             'name': row[0]} for row in rows]
         return projects
 
-    # Retrieves all the versions (name, date, star) for a project.
-    # The results are sorted in reverse chronological order.
+    # Retrieves the versions (name, date, star, cursor) for a project.
+    # The results are sorted in reverse chronological order, then in
+    # reverse alphabetical order. They are paginated by keyset: only the
+    # versions after the cursor of a version are retrieved, up to the
+    # limit if specified.
     @database_context_manager
-    def retrieve_versions(self, project_name):
-        # Validates the parameter.
+    def retrieve_versions(self, project_name, cursor=None, limit=None):
+        # Validates the parameters.
         validate_name(project_name)
+        if cursor is not None:
+            timestamp, name = parse_version_cursor(cursor)
+        validate_limit(limit)
         # Starts a transaction.
         self.cursor.execute('BEGIN')
         # Retrieves the project.
@@ -212,25 +755,39 @@ class Database:
         # Retrieves the versions.
         sql = '''
             SELECT name, timestamp, star FROM versions
-            WHERE project_id=? ORDER BY timestamp DESC
+            WHERE project_id=? AND (timestamp, name)<(?, ?)
+            ORDER BY timestamp DESC, name DESC LIMIT ?
             '''
         params = [project_id]
+        if cursor is not None:
+            params += [timestamp, name]
+        else:
+            # Sorts after any version.
+            params += [float('inf'), '']
+        params.append(limit if limit is not None else -1)
         rows = list(self.cursor.execute(sql, params))
         versions = [{
             'name': row[0],
             'timestamp': row[1],
-            'star': row[2]} for row in rows]
+            'star': row[2],
+            'cursor': '%d:%s' % (row[1], row[0])} for row in rows]
         # Commits the transaction.
         self.cursor.execute('COMMIT')
         return versions
 
-    # Retrieves all the files (name, sha256) for a version.
-    # The results are sorted in alphabetical order.
+    # Retrieves the files (name, sha256) for a version.
+    # The results are sorted in alphabetical order. They are paginated
+    # by keyset: only the files after the cursor (a file name) are
+    # retrieved, up to the limit if specified.
     @database_context_manager
-    def retrieve_files(self, project_name, version_name):
+    def retrieve_files(
+            self, project_name, version_name, cursor=None, limit=None):
         # Validates the parameters.
         validate_name(project_name)
         validate_name(version_name)
+        if cursor is not None:
+            validate_name(cursor)
+        validate_limit(limit)
         # Starts a transaction.
         self.cursor.execute('BEGIN')
         # Retrieves the version.
@@ -248,9 +805,13 @@ class Database:
         # Retrieves the files.
         sql = '''
             SELECT name, sha256 FROM files
-            WHERE version_id=? ORDER BY name ASC
+            WHERE version_id=? AND name>?
+            ORDER BY name ASC LIMIT ?
             '''
-        params = [version_id]
+        params = [
+            version_id,
+            cursor if cursor is not None else '',
+            limit if limit is not None else -1]
         rows = list(self.cursor.execute(sql, params))
         files = [{
             'name': row[0],
@@ -259,12 +820,162 @@ class Database:
         self.cursor.execute('COMMIT')
         return files
 
-    # Retrieves all the known SHA-256 hashes.
+    # Searches the projects, versions, or files whose name contains a
+    # query, case-insensitively. The results are sorted in reverse order
+    # of creation. They are paginated by keyset: only the results after
+    # the cursor of a result are retrieved, up to the limit if specified.
+    @database_context_manager
+    def search(self, kind, query, cursor=None, limit=None):
+        # Validates the parameters.
+        if kind not in SEARCH_QUERIES:
+            raise DatabaseException('Invalid search kind')
+        validate_search_query(query)
+        if cursor is not None:
+            row_id = parse_search_cursor(cursor)
+        validate_limit(limit)
+        # Searches the query as a phrase of trigrams, or as a part of the
+        # names if the database has no search indexes.
+        if self.has_search_indexes():
+            sql = SEARCH_QUERIES[kind]
+            pattern = '"%s"' % query
+        else:
+            sql = SEARCH_SCAN_QUERIES[kind]
+            pattern = '%%%s%%' % query.replace('_', '\\_')
+        params = [
+            pattern,
+            row_id if cursor is not None else 2**63 - 1,
+            limit if limit is not None else -1]
+        rows = list(self.cursor.execute(sql, params))
+        results = []
+        for row in rows:
+            result = dict(zip(SEARCH_COLUMNS[kind], row[1:]))
+            result['cursor'] = str(row[0])
+            results.append(result)
+        return results
+
+    # Retrieves all the known SHA-256 hashes as a set.
+    # The rows are streamed into the set to bound the memory usage.
     @database_context_manager
     def retrieve_sha256s(self):
         sql = 'SELECT DISTINCT sha256 FROM files'
-        rows = list(self.cursor.execute(sql))
-        return [row[0] for row in rows]
+        return set(row[0] for row in self.cursor.execute(sql))
+
+    # Retrieves the generation, incremented by every change of the
+    # projects, versions, and files. It is the size of the generation
+    # file, so that the processes caching them check it without querying
+    # the database.
+    def retrieve_generation(self):
+        try:
+            return os.stat(self.generation_file).st_size
+        except FileNotFoundError:
+            return 0
+
+    # Retrieves the SHA-256 hashes of the blobs no longer referenced,
+    # except the ones deferred to a later check.
+    @database_context_manager
+    def retrieve_unreferenced_sha256s(self):
+        sql = 'SELECT sha256 FROM blobs WHERE refs=0 AND recheck<=?'
+        params = [int(time.time())]
+        return [row[0] for row in self.cursor.execute(sql, params)]
+
+    # Defers the next check of unreferenced blobs to their timestamps.
+    # The blobs which were referenced again in the meantime are left
+    # unchanged.
+    @database_context_manager
+    def defer_blobs(self, rechecks):
+        # Validates the parameter.
+        for sha256, timestamp in rechecks:
+            validate_sha256(sha256)
+        # Records the time of the next checks.
+        sql = 'UPDATE blobs SET recheck=? WHERE sha256=? AND refs=0'
+        params = [[timestamp, sha256] for sha256, timestamp in rechecks]
+        self.begin_immediate()
+        self.cursor.executemany(sql, params)
+        self.cursor.execute('COMMIT')
+
+    # Registers a blob which is not referenced yet, so that it is
+    # deleted from the datastore unless it gets referenced. The manifests
+    # of the chunked blobs are counted in the same transaction, if
+    # specified.
+    @database_context_manager
+    def create_blob(self, sha256, manifests=None):
+        self.insert_blobs([sha256], manifests)
+
+    # Registers blobs which are not referenced yet.
+    @database_context_manager
+    def create_blobs(self, sha256s, manifests=None):
+        self.insert_blobs(sha256s, manifests)
+
+    # Inserts blobs in a single transaction.
+    # Only called by the methods working on an open database.
+    def insert_blobs(self, sha256s, manifests):
+        # Validates the parameters.
+        for sha256 in sha256s:
+            validate_sha256(sha256)
+        validate_manifests(manifests)
+        # Creates the blobs which do not exist.
+        sql = 'INSERT OR IGNORE INTO blobs(sha256, refs) VALUES(?, 0)'
+        params = [[sha256] for sha256 in sha256s]
+        self.begin_immediate()
+        self.cursor.executemany(sql, params)
+        self.insert_manifests(manifests)
+        self.cursor.execute('COMMIT')
+
+    # Counts the chunks references of the manifests of chunked blobs
+    # already stored.
+    @database_context_manager
+    def create_manifests(self, manifests):
+        # Validates the parameter.
+        validate_manifests(manifests)
+        # Counts the chunks references.
+        self.begin_immediate()
+        self.insert_manifests(manifests)
+        self.cursor.execute('COMMIT')
+
+    # Forgets the blobs deleted from the datastore.
+    # Keeps the blobs which were referenced again in the meantime.
+    # Unreferences the chunks of the forgotten blobs if their manifests
+    # are specified.
+    @database_context_manager
+    def delete_blobs(self, sha256s, manifests=None):
+        self.begin_immediate()
+        deleted_sha256s = set()
+        for sha256 in sha256s:
+            sql = 'DELETE FROM blobs WHERE sha256=? AND refs=0'
+            params = [sha256]
+            self.cursor.execute(sql, params)
+            if self.cursor.rowcount == 1:
+                deleted_sha256s.add(sha256)
+        for sha256, chunk_sha256s in manifests or []:
+            if sha256 not in deleted_sha256s:
+                continue
+            # Only unreferences the chunks of a counted manifest.
+            sql = 'DELETE FROM manifests WHERE sha256=?'
+            params = [sha256]
+            self.cursor.execute(sql, params)
+            if self.cursor.rowcount != 1:
+                continue
+            sql = 'UPDATE chunks SET refs=refs-1 WHERE sha256=?'
+            params = [
+                [chunk_sha256] for chunk_sha256 in sorted(set(chunk_sha256s))]
+            self.cursor.executemany(sql, params)
+        self.cursor.execute('COMMIT')
+
+    # Retrieves the SHA-256 hashes of the chunks no longer referenced.
+    @database_context_manager
+    def retrieve_unreferenced_chunk_sha256s(self):
+        sql = 'SELECT sha256 FROM chunks WHERE refs=0'
+        return [row[0] for row in self.cursor.execute(sql)]
+
+    # Forgets the chunks deleted from the datastore.
+    # Keeps the chunks which were referenced again in the meantime.
+    @database_context_manager
+    def delete_chunks(self, sha256s):
+        sql = 'DELETE FROM chunks WHERE sha256=? AND refs=0'
+        params = [[sha256] for sha256 in sha256s]
+        self.begin_immediate()
+        self.cursor.executemany(sql, params)
+        self.cursor.execute('COMMIT')
 
     # Star/unstar a version.
     @database_context_manager
@@ -274,7 +985,7 @@ class Database:
         validate_name(version_name)
         validate_star(star)
         # Starts a transaction.
-        self.cursor.execute('BEGIN IMMEDIATE')
+        self.begin_immediate()
         # Retrieves the version.
         sql = '''
             SELECT versions.id FROM versions
@@ -293,6 +1004,7 @@ class Database:
         self.cursor.execute(sql, params)
         # Commits the transaction.
         self.cursor.execute('COMMIT')
+        self.increment_generation()
 
     # Deletes the obsolete versions (i.e.: with no star
     # and older than the specified age in seconds).
@@ -300,6 +1012,8 @@ class Database:
     def delete_obsolete_versions(self, age=0):
         # Initializes the timestamp.
         timestamp = int(time.time()) - age
+        # Starts a transaction.
+        self.begin_immediate()
         # Deletes the versions.
         sql = '''
             DELETE FROM versions
@@ -307,3 +1021,8 @@ class Database:
             '''
         params = [False, timestamp]
         self.cursor.execute(sql, params)
+        deleted = self.cursor.rowcount
+        # Commits the transaction.
+        self.cursor.execute('COMMIT')
+        if deleted > 0:
+            self.increment_generation()
@@ -1,23 +1,169 @@
+import tempstore.cache as ts_c
+import tempstore.metrics as ts_m
+
 import binascii
+import concurrent.futures
+import ctypes
+import fcntl
+import gzip
 import hashlib
+import json
+import lzma
 import os
 import os.path
 import re
 import shutil
+import threading
 import time
 import uuid
+import zlib
 
 BUFFER_SIZE = 65536
 
+# Name of the file saving the progress of the garbage collection.
+GC_CHECKPOINT_FILE = 'gc-checkpoint'
+
+# Name of the file saving the progress of the integrity scrubbing.
+SCRUB_CHECKPOINT_FILE = 'scrub-checkpoint'
+
+# Name of the directory receiving the corrupted blobs.
+QUARANTINE_DIR = 'quarantine'
+
+# Name of the directory of the resumable upload sessions.
+UPLOADS_DIR = 'uploads'
+
+# Name of the directory of the temporary files of the blobs being
+# written, which the scans of the blobs skip.
+TEMP_DIR = 'temp'
+
+# Age in seconds after which the cleanups delete the temporary files
+# which no writer holds.
+TEMP_FILE_AGE = 3600
+
+# Number of upload sessions hashes kept in memory between requests.
+UPLOAD_HASHES_SIZE = 100
+
+# Maximum time in seconds a request waits for the completion of an upload
+# session, after which the client polls the completion.
+UPLOAD_COMMIT_TIMEOUT = 10
+
+# Linux ioctl request cloning the data of a file into another file on
+# the same copy-on-write file system.
+FICLONE = 0x40049409
+
+# Durability levels of the writes.
+# Flushes each file, then its directory, to disk before returning.
+DURABILITY_STRICT = 'strict'
+# Same, but the flushes of the concurrent writes are batched.
+DURABILITY_GROUP = 'group'
+# Leaves the flushes to the operating system. The blobs written just
+# before a crash may be lost or corrupted, the scrubbing finds the latter.
+DURABILITY_RELAXED = 'relaxed'
+DURABILITIES = (DURABILITY_STRICT, DURABILITY_GROUP, DURABILITY_RELAXED)
+
+# Size of the beginning of a blob compressed to decide whether the blob
+# compresses. The blob is stored uncompressed unless the sample shrinks
+# to at most the ratio of its size.
+COMPRESSION_SAMPLE_SIZE = 262144
+COMPRESSION_RATIO = 0.9
+
 class DatastoreException(Exception):
     pass
 
+# Raised when another request holds an upload session.
+class UploadSessionBusy(DatastoreException):
+    pass
+
+# Compression codec for the blobs. The compressed blobs file names end
+# with the codec suffix. The content encoding is the HTTP name of the
+# format, if any, to pass the compressed blobs to the clients.
+# The open function wraps a file object to read or write it compressed
+# at a level (None when reading), without closing it. The compress
+# function compresses bytes at a level. The default level of the valid
+# levels favours the upload throughput over the compression ratio.
+class Codec:
+
+    def __init__(
+            self, name, suffix, content_encoding, open, compress, levels,
+            default_level):
+        self.name = name
+        self.suffix = suffix
+        self.content_encoding = content_encoding
+        self.open = open
+        self.compress = compress
+        self.levels = levels
+        self.default_level = default_level
+
+# Available codecs by name.
+CODECS = {}
+
+# Makes a codec available.
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+# The gzip level 6 compresses about 3 times faster than the level 9, and
+# the lzma preset 1 about 7 times faster than the preset 6, for a few
+# percent of ratio.
+register_codec(Codec(
+    'gzip', '.gz', 'gzip',
+    lambda file, mode, level: gzip.GzipFile(
+        fileobj=file, mode=mode, compresslevel=level, mtime=0),
+    lambda data, level: gzip.compress(data, level, mtime=0),
+    range(1, 10), 6))
+register_codec(Codec(
+    'lzma', '.xz', None,
+    lambda file, mode, level: lzma.LZMAFile(file, mode, preset=level),
+    lambda data, level: lzma.compress(data, preset=level),
+    range(0, 10), 1))
+
+# Returns whether a value represents a valid SHA-256 hash.
+def is_sha256(sha256):
+    sha256_regex = re.compile('^[0-9a-f]{64}$')
+    return sha256_regex.search(sha256) is not None
+
 # Checks that a value represents a valid SHA-256 hash.
 def validate_sha256(sha256):
-    sha256_regex = re.compile('^[0-9a-f]{64}$')
-    if not sha256_regex.search(sha256):
+    if not is_sha256(sha256):
         raise DatastoreException('Invalid SHA-256 hash')
 
+# Checks that a value represents a valid upload session ID.
+def validate_session_id(session_id):
+    session_id_regex = re.compile('^[0-9a-f]{32}$')
+    if not session_id_regex.search(session_id):
+        raise DatastoreException('Invalid upload session ID')
+
+# Creates a file sharing the data of another file. Reflinks the file if
+# the file system supports it, hard-links it if allowed and on the same
+# file system, copies it otherwise. Returns the method used: 'reflink',
+# 'link', or 'copy'.
+def clone_file(source_path, file_path, link=True):
+    try:
+        with open(source_path, 'rb') as source, open(file_path, 'xb') as f:
+            fcntl.ioctl(f.fileno(), FICLONE, source.fileno())
+        return 'reflink'
+    except OSError:
+        if os.path.exists(file_path):
+            os.unlink(file_path)
+    if link:
+        try:
+            os.link(source_path, file_path)
+            return 'link'
+        except OSError:
+            pass
+    shutil.copyfile(source_path, file_path)
+    return 'copy'
+
+# Parses the file name of a blob. Returns its SHA-256 hash and its codec,
+# or None and None if the file is not a blob.
+def parse_blob_name(file_name):
+    if is_sha256(file_name):
+        return file_name, None
+    for codec in CODECS.values():
+        sha256 = file_name[:-len(codec.suffix)]
+        if file_name.endswith(codec.suffix) and is_sha256(sha256):
+            return sha256, codec
+    return None, None
+
 # Returns the SHA-256 hash of a stream.
 def sha256_sum(stream):
     sha256 = hashlib.sha256()
@@ -25,11 +171,449 @@ def sha256_sum(stream):
         sha256.update(buffer)
     return binascii.hexlify(sha256.digest()).decode()
 
+# Returns the SHA-256 hash of a file.
+def sha256_file(file_path):
+    with open(file_path, 'rb') as stream:
+        return sha256_sum(stream)
+
+# Reads a compressed blob. Returns the original data.
+class DecompressedBlob:
+
+    def __init__(self, file, codec):
+        self.file = file
+        self.codec = codec
+        self.reader = codec.open(file, 'rb', None)
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def close(self):
+        self.reader.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Limits the rate of the reads shared by several threads.
+class Throttle:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    # Waits until a number of bytes can be read. Never waits without rate.
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + size / self.rate
+        time.sleep(start_time - now)
+
+# Writes a blob to a temporary file while computing its SHA-256 hash,
+# then moves it to its final location once the hash is known. Only
+# reads the data once and never seeks, so it accepts any stream.
+# If the datastore has a codec, the blob is compressed unless its first
+# bytes do not compress. The hash is the hash of the original data.
+class BlobWriter:
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.sha256 = hashlib.sha256()
+        self.temp_file_path = datastore.create_temp_path()
+        self.file = open(self.temp_file_path, 'xb')
+        # Holds the temporary file, so that the cleanups keep it however
+        # long the write lasts.
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        self.size = 0
+        # The sample is kept until the compression is decided.
+        self.codec = datastore.codec
+        self.sample = [] if self.codec is not None else None
+        self.sample_size = 0
+        self.encoder = None
+
+    # Appends data to the blob.
+    def write(self, buffer):
+        self.sha256.update(buffer)
+        self.size += len(buffer)
+        if self.sample is not None:
+            self.sample.append(buffer)
+            self.sample_size += len(buffer)
+            if self.sample_size >= COMPRESSION_SAMPLE_SIZE:
+                self.decide_compression()
+        elif self.encoder is not None:
+            self.encoder.write(buffer)
+        else:
+            self.file.write(buffer)
+
+    # Compresses the blob if its sample compresses, writes the sample.
+    def decide_compression(self):
+        sample = b''.join(self.sample)
+        self.sample = None
+        level = self.datastore.compression_level
+        compressed_size = len(self.codec.compress(sample, level))
+        if compressed_size <= len(sample) * COMPRESSION_RATIO:
+            self.encoder = self.codec.open(self.file, 'wb', level)
+            self.encoder.write(sample)
+        else:
+            self.codec = None
+            self.file.write(sample)
+
+    # Appends the contents of a stream to the blob.
+    def write_stream(self, stream):
+        for buffer in iter(lambda: stream.read(BUFFER_SIZE), b''):
+            self.write(buffer)
+
+    # Completes the blob. Returns its SHA-256 hash.
+    # The age in seconds should only be specified when testing.
+    def commit(self, age=0):
+        sha256 = binascii.hexlify(self.sha256.digest()).decode()
+        timestamp = int(time.time()) - age
+        # Keeps the existing blob if there is one, compressed or not. Only
+        # refreshes its timestamp so that it is not deleted before being
+        # referenced.
+        for file_path, codec in self.datastore.blob_paths(sha256):
+            try:
+                self.datastore.touch_blob(file_path, timestamp)
+                self.abort()
+                self.datastore.count_dedup_hit(self.size)
+                return sha256
+            except FileNotFoundError:
+                pass
+        # Completes the compression.
+        if self.sample is not None:
+            self.decide_compression()
+        if self.encoder is not None:
+            self.encoder.close()
+        file_path = self.datastore.blob_path(sha256)
+        if self.codec is not None:
+            file_path += self.codec.suffix
+        # Flushes the temporary file to disk.
+        self.datastore.sync_file(self.file)
+        ts_m.DATASTORE_WRITTEN_BYTES.inc(amount=self.file.tell())
+        # Fix the temporary file timestamp.
+        os.utime(self.temp_file_path, (timestamp, timestamp))
+        # Replaces the actual file with the temporary file atomically,
+        # still holding it.
+        try:
+            self.datastore.install_file(self.temp_file_path, file_path)
+        finally:
+            self.file.close()
+        # Returns the SHA-256 hash.
+        return sha256
+
+    # Discards the blob.
+    def abort(self):
+        if self.encoder is not None:
+            self.encoder.close()
+        try:
+            os.unlink(self.temp_file_path)
+        finally:
+            self.file.close()
+
+# Returns the Linux syncfs function, which flushes a whole file system
+# in a single call, or None if unavailable.
+def load_syncfs():
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+SYNCFS = load_syncfs()
+
+# Flushes the file system of a file descriptor to disk.
+def syncfs(fd):
+    if SYNCFS(fd) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+# Flushes of files to disk, batched across concurrent threads. A thread
+# flushes its file at once if no flush is in progress. Otherwise it waits
+# for the flush in progress, while the other threads join its batch, and
+# the first thread to wake up flushes the whole batch for all of them:
+# with a single syncfs per file system, so that the journal commits the
+# batch at once, or one fsync per file if syncfs is unavailable.
+class GroupSync:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.batch = None
+        self.flushing = False
+        # Counts the batches flushed, and the flush calls.
+        self.flushes = 0
+        self.calls = 0
+
+    # Flushes a file descriptor to disk in the current batch. Returns
+    # once the batch is flushed.
+    def fsync(self, fd):
+        with self.condition:
+            if self.batch is None:
+                self.batch = SyncBatch()
+            batch = self.batch
+            batch.fds.append(fd)
+            while self.flushing and not batch.done:
+                self.condition.wait()
+            leader = not batch.done
+            if leader:
+                # Flushes the batch, later threads start a new one.
+                self.flushing = True
+                self.batch = None
+        if leader:
+            calls = 0
+            try:
+                if len(batch.fds) == 1 or SYNCFS is None:
+                    for batch_fd in batch.fds:
+                        os.fsync(batch_fd)
+                        calls += 1
+                else:
+                    devices = {}
+                    for batch_fd in batch.fds:
+                        devices.setdefault(
+                            os.fstat(batch_fd).st_dev, batch_fd)
+                    for batch_fd in devices.values():
+                        syncfs(batch_fd)
+                        calls += 1
+            except OSError as e:
+                batch.error = e
+            with self.condition:
+                batch.done = True
+                self.flushing = False
+                self.flushes += 1
+                self.calls += calls
+                self.condition.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+# File descriptors flushed together by a group flush.
+class SyncBatch:
+
+    def __init__(self):
+        self.fds = []
+        self.done = False
+        self.error = None
+
+# Resumable upload of a blob. The session directory holds the data
+# received so far and the session metadata. The data is appended at the
+# current offset by one request at a time, and flushed to disk before the
+# new offset is returned. The SHA-256 hash is updated as the data is
+# appended, and kept in memory between the requests served by the same
+# process. Otherwise the hash is unknown, and the data is hashed once
+# when the upload is completed.
+# The upload is completed in the background, so that the requests never
+# wait for the hashing and the storage of the whole data. The hash is
+# recorded with the data size before the data is moved to the blob, so
+# that an interrupted completion resumes without hashing again.
+class UploadSession:
+
+    def __init__(self, datastore, session_id):
+        validate_session_id(session_id)
+        self.datastore = datastore
+        self.session_id = session_id
+        self.session_dir = os.path.join(
+            datastore.data_dir, UPLOADS_DIR, session_id)
+        self.data_path = os.path.join(self.session_dir, 'data')
+        self.sha256_path = os.path.join(self.session_dir, 'sha256')
+        self.committing_path = os.path.join(self.session_dir, 'committing')
+        try:
+            with open(os.path.join(self.session_dir, 'metadata')) as f:
+                self.metadata = json.load(f)
+        except FileNotFoundError:
+            raise DatastoreException('Upload session not found')
+        self.file = None
+        self.sha256 = None
+        self.offset = None
+        self.begin_offset = None
+        self.commit_error = None
+        self.sha256_file = None
+
+    # Returns the size of the data received so far.
+    def retrieve_offset(self):
+        try:
+            return os.stat(self.data_path).st_size
+        except FileNotFoundError:
+            raise DatastoreException('Upload session not found')
+
+    # Locks the session to append data at an offset. Returns False if
+    # another request holds the session or if the offset is not the size
+    # of the data received so far.
+    def begin(self, offset):
+        try:
+            self.file = open(self.data_path, 'r+b')
+        except FileNotFoundError:
+            raise DatastoreException('Upload session not found')
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        self.offset = self.begin_offset = self.file.seek(0, os.SEEK_END)
+        if offset != self.offset:
+            self.file.close()
+            self.file = None
+            return False
+        # Resumes the hash computed by this process, if any.
+        sha256 = self.datastore.upload_hashes.get(
+            (self.session_id, self.offset))
+        self.sha256 = sha256.copy() if sha256 is not None else None
+        return True
+
+    # Appends data at the current offset.
+    def write(self, buffer):
+        self.file.write(buffer)
+        if self.sha256 is not None:
+            self.sha256.update(buffer)
+        self.offset += len(buffer)
+
+    # Flushes the data appended to disk and unlocks the session. Returns
+    # the new offset.
+    def end(self):
+        self.datastore.sync_file(self.file)
+        ts_m.DATASTORE_WRITTEN_BYTES.inc(
+            amount=self.offset - self.begin_offset)
+        # Keeps the hash only if known and all the data was appended.
+        if self.sha256 is not None and self.file.tell() == self.offset:
+            self.datastore.upload_hashes.put(
+                (self.session_id, self.offset), self.sha256.copy(),
+                self.datastore.upload_hashes.epoch)
+        self.file.close()
+        self.file = None
+        return self.offset
+
+    # Completes the upload: hashes the data unless the hash is known,
+    # then moves the data to a blob. The completion runs in a background
+    # thread holding the session, and is waited for up to a timeout.
+    # Returns the SHA-256 hash of the blob, or None if the completion is
+    # still in progress or if another request is finishing the session.
+    # The session is then locked until deleted by the caller, once done
+    # with the blob.
+    # The age in seconds should only be specified when testing.
+    def commit(self, age=0):
+        try:
+            offset = self.retrieve_offset()
+        except DatastoreException:
+            # The data was moved to the blob.
+            return self.finish()
+        if not self.begin(offset):
+            if os.path.exists(self.committing_path):
+                return None
+            raise UploadSessionBusy('Upload session busy')
+        open(self.committing_path, 'w').close()
+        done = threading.Event()
+        thread = threading.Thread(
+            target=self.complete, args=(age, done), daemon=True)
+        thread.start()
+        if not done.wait(UPLOAD_COMMIT_TIMEOUT):
+            return None
+        if self.commit_error is not None:
+            raise self.commit_error
+        return self.finish()
+
+    # Hashes the data unless the hash is known, records the hash, moves
+    # the data to the blob, then unlocks the session. Runs in the
+    # background, the error if any is kept for the waiting request.
+    def complete(self, age, done):
+        try:
+            size, sha256 = self.retrieve_recorded_sha256()
+            if size != self.offset:
+                if self.sha256 is None:
+                    self.sha256 = hashlib.sha256()
+                    self.file.seek(0)
+                    for buffer in iter(
+                            lambda: self.file.read(BUFFER_SIZE), b''):
+                        self.sha256.update(buffer)
+                sha256 = binascii.hexlify(self.sha256.digest()).decode()
+                with open(self.sha256_path + '-temp', 'w') as f:
+                    f.write('%d %s' % (self.offset, sha256))
+                os.replace(self.sha256_path + '-temp', self.sha256_path)
+            self.datastore.adopt_blob(self.data_path, sha256, age)
+        except Exception as e:
+            self.commit_error = e
+        finally:
+            self.file.close()
+            self.file = None
+            done.set()
+
+    # Returns the data size and the SHA-256 hash recorded by the
+    # completion of the upload, or None and None if not recorded.
+    def retrieve_recorded_sha256(self):
+        try:
+            with open(self.sha256_path) as f:
+                size, sha256 = f.read().split()
+        except FileNotFoundError:
+            return None, None
+        return int(size), sha256
+
+    # Locks the session once its data was moved to the blob, so that a
+    # single request creates the file. Returns the SHA-256 hash of the
+    # blob, or None if another request holds the session.
+    def finish(self):
+        try:
+            self.sha256_file = open(self.sha256_path, 'rb')
+        except FileNotFoundError:
+            raise DatastoreException('Upload session not found')
+        try:
+            fcntl.flock(
+                self.sha256_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.sha256_file.close()
+            self.sha256_file = None
+            return None
+        size, sha256 = self.sha256_file.read().decode().split()
+        # The session was finished meanwhile, or its blob was deleted
+        # by a cleanup before the file was created.
+        if not os.path.exists(self.sha256_path) or \
+                not self.datastore.has_blob(sha256):
+            self.abort()
+            raise DatastoreException('Upload session not found')
+        return sha256
+
+    # Discards the upload, or deletes the session once finished.
+    def abort(self):
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+        if self.sha256_file is not None:
+            self.sha256_file.close()
+            self.sha256_file = None
+
 # Filesystem-backed datastore.
+# The blobs are either stored flat in the data directory, or fanned out
+# in nested directories named after the first bytes of their SHA-256
+# hashes (e.g.: ab/cd/abcd...) depending on the fan-out depth.
+# The new blobs are compressed with the codec named by the compression if
+# specified, at the compression level if specified, otherwise at the codec
+# default level. The blobs stored with any codec are readable.
 class Datastore:
 
-    def __init__(self, data_dir):
+    def __init__(
+            self, data_dir, fanout=0, compression=None,
+            durability=DURABILITY_STRICT, compression_level=None):
         self.data_dir = data_dir
+        self.fanout = fanout
+        if compression is not None and compression not in CODECS:
+            raise DatastoreException('Invalid compression')
+        self.codec = CODECS.get(compression)
+        if compression_level is not None and (
+                self.codec is None or
+                compression_level not in self.codec.levels):
+            raise DatastoreException('Invalid compression level')
+        if compression_level is None and self.codec is not None:
+            compression_level = self.codec.default_level
+        self.compression_level = compression_level
+        if durability not in DURABILITIES:
+            raise DatastoreException('Invalid durability')
+        self.durability = durability
+        self.group_sync = GroupSync()
+        # Counts the blobs which already existed when created.
+        self.dedup_lock = threading.Lock()
+        self.dedup_hits = 0
+        self.dedup_bytes = 0
+        # Hashes of the upload sessions by session ID and offset.
+        self.upload_hashes = ts_c.LruCache(UPLOAD_HASHES_SIZE)
 
     # Creates or resets the datastore.
     def create(self):
@@ -43,46 +627,577 @@ class Datastore:
     # Creates a blob. Returns its SHA-256 hash.
     # The age in seconds should only be specified when testing.
     def create_blob(self, stream, age=0):
-        # Generates the actual and temporary files names.
-        sha256 = sha256_sum(stream)
-        file_path = os.path.join(self.data_dir, sha256)
-        temp_file_path = file_path + '-' + uuid.uuid4().hex
-        # Writes the stream to a temporary file.
-        stream.seek(0)
-        with open(temp_file_path, 'xb') as f:
-            for buffer in iter(lambda: stream.read(BUFFER_SIZE), b''):
-                f.write(buffer)
-            f.flush()
-            os.fsync(f.fileno())
-        # Fix the temporary file timestamp.
+        writer = self.create_blob_writer()
+        try:
+            writer.write_stream(stream)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.commit(age)
+
+    # Creates a blob writer to write a blob incrementally.
+    def create_blob_writer(self):
+        return BlobWriter(self)
+
+    # Creates a resumable upload session holding metadata. Returns its
+    # ID.
+    def create_upload_session(self, metadata):
+        session_id = uuid.uuid4().hex
+        session_dir = os.path.join(self.data_dir, UPLOADS_DIR, session_id)
+        os.makedirs(session_dir)
+        open(os.path.join(session_dir, 'data'), 'xb').close()
+        with open(os.path.join(session_dir, 'metadata'), 'x') as f:
+            json.dump(metadata, f)
+        return session_id
+
+    # Opens a resumable upload session.
+    def open_upload_session(self, session_id):
+        return UploadSession(self, session_id)
+
+    # Deletes the upload sessions without activity for a maximum age in
+    # seconds, unless a request holds them. Returns the freed bytes.
+    def delete_stale_upload_sessions(self, max_age):
+        now = int(time.time())
+        freed_bytes = 0
+        try:
+            session_ids = os.listdir(os.path.join(self.data_dir, UPLOADS_DIR))
+        except FileNotFoundError:
+            return 0
+        for session_id in session_ids:
+            try:
+                session = self.open_upload_session(session_id)
+            except DatastoreException:
+                continue
+            # The session holds either the data, or the hash of the blob
+            # the data was moved to until finished.
+            for file_path in [session.data_path, session.sha256_path]:
+                try:
+                    f = open(file_path, 'rb')
+                    break
+                except FileNotFoundError:
+                    f = None
+            if f is None:
+                continue
+            with f:
+                stat = os.fstat(f.fileno())
+                if stat.st_mtime > now - max_age:
+                    continue
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                session.abort()
+            freed_bytes += stat.st_size
+        return freed_bytes
+
+    # Moves a complete file into the datastore as the blob of a SHA-256
+    # hash, unless the blob exists. The file is written through a blob
+    # writer if the datastore compresses the blobs.
+    # The age in seconds should only be specified when testing.
+    def adopt_blob(self, file_path, sha256, age=0):
         timestamp = int(time.time()) - age
-        os.utime(temp_file_path, (timestamp, timestamp))
-        # Replaces the actual file with the temporary file atomically.
+        size = os.stat(file_path).st_size
+        # Keeps the existing blob if there is one, and refreshes its
+        # timestamp.
+        for blob_path, codec in self.blob_paths(sha256):
+            try:
+                self.touch_blob(blob_path, timestamp)
+                os.unlink(file_path)
+                self.count_dedup_hit(size)
+                return
+            except FileNotFoundError:
+                pass
+        if self.codec is not None:
+            self.copy_blob(file_path, sha256, age)
+            os.unlink(file_path)
+            return
+        os.utime(file_path, (timestamp, timestamp))
+        self.install_file(file_path, self.blob_path(sha256))
+
+    # Stores a file as the blob of its SHA-256 hash unless the blob
+    # exists, leaving the file in place. The blob shares the data of the
+    # file if possible. Returns how the blob was stored: 'existing',
+    # 'reflink', 'link', or 'copy'.
+    def import_file(self, file_path, sha256, link=True):
+        validate_sha256(sha256)
+        # Keeps the existing blob if there is one, and refreshes its
+        # timestamp.
+        for blob_path, codec in self.blob_paths(sha256):
+            try:
+                self.touch_blob(blob_path, int(time.time()))
+                self.count_dedup_hit(os.stat(file_path).st_size)
+                return 'existing'
+            except FileNotFoundError:
+                pass
+        if self.codec is not None:
+            self.copy_blob(file_path, sha256)
+            return 'copy'
+        return self.clone_blob(file_path, sha256, link)
+
+    # Refreshes the timestamp of an existing blob, so that it is not
+    # deleted before being referenced. Leaves the hard-linked blobs as they
+    # are: their timestamp is the one of the imported file sharing their
+    # data, and the cleanups keep them while that file exists.
+    # Raises FileNotFoundError if the blob does not exist.
+    def touch_blob(self, file_path, timestamp):
+        if os.stat(file_path).st_nlink == 1:
+            os.utime(file_path, (timestamp, timestamp))
+
+    # Returns the path of a new temporary file, in the directory of the
+    # temporary files.
+    def create_temp_path(self, prefix=''):
+        temp_dir = os.path.join(self.data_dir, TEMP_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(temp_dir, prefix + uuid.uuid4().hex)
+
+    # Stores a file as the blob of its SHA-256 hash, sharing its data:
+    # reflinks the file if the file system supports it, hard-links it if
+    # allowed and on the same file system, copies it otherwise. A
+    # hard-linked file must not be modified afterwards. Returns how the
+    # blob was stored.
+    def clone_blob(self, file_path, sha256, link=True):
+        temp_file_path = self.create_temp_path()
+        try:
+            method = clone_file(file_path, temp_file_path, link)
+            with open(temp_file_path, 'rb') as f:
+                self.sync_fd(f.fileno())
+            self.install_file(temp_file_path, self.blob_path(sha256))
+        except Exception:
+            if os.path.exists(temp_file_path):
+                os.unlink(temp_file_path)
+            raise
+        return method
+
+    # Writes a file through a blob writer. Checks that the file still
+    # hashes to a SHA-256 hash.
+    def copy_blob(self, file_path, sha256, age=0):
+        with open(file_path, 'rb') as f:
+            writer = self.create_blob_writer()
+            try:
+                writer.write_stream(f)
+            except Exception:
+                writer.abort()
+                raise
+        if binascii.hexlify(writer.sha256.digest()).decode() != sha256:
+            writer.abort()
+            raise DatastoreException('Invalid SHA-256 hash')
+        writer.commit(age)
+
+    # Flushes a written file to disk, as the durability requires.
+    def sync_file(self, file):
+        file.flush()
+        self.sync_fd(file.fileno())
+
+    # Flushes a file descriptor to disk, as the durability requires.
+    def sync_fd(self, fd):
+        if self.durability == DURABILITY_RELAXED:
+            return
+        with ts_m.DATASTORE_FSYNC_SECONDS.time():
+            if self.durability == DURABILITY_GROUP:
+                self.group_sync.fsync(fd)
+            else:
+                os.fsync(fd)
+
+    # Moves a file to its final path atomically, creating the missing
+    # directories. Then flushes the directories entries to disk, as the
+    # durability requires, so that the file survives a crash.
+    def install_file(self, temp_file_path, file_path):
+        modified_dirs = self.move_file(temp_file_path, file_path)
+        if self.durability == DURABILITY_RELAXED:
+            return
+        for modified_dir in modified_dirs:
+            fd = os.open(modified_dir, os.O_RDONLY)
+            try:
+                self.sync_fd(fd)
+            finally:
+                os.close(fd)
+
+    # Moves a file to its final path atomically, creating the missing
+    # directories. Returns the modified directories, not flushed yet.
+    def move_file(self, temp_file_path, file_path):
+        dir_path = os.path.dirname(file_path)
+        # The parents of the created directories are modified too.
+        modified_dirs = [dir_path]
+        missing_dir = dir_path
+        while not os.path.isdir(missing_dir):
+            missing_dir = os.path.dirname(missing_dir)
+            modified_dirs.append(missing_dir)
+        os.makedirs(dir_path, exist_ok=True)
         os.replace(temp_file_path, file_path)
-        # Returns the SHA-256 hash.
-        return sha256
+        return modified_dirs
+
+    # Flushes files or directories to disk, as the durability requires:
+    # with a single syncfs per file system if there are several of them
+    # and syncfs is available, otherwise with one fsync each.
+    def sync_paths(self, paths):
+        if self.durability == DURABILITY_RELAXED:
+            return
+        use_syncfs = len(paths) > 1 and SYNCFS is not None
+        if use_syncfs:
+            devices = {}
+            for path in paths:
+                devices.setdefault(os.stat(path).st_dev, path)
+            paths = list(devices.values())
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if use_syncfs:
+                    with ts_m.DATASTORE_FSYNC_SECONDS.time():
+                        syncfs(fd)
+                else:
+                    self.sync_fd(fd)
+            finally:
+                os.close(fd)
+
+    # Records that a blob of the specified size already existed.
+    def count_dedup_hit(self, size):
+        with self.dedup_lock:
+            self.dedup_hits += 1
+            self.dedup_bytes += size
+        ts_m.DATASTORE_DEDUP_BYTES.inc(amount=size)
+
+    # Returns the path of a blob from its SHA-256 hash.
+    def blob_path(self, sha256, fanout=None):
+        if fanout is None:
+            fanout = self.fanout
+        shards = [sha256[2*i:2*i+2] for i in range(fanout)]
+        return os.path.join(self.data_dir, *shards, sha256)
+
+    # Returns the possible paths of a blob from its SHA-256 hash, with
+    # their codecs, in the order they should be looked up: uncompressed
+    # then compressed, in the configured layout then in the flat layout.
+    def blob_paths(self, sha256, fanouts=None):
+        if fanouts is None:
+            fanouts = [self.fanout]
+            if self.fanout > 0:
+                fanouts.append(0)
+        codecs = [None]
+        if self.codec is not None:
+            codecs.append(self.codec)
+        codecs += [codec for codec in CODECS.values() if codec not in codecs]
+        blob_paths = []
+        for fanout in fanouts:
+            file_path = self.blob_path(sha256, fanout)
+            for codec in codecs:
+                if codec is None:
+                    blob_paths.append((file_path, None))
+                else:
+                    blob_paths.append((file_path + codec.suffix, codec))
+        return blob_paths
+
+    # Locates a blob from its SHA-256 hash. Returns its path relative
+    # to the data directory.
+    # Raises an exception if the SHA-256 is invalid/unknown.
+    def locate_blob(self, sha256):
+        # Validates the parameter.
+        validate_sha256(sha256)
+        # Locates the blob, also in the flat layout.
+        for file_path, codec in self.blob_paths(sha256):
+            if os.path.isfile(file_path):
+                return os.path.relpath(file_path, self.data_dir)
+        raise DatastoreException('Blob not found')
 
-    # Retrieves a blob from its SHA-256 hash. Returns a stream.
+    # Opens a blob from its SHA-256 hash as stored. Returns a stream and
+    # the blob codec, None if the blob is not compressed.
+    # Raises an exception if the SHA-256 is invalid/unknown.
+    def open_blob(self, sha256):
+        # Validates the parameter.
+        validate_sha256(sha256)
+        # Opens the blob. Falls back to the flat layout while the
+        # datastore is migrated, then tries again in case the blob was
+        # moved in the meantime.
+        blob_paths = self.blob_paths(sha256)
+        if self.fanout > 0:
+            blob_paths += self.blob_paths(sha256, [self.fanout])
+        for file_path, codec in blob_paths:
+            try:
+                return open(file_path, 'rb'), codec
+            except FileNotFoundError:
+                pass
+        raise DatastoreException('Blob not found')
+
+    # Retrieves a blob from its SHA-256 hash. Returns a stream of the
+    # original data.
     # Raises an exception if the SHA-256 is invalid/unknown.
     def retrieve_blob(self, sha256):
+        stream, codec = self.open_blob(sha256)
+        if codec is not None:
+            return DecompressedBlob(stream, codec)
+        return stream
+
+    # Deletes a blob from its SHA-256 hash unless it was created less
+    # than 60 seconds ago, or is hard-linked to an imported file. Returns
+    # the outcome, 'deleted', 'kept', or 'linked', and the freed bytes.
+    def delete_blob(self, sha256):
         # Validates the parameter.
         validate_sha256(sha256)
-        # Retrieves the blob.
-        file_path = os.path.join(self.data_dir, sha256)
-        try:
-            return open(file_path, 'rb')
-        except FileNotFoundError:
-            raise DatastoreException('Blob not found')
+        # Deletes the blob, wherever the layout stores it.
+        now = int(time.time())
+        freed_bytes = 0
+        for file_path, codec in self.blob_paths(sha256):
+            try:
+                stat = os.stat(file_path)
+                # The blob may have just been uploaded again.
+                if stat.st_mtime > now - 60:
+                    return 'kept', 0
+                # Deleting a hard-linked blob would free nothing.
+                if stat.st_nlink > 1:
+                    return 'linked', 0
+                os.unlink(file_path)
+                freed_bytes += stat.st_size
+            except FileNotFoundError:
+                pass
+        return 'deleted', freed_bytes
 
     # Deletes the unreferenced blobs from the datastore.
-    def delete_unreferenced_blobs(self, sha256s):
+    # The blobs are scanned in order and deleted in batches. A checkpoint
+    # is saved after each batch so that an interrupted run resumes where
+    # it stopped. Returns the scanned, kept, linked, and deleted blobs
+    # counts and the freed bytes.
+    def delete_unreferenced_blobs(self, sha256s, batch_size=1000):
         now = int(time.time())
-        for file_name in os.listdir(self.data_dir):
-            file_path = os.path.join(self.data_dir, file_name)
+        checkpoint_path = os.path.join(self.data_dir, GC_CHECKPOINT_FILE)
+        checkpoint = ''
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = f.read().strip()
+        statistics = {
+            'scanned': 0,
+            'kept': 0,
+            'linked': 0,
+            'deleted': 0,
+            'bytes_freed': 0}
+        batch = []
+        # Deletes a batch of files.
+        def delete_batch():
+            for file_path, size in batch:
+                try:
+                    os.unlink(file_path)
+                    statistics['deleted'] += 1
+                    statistics['bytes_freed'] += size
+                except FileNotFoundError:
+                    pass
+            batch.clear()
+        for entry in self.scan(checkpoint):
+            file_name = entry.name
+            # The stat result is cached by the directory entry.
+            stat = entry.stat(follow_symlinks=False)
             # Ignores the file if created less than 60 seconds ago,
             # it may not be referenced yet.
-            if os.stat(file_path).st_mtime > now - 60:
+            if stat.st_mtime > now - 60:
                 continue
-            # Deletes the file unless referenced.
-            if file_name not in sha256s:
-                os.unlink(file_path)
+            # Deletes the temporary files left behind by failed writes
+            # outside of the directory of the temporary files, by older
+            # versions.
+            sha256, codec = parse_blob_name(file_name)
+            if sha256 is None:
+                if stat.st_mtime <= now - TEMP_FILE_AGE:
+                    batch.append((entry.path, stat.st_size))
+                continue
+            # Deletes the blob unless referenced. Keeps the hard-linked
+            # blobs, which keep the old timestamp of the imported file
+            # sharing their data, even while being imported.
+            statistics['scanned'] += 1
+            if sha256 in sha256s:
+                statistics['kept'] += 1
+            elif stat.st_nlink > 1:
+                statistics['linked'] += 1
+            else:
+                batch.append((entry.path, stat.st_size))
+                if len(batch) >= batch_size:
+                    delete_batch()
+                    # Saves the checkpoint atomically.
+                    temp_checkpoint_path = checkpoint_path + '-temp'
+                    with open(temp_checkpoint_path, 'w') as f:
+                        f.write(file_name)
+                    os.replace(temp_checkpoint_path, checkpoint_path)
+        delete_batch()
+        if os.path.exists(checkpoint_path):
+            os.unlink(checkpoint_path)
+        statistics['bytes_freed'] += self.delete_stale_temp_files()
+        return statistics
+
+    # Deletes the temporary files left behind by failed or interrupted
+    # writes: the ones which no writer holds, and which did not change
+    # for an age in seconds. The change time is used, which neither the
+    # timestamp fixes nor the links to old files set back. Returns the
+    # freed bytes.
+    def delete_stale_temp_files(self, age=TEMP_FILE_AGE):
+        now = time.time()
+        freed_bytes = 0
+        try:
+            with os.scandir(os.path.join(self.data_dir, TEMP_DIR)) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            return freed_bytes
+        for entry in entries:
+            try:
+                with open(entry.path, 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    if stat.st_ctime > now - age:
+                        continue
+                    try:
+                        fcntl.flock(
+                            f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            # A temporary link to an imported file frees nothing.
+            if stat.st_nlink == 1:
+                freed_bytes += stat.st_size
+        return freed_bytes
+
+    # Scans the blobs and the temporary files in the order of their
+    # names. Skips the blobs up to and including a checkpoint hash.
+    # Yields directory entries.
+    def scan(self, checkpoint='', dir_path=None, prefix=''):
+        if dir_path is None:
+            dir_path = self.data_dir
+        with os.scandir(dir_path) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.name in (QUARANTINE_DIR, UPLOADS_DIR, TEMP_DIR):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                # Skips the shards entirely before the checkpoint.
+                shard = prefix + entry.name
+                if shard < checkpoint[:len(shard)]:
+                    continue
+                yield from self.scan(checkpoint, entry.path, shard)
+            elif entry.name.startswith(GC_CHECKPOINT_FILE) or \
+                    entry.name.startswith(SCRUB_CHECKPOINT_FILE):
+                continue
+            elif parse_blob_name(entry.name)[0] is None \
+                    or entry.name > checkpoint:
+                yield entry
+
+    # Verifies that the blobs still hash to their names. The blobs are
+    # hashed in order by a pool of threads, in batches. A checkpoint is
+    # saved after each batch so that an interrupted run resumes where it
+    # stopped. The reads are limited to a rate in bytes per second if
+    # specified. The corrupted blobs are moved to the quarantine directory
+    # if requested, so that uploading them again restores them.
+    # Returns the scanned blobs count and bytes, and the SHA-256 hashes of
+    # the corrupted blobs.
+    def scrub(self, workers=4, rate=None, quarantine=False, batch_size=100):
+        checkpoint_path = os.path.join(self.data_dir, SCRUB_CHECKPOINT_FILE)
+        checkpoint = ''
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = f.read().strip()
+        statistics = {
+            'scanned': 0,
+            'bytes': 0,
+            'corrupted': []}
+        throttle = Throttle(rate)
+        batch = []
+        # Verifies a batch of files, then saves the checkpoint.
+        def verify_batch():
+            results = executor.map(
+                lambda entry: self.verify_file(entry.path, throttle), batch)
+            for entry, (valid, size) in zip(batch, results):
+                statistics['scanned'] += 1
+                statistics['bytes'] += size
+                if valid:
+                    continue
+                sha256, codec = parse_blob_name(entry.name)
+                statistics['corrupted'].append(sha256)
+                if quarantine:
+                    self.quarantine_file(entry.path)
+            # Saves the checkpoint atomically.
+            temp_checkpoint_path = checkpoint_path + '-temp'
+            with open(temp_checkpoint_path, 'w') as f:
+                f.write(batch[-1].name)
+            os.replace(temp_checkpoint_path, checkpoint_path)
+            batch.clear()
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for entry in self.scan_scrub(checkpoint):
+                # Ignores the temporary files.
+                if parse_blob_name(entry.name)[0] is None:
+                    continue
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    verify_batch()
+            if batch:
+                verify_batch()
+        if os.path.exists(checkpoint_path):
+            os.unlink(checkpoint_path)
+        return statistics
+
+    # Scans the files verified by the scrubbing, in the order of their
+    # names, after a checkpoint. Yields directory entries.
+    def scan_scrub(self, checkpoint):
+        return self.scan(checkpoint)
+
+    # Verifies that a blob file hashes to its name, decompressed if
+    # needed. Returns whether the blob is valid, and the bytes read.
+    def verify_file(self, file_path, throttle):
+        sha256, codec = parse_blob_name(os.path.basename(file_path))
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(file_path, 'rb') as stream:
+                if codec is not None:
+                    stream = DecompressedBlob(stream, codec)
+                with stream:
+                    while True:
+                        throttle.consume(BUFFER_SIZE)
+                        buffer = stream.read(BUFFER_SIZE)
+                        if not buffer:
+                            break
+                        digest.update(buffer)
+                        size += len(buffer)
+        except FileNotFoundError:
+            # Deleted meanwhile.
+            return True, size
+        except (EOFError, lzma.LZMAError, zlib.error, gzip.BadGzipFile):
+            return False, size
+        return digest.hexdigest() == sha256, size
+
+    # Moves a corrupted file to the quarantine directory.
+    def quarantine_file(self, file_path):
+        quarantine_dir = os.path.join(self.data_dir, QUARANTINE_DIR)
+        os.makedirs(quarantine_dir, exist_ok=True)
+        os.replace(file_path, os.path.join(
+            quarantine_dir, os.path.basename(file_path)))
+
+    # Returns whether a blob exists from its SHA-256 hash.
+    def has_blob(self, sha256):
+        return any(
+            os.path.isfile(file_path)
+            for file_path, codec in self.blob_paths(sha256))
+
+    # Moves the blobs stored with another fan-out depth to their
+    # expected location. Safe to run while the datastore is in use.
+    # Returns the number of blobs moved.
+    def migrate(self):
+        return self.migrate_dir(self.data_dir, self.blob_path)
+
+    # Moves the blobs of a directory to the location given by a path
+    # function of their SHA-256 hashes. Returns the number of blobs moved.
+    def migrate_dir(self, data_dir, path_function):
+        count = 0
+        for dir_path, dir_names, file_names in os.walk(data_dir):
+            # Leaves the quarantined blobs, the uploads, and the temporary
+            # files in place.
+            for skipped_dir in (QUARANTINE_DIR, UPLOADS_DIR, TEMP_DIR):
+                if skipped_dir in dir_names:
+                    dir_names.remove(skipped_dir)
+            for file_name in file_names:
+                # Ignores the temporary files.
+                sha256, codec = parse_blob_name(file_name)
+                if sha256 is None:
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                blob_path = path_function(sha256)
+                if codec is not None:
+                    blob_path += codec.suffix
+                if file_path == blob_path:
+                    continue
+                # Moves the blob atomically.
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(file_path, blob_path)
+                count += 1
+        return count
@@ -1,37 +1,91 @@
+import tempstore.cache as ts_c
+import tempstore.chunkstore as ts_cs
 import tempstore.database as ts_db
 import tempstore.datastore as ts_ds
+import tempstore.metrics as ts_m
 
+import concurrent.futures
 import datetime
+import os
+import os.path
+import random
 import time
 
+# SQLite synchronous settings matching the datastore durability levels.
+# The group durability only batches the datastore flushes, the database
+# flushes each commit as with the strict durability.
+SYNCHRONOUS_SETTINGS = {
+    ts_ds.DURABILITY_STRICT: 'FULL',
+    ts_ds.DURABILITY_GROUP: 'FULL',
+    ts_ds.DURABILITY_RELAXED: 'OFF'}
+
+# Age in seconds after which the cleanups delete the upload sessions
+# without activity.
+UPLOAD_SESSION_AGE = 24 * 60 * 60
+
+# Interval in seconds after which the cleanups check again the
+# unreferenced blobs kept because they share the data of imported files.
+# The checks are spread over the second half of the interval, so that the
+# blobs of an import are not checked again all at once.
+LINKED_BLOB_RECHECK_INTERVAL = 24 * 60 * 60
+
+# Number of files hashed per task of the import processes.
+IMPORT_CHUNK_SIZE = 16
+
 # Combines a database and a datastore to handle projects,
 # versions, files, blobs, and their associated metadata.
+# The metadata read from the database is cached if a cache size is
+# specified. The cache is cleared by the writes of this engine, and by the
+# writes of the other processes when the database generation changes.
+# The durability level applies to both the datastore and the database.
 class Engine:
 
-    def __init__(self, datastore_dir, database_dir, obsolete_age):
-        self.datastore = ts_ds.Datastore(datastore_dir)
-        self.database = ts_db.Database(database_dir)
+    def __init__(
+            self, datastore_dir, database_dir, obsolete_age,
+            database_pool_size=0, datastore_fanout=0, cache_size=0,
+            datastore_compression=None, datastore_chunking=False,
+            durability=ts_ds.DURABILITY_STRICT,
+            datastore_compression_level=None):
+        if datastore_chunking:
+            datastore_class = ts_cs.ChunkedDatastore
+        else:
+            datastore_class = ts_ds.Datastore
+        self.datastore = datastore_class(
+            datastore_dir, datastore_fanout, datastore_compression,
+            durability, datastore_compression_level)
+        self.database = ts_db.Database(
+            database_dir, database_pool_size,
+            SYNCHRONOUS_SETTINGS[durability])
         self.obsolete_age = obsolete_age
+        self.cache = ts_c.LruCache(cache_size)
+        self.generation = None
 
     # Creates or resets the datastore and database.
     def create(self):
         self.datastore.create()
         self.database.create()
+        self.invalidate()
 
     # Deletes the datastore and database.
     def delete(self):
         self.datastore.delete()
         self.database.delete()
 
-    # Lists all the projects.
-    def list_projects(self):
-        projects = self.database.retrieve_projects()
-        return projects
+    # Lists the projects, after a cursor and up to a limit if specified.
+    def list_projects(self, cursor=None, limit=None):
+        projects = self.cached(
+            ('projects', cursor, limit),
+            self.database.retrieve_projects, cursor, limit)
+        return list(projects)
 
-    # Lists all the versions for a project.
-    def list_versions(self, project_name):
+    # Lists the versions for a project, after a cursor and up to a limit
+    # if specified.
+    def list_versions(self, project_name, cursor=None, limit=None):
         # Retrieves the versions from the database.
-        versions = self.database.retrieve_versions(project_name)
+        versions = self.cached(
+            ('versions', project_name, cursor, limit),
+            self.database.retrieve_versions, project_name, cursor, limit)
+        versions = [dict(version) for version in versions]
         # Formats nicely the date and the time until expiry.
         now = int(time.time())
         for version in versions:
@@ -45,47 +99,462 @@ class Engine:
         # Returns the versions
         return versions
 
-    # Lists all the files for a version.
-    def list_files(self, project_name, version_name):
-        files = self.database.retrieve_files(project_name, version_name)
-        return files
+    # Lists the files for a version, after a cursor and up to a limit if
+    # specified.
+    def list_files(
+            self, project_name, version_name, cursor=None, limit=None):
+        files = self.cached(
+            ('files', project_name, version_name, cursor, limit),
+            self.database.retrieve_files,
+            project_name, version_name, cursor, limit)
+        return list(files)
+
+    # Searches the projects, versions, or files whose name contains a
+    # query, after a cursor and up to a limit if specified.
+    def search(self, kind, query, cursor=None, limit=None):
+        results = self.cached(
+            ('search', kind, query, cursor, limit),
+            self.database.search, kind, query, cursor, limit)
+        return list(results)
+
+    # Returns the cached result of a database retrieval, or performs the
+    # retrieval and caches its result.
+    def cached(self, key, retrieve, *args):
+        self.check_generation()
+        value = self.cache.get(key)
+        if value is None:
+            # The result is outdated if the cache is cleared meanwhile.
+            epoch = self.cache.epoch
+            value = retrieve(*args)
+            self.cache.put(key, value, epoch)
+        return value
+
+    # Clears the cache if another process changed the database. The
+    # database generation is read from a file, so that the cache hits do
+    # not query the database.
+    def check_generation(self):
+        generation = self.database.retrieve_generation()
+        if generation != self.generation:
+            self.generation = generation
+            self.cache.clear()
+
+    # Returns the database generation, as last checked. It identifies
+    # the state of the projects, versions, and files.
+    def current_generation(self):
+        self.check_generation()
+        return self.generation
+
+    # Clears the cache after a write.
+    def invalidate(self):
+        self.cache.clear()
 
     # Uploads a file.
     # The age in seconds should only be specified when testing.
     def upload(self,
             project_name, version_name, file_name, stream, age=0):
         # Writes the stream to a datastore blob.
-        sha256 = self.datastore.create_blob(stream, age)
+        writer = self.create_blob_writer()
+        try:
+            writer.write_stream(stream)
+        except Exception:
+            writer.abort()
+            raise
+        # Commits the blob and creates a file in the database.
+        self.commit_upload(
+            project_name, version_name, file_name, writer, age)
+
+    # Creates a blob writer to upload a file incrementally.
+    def create_blob_writer(self):
+        return self.datastore.create_blob_writer()
+
+    # Commits the blob of an incremental upload and creates a file.
+    # The age in seconds should only be specified when testing.
+    def commit_upload(self,
+            project_name, version_name, file_name, writer, age=0):
+        # Commits the datastore blob.
+        sha256 = writer.commit(age)
         # Creates a file in the database.
-        self.database.create_file(
-            project_name, version_name, file_name, sha256, age)
+        self.create_file(project_name, version_name, file_name, sha256, age)
+
+    # Creates a file referencing a committed blob in the database.
+    # The age in seconds should only be specified when testing.
+    def create_file(
+            self, project_name, version_name, file_name, sha256, age=0):
+        manifests = self.retrieve_manifests([sha256])
+        try:
+            self.database.create_file(
+                project_name, version_name, file_name, sha256, age,
+                manifests)
+        except ts_db.DatabaseException:
+            # Queues the blob for deletion if nothing references it.
+            self.database.create_blob(sha256, manifests)
+            raise
+        self.invalidate()
+
+    # Retrieves the manifests of committed blobs (SHA-256 hash, SHA-256
+    # hashes of the chunks) for the database to count the chunks
+    # references. Returns None if the datastore does not chunk the blobs.
+    def retrieve_manifests(self, sha256s):
+        if not isinstance(self.datastore, ts_cs.ChunkedDatastore):
+            return None
+        return [
+            (sha256, self.datastore.retrieve_chunk_sha256s(sha256))
+            for sha256 in sha256s]
+
+    # Creates a resumable upload session of a file. Returns its ID.
+    def create_upload_session(self, project_name, version_name, file_name):
+        # Validates the names before receiving the data.
+        ts_db.validate_name(project_name)
+        ts_db.validate_name(version_name)
+        ts_db.validate_name(file_name)
+        return self.datastore.create_upload_session({
+            'project': project_name,
+            'version': version_name,
+            'file': file_name})
+
+    # Opens a resumable upload session.
+    def open_upload_session(self, session_id):
+        return self.datastore.open_upload_session(session_id)
+
+    # Completes a resumable upload session and creates its file. Returns
+    # False if the completion of the blob is still in progress, then the
+    # session should be committed again later.
+    # The age in seconds should only be specified when testing.
+    def commit_upload_session(self, session_id, age=0):
+        session = self.datastore.open_upload_session(session_id)
+        sha256 = session.commit(age)
+        if sha256 is None:
+            return False
+        try:
+            self.create_file(
+                session.metadata['project'], session.metadata['version'],
+                session.metadata['file'], sha256, age)
+        finally:
+            session.abort()
+        return True
+
+    # Discards a resumable upload session.
+    def abort_upload_session(self, session_id):
+        self.datastore.open_upload_session(session_id).abort()
+
+    # Commits the blobs of the incremental uploads of several files
+    # (name, writer) in a version, then creates all or none of the files.
+    # The age in seconds should only be specified when testing.
+    def commit_uploads(self, project_name, version_name, files, age=0):
+        file_names = [file_name for file_name, writer in files]
+        writers = [writer for file_name, writer in files]
+        sha256s = []
+        try:
+            # Commits the datastore blobs.
+            for writer in writers:
+                sha256s.append(writer.commit(age))
+            manifests = self.retrieve_manifests(sha256s)
+            # Creates the files in the database, in a single transaction.
+            self.database.create_files(
+                project_name, version_name,
+                list(zip(file_names, sha256s)), age, manifests=manifests)
+        except Exception:
+            # Discards the blobs which were not committed, including the
+            # one which failed to, whose files may be gone already.
+            for writer in writers[len(sha256s):]:
+                try:
+                    writer.abort()
+                except FileNotFoundError:
+                    pass
+            # Queues the blobs for deletion if nothing references them.
+            if sha256s:
+                self.database.create_blobs(
+                    sha256s, self.retrieve_manifests(sha256s))
+            raise
+        self.invalidate()
+
+    # Imports a tree of project/version/file directories and files. The
+    # files are hashed by a pool of processes and stored as blobs sharing
+    # their data if possible, hard links included if allowed. The files of
+    # each version are created in batches, the version taking the
+    # timestamp of its most recent file. The existing files are skipped,
+    # so that an interrupted import may be run again.
+    # Returns the import statistics.
+    def import_tree(
+            self, root_dir, workers=None, batch_size=1000, link=True):
+        statistics = {
+            'files': 0,
+            'bytes': 0,
+            'existing': 0,
+            'reflink': 0,
+            'link': 0,
+            'copy': 0,
+            'skipped': 0}
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for project_name, version_name, files, timestamp in \
+                    scan_import_tree(root_dir, statistics):
+                # Skips the files of a previous import.
+                try:
+                    existing_names = set(
+                        file['name'] for file in
+                        self.database.retrieve_files(
+                            project_name, version_name))
+                except ts_db.DatabaseException:
+                    existing_names = set()
+                count = len(files)
+                files = [
+                    file for file in files
+                    if file[0] not in existing_names]
+                statistics['skipped'] += count - len(files)
+                # Stores the blobs as the files are hashed.
+                sha256s = executor.map(
+                    ts_ds.sha256_file,
+                    [file_path for file_name, file_path, size in files],
+                    chunksize=IMPORT_CHUNK_SIZE)
+                batch = []
+                for (file_name, file_path, size), sha256 in zip(
+                        files, sha256s):
+                    method = self.datastore.import_file(
+                        file_path, sha256, link)
+                    statistics[method] += 1
+                    statistics['bytes'] += size
+                    batch.append((file_name, sha256))
+                    if len(batch) >= batch_size:
+                        self.import_files(
+                            project_name, version_name, batch, timestamp,
+                            statistics)
+                        batch = []
+                if batch:
+                    self.import_files(
+                        project_name, version_name, batch, timestamp,
+                        statistics)
+        self.invalidate()
+        return statistics
+
+    # Creates a batch of imported files in a single transaction. Falls
+    # back to creating them one by one if some of them exist.
+    def import_files(
+            self, project_name, version_name, files, timestamp, statistics):
+        manifests = self.retrieve_manifests(
+            [sha256 for file_name, sha256 in files])
+        try:
+            self.database.create_files(
+                project_name, version_name, files, timestamp=timestamp,
+                manifests=manifests)
+            statistics['files'] += len(files)
+            return
+        except ts_db.DatabaseException:
+            pass
+        for file in files:
+            manifests = self.retrieve_manifests([file[1]])
+            try:
+                self.database.create_files(
+                    project_name, version_name, [file], timestamp=timestamp,
+                    manifests=manifests)
+                statistics['files'] += 1
+            except ts_db.DatabaseException:
+                # Queues the blob for deletion if nothing references it.
+                self.database.create_blob(file[1], manifests)
+                statistics['skipped'] += 1
 
     # Downloads a file.
     def download(self, project_name, version_name, file_name):
         # Retrieves the file SHA-256 hash from the database.
-        sha256 = self.database.retrieve_file_sha256(
-            project_name, version_name, file_name)
+        sha256 = self.lookup(project_name, version_name, file_name)
         # Returns a stream from the datastore blob.
-        stream = self.datastore.retrieve_blob(sha256)
-        return stream
+        return self.retrieve(sha256)
+
+    # Looks up the SHA-256 hash of a file.
+    def lookup(self, project_name, version_name, file_name):
+        return self.cached(
+            ('sha256', project_name, version_name, file_name),
+            self.database.retrieve_file_sha256,
+            project_name, version_name, file_name)
+
+    # Retrieves a blob from its SHA-256 hash. Returns a stream.
+    def retrieve(self, sha256):
+        return self.datastore.retrieve_blob(sha256)
+
+    # Opens a blob from its SHA-256 hash as stored. Returns a stream and
+    # the blob codec, None if the blob is not compressed.
+    def retrieve_stored(self, sha256):
+        return self.datastore.open_blob(sha256)
+
+    # Locates a blob from its SHA-256 hash. Returns its path relative
+    # to the datastore directory.
+    def locate(self, sha256):
+        return self.datastore.locate_blob(sha256)
 
     # Stars a version.
     def star_version(self, project_name, version_name):
         self.database.update_star(project_name, version_name, True)
+        self.invalidate()
 
     # Unstars a version.
     def unstar_version(self, project_name, version_name):
         self.database.update_star(project_name, version_name, False)
+        self.invalidate()
 
     # Cleans up the obsolete database versions
-    # and the unreferenced datastore blobs.
+    # and the blobs they were the last to reference.
+    # Returns the datastore cleanup statistics.
     def cleanup(self):
+        with ts_m.CLEANUP_SECONDS.time('queue'):
+            statistics = self.cleanup_queue()
+        count_cleanup(statistics)
+        return statistics
+
+    # Deletes the obsolete versions, then the blobs queued for deletion
+    # in the database. Returns the datastore cleanup statistics.
+    def cleanup_queue(self):
         # Deletes the obsolete versions from the database.
         self.database.delete_obsolete_versions(self.obsolete_age)
-        # Retrieves the list of remaining SHA-256 hashes.
-        sha256s = self.database.retrieve_sha256s()
+        self.invalidate()
         # Deletes the unreferenced blobs from the datastore.
-        self.datastore.delete_unreferenced_blobs(sha256s)
+        statistics = {
+            'scanned': 0,
+            'kept': 0,
+            'linked': 0,
+            'deleted': 0,
+            'bytes_freed': 0}
+        chunking = isinstance(self.datastore, ts_cs.ChunkedDatastore)
+        deleted_sha256s = []
+        manifests = []
+        rechecks = []
+        now = int(time.time())
+        for sha256 in self.database.retrieve_unreferenced_sha256s():
+            statistics['scanned'] += 1
+            # Reads the chunks of a manifest before deleting it.
+            if chunking:
+                try:
+                    chunk_sha256s = \
+                        self.datastore.retrieve_chunk_sha256s(sha256)
+                except ts_ds.DatastoreException:
+                    chunk_sha256s = []
+            outcome, freed_bytes = self.datastore.delete_blob(sha256)
+            statistics[outcome] += 1
+            statistics['bytes_freed'] += freed_bytes
+            if outcome == 'deleted':
+                deleted_sha256s.append(sha256)
+                if chunking:
+                    manifests.append((sha256, chunk_sha256s))
+            elif outcome == 'linked':
+                rechecks.append((sha256, now + random.randint(
+                    LINKED_BLOB_RECHECK_INTERVAL // 2,
+                    LINKED_BLOB_RECHECK_INTERVAL)))
+        # Removes the deleted blobs from the database queue, and
+        # unreferences their chunks. Defers the linked blobs.
+        self.database.delete_blobs(deleted_sha256s, manifests)
+        if rechecks:
+            self.database.defer_blobs(rechecks)
+        # Deletes the chunks no longer referenced by any manifest.
+        if chunking:
+            chunk_sha256s, freed_bytes = self.datastore.delete_chunks(
+                self.database.retrieve_unreferenced_chunk_sha256s())
+            statistics['bytes_freed'] += freed_bytes
+            self.database.delete_chunks(chunk_sha256s)
+        # Deletes the abandoned upload sessions.
+        statistics['bytes_freed'] += \
+            self.datastore.delete_stale_upload_sessions(UPLOAD_SESSION_AGE)
+        return statistics
+
+    # Cleans up the obsolete database versions and scans the whole
+    # datastore for unreferenced blobs, including the orphan blobs
+    # never registered in the database.
+    # Returns the datastore cleanup statistics.
+    def full_cleanup(self):
+        with ts_m.CLEANUP_SECONDS.time('full'):
+            # Deletes the blobs queued for deletion first if the datastore
+            # chunks the blobs, so that their chunks are unreferenced.
+            chunking = isinstance(self.datastore, ts_cs.ChunkedDatastore)
+            if chunking:
+                queue_statistics = self.cleanup_queue()
+            # Deletes the obsolete versions from the database.
+            self.database.delete_obsolete_versions(self.obsolete_age)
+            self.invalidate()
+            # Retrieves the set of remaining SHA-256 hashes.
+            sha256s = self.database.retrieve_sha256s()
+            # Deletes the unreferenced blobs from the datastore.
+            statistics = self.datastore.delete_unreferenced_blobs(sha256s)
+            if chunking:
+                for key, value in queue_statistics.items():
+                    statistics[key] += value
+            # Deletes the abandoned upload sessions.
+            statistics['bytes_freed'] += \
+                self.datastore.delete_stale_upload_sessions(
+                    UPLOAD_SESSION_AGE)
+        count_cleanup(statistics)
+        return statistics
+
+    # Verifies the integrity of the datastore blobs, and that the blobs
+    # referenced by the database exist. The reads are limited to a rate
+    # in bytes per second if specified. The corrupted blobs are moved to
+    # quarantine if requested.
+    # Returns the scrubbing statistics, with the missing blobs hashes.
+    def scrub(self, workers=4, rate=None, quarantine=False):
+        statistics = self.datastore.scrub(workers, rate, quarantine)
+        statistics['missing'] = [
+            sha256 for sha256 in sorted(self.database.retrieve_sha256s())
+            if not self.datastore.has_blob(sha256)]
+        return statistics
+
+    # Upgrades the database schema of an existing installation. Counts
+    # the chunks references of the existing manifests in batches, if the
+    # datastore chunks the blobs. The manifests already counted are
+    # skipped.
+    def upgrade(self, batch_size=1000):
+        self.database.migrate()
+        if not isinstance(self.datastore, ts_cs.ChunkedDatastore):
+            return
+        manifests = []
+        for manifest in self.datastore.scan_manifests():
+            manifests.append(manifest)
+            if len(manifests) >= batch_size:
+                self.database.create_manifests(manifests)
+                manifests = []
+        if manifests:
+            self.database.create_manifests(manifests)
+
+    # Moves the datastore blobs to the configured fan-out layout.
+    def migrate_datastore(self):
+        return self.datastore.migrate()
+
+# Lists the versions of a project/version/file import tree. Yields the
+# project and version names, the (name, path, size) of their files, and
+# the timestamp of their most recent file. Counts the entries with invalid
+# names, out of place, or which are not regular files, as skipped.
+def scan_import_tree(root_dir, statistics):
+    def list_dir(dir_path):
+        with os.scandir(dir_path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            try:
+                ts_db.validate_name(entry.name)
+            except ts_db.DatabaseException:
+                statistics['skipped'] += 1
+                continue
+            yield entry
+    for project_entry in list_dir(root_dir):
+        if not project_entry.is_dir(follow_symlinks=False):
+            statistics['skipped'] += 1
+            continue
+        for version_entry in list_dir(project_entry.path):
+            if not version_entry.is_dir(follow_symlinks=False):
+                statistics['skipped'] += 1
+                continue
+            files = []
+            timestamp = 0
+            for file_entry in list_dir(version_entry.path):
+                if not file_entry.is_file(follow_symlinks=False):
+                    statistics['skipped'] += 1
+                    continue
+                stat = file_entry.stat(follow_symlinks=False)
+                files.append((file_entry.name, file_entry.path, stat.st_size))
+                timestamp = max(timestamp, int(stat.st_mtime))
+            if files:
+                yield project_entry.name, version_entry.name, files, timestamp
+
+# Adds the statistics of a cleanup to the metrics.
+def count_cleanup(statistics):
+    ts_m.CLEANUP_BLOBS.inc('kept', amount=statistics['kept'])
+    ts_m.CLEANUP_BLOBS.inc('linked', amount=statistics['linked'])
+    ts_m.CLEANUP_BLOBS.inc('deleted', amount=statistics['deleted'])
+    ts_m.CLEANUP_FREED_BYTES.inc(amount=statistics['bytes_freed'])
 
 # Formats nicely the time until expiry.
 def format_expiry(expiry):
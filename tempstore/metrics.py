@@ -0,0 +1,357 @@
+import contextlib
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+# Default histogram buckets, in seconds.
+BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf]
+
+# Minimum interval in seconds between the writes of the values of a
+# process to the multiprocess directory.
+FLUSH_INTERVAL = 1
+
+# Name of the file of the multiprocess directory holding the values of the
+# terminated processes, summed.
+DEAD_FILE_NAME = 'metrics-dead.json'
+
+# Name of the file of the multiprocess directory locked while collecting
+# the values.
+LOCK_FILE_NAME = 'metrics.lock'
+
+# Counts events, or sums amounts.
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, label_names):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+
+    # Adds an amount to the counter with the specified label values.
+    def inc(self, *labels, amount=1):
+        with self.registry.lock:
+            self.registry.check_fork()
+            key = (self.name, labels)
+            values = self.registry.values
+            values[key] = values.get(key, 0) + amount
+            self.registry.dirty = True
+
+# Counts observations in buckets, e.g.: of durations.
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, label_names, buckets=BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+
+    # Records an observation with the specified label values. The values
+    # are the count of each bucket, the sum, and the count.
+    def observe(self, amount, *labels):
+        with self.registry.lock:
+            self.registry.check_fork()
+            key = (self.name, labels)
+            values = self.registry.values.get(key)
+            if values is None:
+                values = self.registry.values[key] = self.zero()
+            for i, bucket in enumerate(self.buckets):
+                if amount <= bucket:
+                    values[i] += 1
+                    break
+            values[-2] += amount
+            values[-1] += 1
+            self.registry.dirty = True
+
+    # Records the duration of a block of code.
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, *labels)
+
+    # Returns the empty values of a labels combination.
+    def zero(self):
+        return [0] * len(self.buckets) + [0, 0]
+
+# Holds the metrics and the values of the current process. If a
+# multiprocess directory is configured, each process writes its values to
+# its own file there, and the values of all the processes are summed
+# when exposed. The files of the terminated processes are then merged
+# into a single file, so that the counters never decrease and the
+# directory does not grow with the processes restarts.
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.values = {}
+        self.dirty = False
+        self.multiprocess_dir = None
+        self.pid = os.getpid()
+        self.file_name = 'metrics-%d-%s.json' % (
+            self.pid, uuid.uuid4().hex)
+        self.flush_time = None
+
+    # Writes the values of the processes to a directory, created on the
+    # first write.
+    def configure(self, multiprocess_dir):
+        self.multiprocess_dir = multiprocess_dir
+
+    # Declares a counter.
+    def counter(self, name, help, label_names=()):
+        metric = Counter(self, name, help, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    # Declares a histogram.
+    def histogram(self, name, help, label_names=(), buckets=BUCKETS):
+        metric = Histogram(self, name, help, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # Starts over in a forked process, which has its own file, without
+    # the values of its parent. Called with the lock held.
+    def check_fork(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.file_name = 'metrics-%d-%s.json' % (
+                self.pid, uuid.uuid4().hex)
+            self.values = {}
+            self.dirty = False
+            self.flush_time = None
+
+    # Writes the values of the current process to its file, at most once
+    # per interval unless forced.
+    def flush(self, force=False):
+        if self.multiprocess_dir is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.check_fork()
+            if not self.dirty:
+                return
+            if not force and self.flush_time is not None and \
+                    now - self.flush_time < FLUSH_INTERVAL:
+                return
+            self.flush_time = now
+            self.dirty = False
+            values = [
+                [name, list(labels), value]
+                for (name, labels), value in self.values.items()]
+            # Writes the file atomically.
+            os.makedirs(self.multiprocess_dir, exist_ok=True)
+            file_path = os.path.join(self.multiprocess_dir, self.file_name)
+            with open(file_path + '-temp', 'w') as f:
+                json.dump(values, f)
+            os.replace(file_path + '-temp', file_path)
+
+    # Returns the values of all the processes, summed by metric and
+    # labels.
+    def collect(self):
+        if self.multiprocess_dir is None:
+            with self.lock:
+                return {
+                    key: list(value) if isinstance(value, list) else value
+                    for key, value in self.values.items()}
+        self.flush(force=True)
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        lock_path = os.path.join(self.multiprocess_dir, LOCK_FILE_NAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return self.collect_files()
+
+    # Returns the values of the files of the multiprocess directory,
+    # summed, after merging the files of the terminated processes into
+    # the dead file. The dead file lists the files merged, so that they
+    # are not counted again if they are not deleted. Called with the
+    # directory locked.
+    def collect_files(self):
+        dead_path = os.path.join(self.multiprocess_dir, DEAD_FILE_NAME)
+        try:
+            with open(dead_path) as f:
+                dead = json.load(f)
+        except FileNotFoundError:
+            dead = {'merged': [], 'values': []}
+        merged = set(dead['merged'])
+        dead_values = {}
+        add_values(dead_values, dead['values'])
+        values = {}
+        dead_file_names = []
+        for file_name in os.listdir(self.multiprocess_dir):
+            pid = parse_file_pid(file_name)
+            if pid is None:
+                continue
+            # Deletes the temporary files of the terminated processes.
+            if not file_name.endswith('.json'):
+                if not is_alive(pid):
+                    delete_file(self.multiprocess_dir, file_name)
+                continue
+            if file_name in merged:
+                dead_file_names.append(file_name)
+                continue
+            try:
+                with open(os.path.join(
+                        self.multiprocess_dir, file_name)) as f:
+                    file_values = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if is_alive(pid):
+                add_values(values, file_values)
+            else:
+                add_values(dead_values, file_values)
+                dead_file_names.append(file_name)
+        # Merges the files of the terminated processes.
+        if dead_file_names:
+            dead = {
+                'merged': dead_file_names,
+                'values': [
+                    [name, list(labels), value]
+                    for (name, labels), value in dead_values.items()]}
+            with open(dead_path + '-temp', 'w') as f:
+                json.dump(dead, f)
+            os.replace(dead_path + '-temp', dead_path)
+            for file_name in dead_file_names:
+                delete_file(self.multiprocess_dir, file_name)
+        add_values(values, [
+            [name, labels, value]
+            for (name, labels), value in dead_values.items()])
+        return values
+
+    # Returns the values of all the processes in the Prometheus text
+    # exposition format.
+    def expose(self):
+        values = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for (name, labels), value in sorted(values.items()):
+                if name != metric.name:
+                    continue
+                pairs = list(zip(metric.label_names, labels))
+                if metric.kind == 'counter':
+                    lines.append('%s%s %s' % (
+                        name, format_labels(pairs), format_value(value)))
+                    continue
+                cumulative = 0
+                for bucket, count in zip(metric.buckets, value):
+                    cumulative += count
+                    le = '+Inf' if bucket == math.inf else repr(bucket)
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(pairs + [('le', le)]),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, format_labels(pairs), format_value(value[-2])))
+                lines.append('%s_count%s %d' % (
+                    name, format_labels(pairs), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+# Adds the values of a file ([name, labels, value] lists) to values
+# summed by metric and labels.
+def add_values(values, file_values):
+    for name, labels, value in file_values:
+        key = (name, tuple(labels))
+        if isinstance(value, list):
+            total = values.setdefault(key, [0] * len(value))
+            for i, amount in enumerate(value):
+                total[i] += amount
+        else:
+            values[key] = values.get(key, 0) + value
+
+# Returns the process ID of the file of a process, including its
+# temporary file, or None if the file is not one of a process.
+def parse_file_pid(file_name):
+    parts = file_name.split('-')
+    if len(parts) < 3 or parts[0] != 'metrics' or not parts[1].isdigit():
+        return None
+    return int(parts[1])
+
+# Checks whether a process is running.
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Deletes a file of a directory, if it exists.
+def delete_file(directory, file_name):
+    try:
+        os.unlink(os.path.join(directory, file_name))
+    except FileNotFoundError:
+        pass
+
+# Formats labels, escaping their values.
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value)
+            .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+# Formats a value, without decimals if it is an integer.
+def format_value(value):
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+# Registry of the tempstore metrics.
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'tempstore_http_requests_total',
+    'HTTP requests by endpoint and status.',
+    ['endpoint', 'status'])
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'tempstore_http_request_duration_seconds',
+    'Time to handle the HTTP requests by endpoint, body excluded.',
+    ['endpoint'])
+DATABASE_SECONDS = REGISTRY.histogram(
+    'tempstore_database_duration_seconds',
+    'Time spent in the database methods.',
+    ['method'])
+DATABASE_BUSY = REGISTRY.counter(
+    'tempstore_database_busy_total',
+    'Attempts to start a database write transaction which found the '
+    'database locked, by method.',
+    ['method'])
+DATASTORE_WRITTEN_BYTES = REGISTRY.counter(
+    'tempstore_datastore_written_bytes_total',
+    'Bytes written to the datastore.')
+DATASTORE_READ_BYTES = REGISTRY.counter(
+    'tempstore_datastore_read_bytes_total',
+    'Bytes read from the datastore to pass the blobs to the clients.')
+DATASTORE_DEDUP_BYTES = REGISTRY.counter(
+    'tempstore_datastore_dedup_bytes_total',
+    'Bytes of the blobs which already existed when created.')
+DATASTORE_FSYNC_SECONDS = REGISTRY.histogram(
+    'tempstore_datastore_fsync_duration_seconds',
+    'Time to flush the datastore files to disk.')
+CLEANUP_BLOBS = REGISTRY.counter(
+    'tempstore_cleanup_blobs_total',
+    'Blobs visited by the cleanups, by outcome.',
+    ['outcome'])
+CLEANUP_FREED_BYTES = REGISTRY.counter(
+    'tempstore_cleanup_freed_bytes_total',
+    'Bytes freed by the cleanups.')
+CLEANUP_SECONDS = REGISTRY.histogram(
+    'tempstore_cleanup_duration_seconds',
+    'Time to run the cleanups.',
+    ['kind'],
+    [1, 10, 60, 300, 900, 3600, math.inf])
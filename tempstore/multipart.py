@@ -0,0 +1,122 @@
+import re
+
+# Maximum size of the headers of a part.
+MAX_HEADERS_SIZE = 16384
+
+# Events returned by the parser.
+PART_BEGIN = 'part_begin'
+PART_DATA = 'part_data'
+PART_END = 'part_end'
+
+# Parser states.
+STATE_PREAMBLE = 'preamble'
+STATE_DELIMITER = 'delimiter'
+STATE_HEADERS = 'headers'
+STATE_BODY = 'body'
+STATE_EPILOGUE = 'epilogue'
+
+class MultipartException(Exception):
+    pass
+
+# Parses a header value with options, e.g.: 'form-data; name="upload"'.
+# Returns the value and a dictionary of options with lowercase names.
+def parse_options_header(header):
+    value, _, rest = header.partition(';')
+    options = {}
+    option_regex = re.compile(
+        r'\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)\s*;?')
+    for name, option in option_regex.findall(rest):
+        if option.startswith('"'):
+            option = re.sub(r'\\(.)', r'\1', option[1:-1])
+        options[name.lower()] = option.strip()
+    return value.strip().lower(), options
+
+# Incremental multipart/form-data parser. The body is fed by chunks of
+# any size, the parser returns events as soon as it can. The memory
+# usage is bounded, the parts data is never accumulated.
+class MultipartParser:
+
+    def __init__(self, boundary):
+        if not boundary:
+            raise MultipartException('Missing boundary')
+        self.delimiter = b'--' + boundary.encode('latin-1')
+        self.state = STATE_PREAMBLE
+        self.buffer = b''
+
+    # Feeds a chunk of the body. Returns a list of events:
+    # (PART_BEGIN, headers), (PART_DATA, bytes), and (PART_END, None).
+    # The headers are a dictionary with lowercase names.
+    def feed(self, data):
+        self.buffer += data
+        events = []
+        while self.parse(events):
+            pass
+        return events
+
+    # Checks that the whole body was parsed.
+    def close(self):
+        if self.state != STATE_EPILOGUE:
+            raise MultipartException('Truncated body')
+
+    # Parses the buffer as far as possible. Appends the events to a list.
+    # Returns whether the parsing can continue with the current buffer.
+    def parse(self, events):
+        if self.state == STATE_PREAMBLE:
+            # The first delimiter may not follow a line break.
+            index = self.buffer.find(self.delimiter)
+            if index < 0:
+                # Keeps the end of the buffer, it may start the delimiter.
+                self.buffer = self.buffer[-len(self.delimiter):]
+                return False
+            self.buffer = self.buffer[index + len(self.delimiter):]
+            self.state = STATE_DELIMITER
+            return True
+        if self.state == STATE_DELIMITER:
+            # The delimiter is followed by a line break, or by two dashes
+            # for the last one.
+            if len(self.buffer) < 2:
+                return False
+            if self.buffer.startswith(b'--'):
+                self.buffer = b''
+                self.state = STATE_EPILOGUE
+                return False
+            if not self.buffer.startswith(b'\r\n'):
+                raise MultipartException('Invalid delimiter')
+            self.buffer = self.buffer[2:]
+            self.state = STATE_HEADERS
+            return True
+        if self.state == STATE_HEADERS:
+            index = self.buffer.find(b'\r\n\r\n')
+            if index < 0:
+                if len(self.buffer) > MAX_HEADERS_SIZE:
+                    raise MultipartException('Headers too large')
+                return False
+            headers = {}
+            for line in self.buffer[:index].decode('utf-8').split('\r\n'):
+                name, separator, value = line.partition(':')
+                if not separator:
+                    raise MultipartException('Invalid header')
+                headers[name.strip().lower()] = value.strip()
+            self.buffer = self.buffer[index + 4:]
+            self.state = STATE_BODY
+            events.append((PART_BEGIN, headers))
+            return True
+        if self.state == STATE_BODY:
+            delimiter = b'\r\n' + self.delimiter
+            index = self.buffer.find(delimiter)
+            if index < 0:
+                # Passes the data which cannot start the delimiter.
+                size = len(self.buffer) - len(delimiter) + 1
+                if size > 0:
+                    events.append((PART_DATA, self.buffer[:size]))
+                    self.buffer = self.buffer[size:]
+                return False
+            if index > 0:
+                events.append((PART_DATA, self.buffer[:index]))
+            events.append((PART_END, None))
+            self.buffer = self.buffer[index + len(delimiter):]
+            self.state = STATE_DELIMITER
+            return True
+        # Ignores the epilogue.
+        self.buffer = b''
+        return False
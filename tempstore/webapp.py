@@ -1,4 +1,9 @@
+import tempstore.cache as ts_c
+import tempstore.database as ts_db
+import tempstore.datastore as ts_ds
 import tempstore.engine as ts_e
+import tempstore.metrics as ts_m
+import tempstore.multipart as ts_mp
 
 import werkzeug.exceptions
 import werkzeug.routing
@@ -6,21 +11,202 @@ import werkzeug.utils
 import werkzeug.wrappers
 import werkzeug.wsgi
 
+import hashlib
 import jinja2
+import json
+import os
+import time
 import traceback
+import uuid
+import zipfile
+
+BUFFER_SIZE = 65536
+
+# Maximum size of the value of a form field.
+MAX_FIELD_SIZE = 4096
+
+# Maximum number of ranges served for a single request. Requests with more
+# ranges are served the whole file.
+MAX_RANGES = 16
+
+# Date of all the archive entries, the earliest a zip file supports, so
+# that the archive of a version is always the same.
+ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Counts and times a request, then writes the metrics of the process if
+# due.
+def record_request(endpoint, status, start_time):
+    ts_m.HTTP_REQUEST_SECONDS.observe(
+        time.monotonic() - start_time, endpoint)
+    ts_m.HTTP_REQUESTS.inc(endpoint, str(status))
+    ts_m.REGISTRY.flush()
+
+# Resolves the ranges of a Range header against a content length.
+# Returns a list of (start, stop) tuples, stop excluded. The list is empty
+# if no range is satisfiable, None if the header should be ignored.
+def resolve_ranges(range_header, length):
+    if range_header is None or range_header.units != 'bytes':
+        return None
+    if len(range_header.ranges) > MAX_RANGES:
+        return None
+    ranges = []
+    for start, stop in range_header.ranges:
+        # Converts the suffix and open-ended ranges.
+        if start < 0:
+            start = max(length + start, 0)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        # Ignores the unsatisfiable ranges.
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+# Yields the bytes of a stream between two offsets, stop excluded.
+def iterate_range(stream, start, stop):
+    stream.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        buffer = stream.read(min(BUFFER_SIZE, remaining))
+        if not buffer:
+            break
+        remaining -= len(buffer)
+        ts_m.DATASTORE_READ_BYTES.inc(amount=len(buffer))
+        yield buffer
+
+# Yields the parts of a multipart/byteranges body, then closes the stream.
+def iterate_ranges(stream, ranges, length, boundary):
+    try:
+        for start, stop in ranges:
+            yield multipart_range_header(start, stop, length, boundary)
+            yield from iterate_range(stream, start, stop)
+            yield b'\r\n'
+        yield ('--%s--\r\n' % boundary).encode()
+    finally:
+        stream.close()
+
+# Returns the header of a part of a multipart/byteranges body.
+def multipart_range_header(start, stop, length, boundary):
+    return (
+        '--%s\r\n'
+        'Content-Type: application/octet-stream\r\n'
+        'Content-Range: bytes %d-%d/%d\r\n'
+        '\r\n' % (boundary, start, stop - 1, length)).encode()
+
+# Yields the bytes of a single range, then closes the stream.
+def iterate_single_range(stream, start, stop):
+    try:
+        yield from iterate_range(stream, start, stop)
+    finally:
+        stream.close()
+
+# Reads a blob stream, counting the bytes read as they are passed to the
+# client.
+class CountedStream:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        buffer = self.stream.read(size)
+        ts_m.DATASTORE_READ_BYTES.inc(amount=len(buffer))
+        return buffer
+
+    def close(self):
+        self.stream.close()
+
+# Collects the data written by a zip file until passed to the client.
+# Has no position, so that the zip file writes the entries sizes after
+# their data and never seeks.
+class ArchiveBuffer:
+
+    def __init__(self):
+        self.buffers = []
+
+    def write(self, buffer):
+        self.buffers.append(bytes(buffer))
+        return len(buffer)
+
+    def flush(self):
+        pass
+
+    # Returns the data written so far, and forgets it.
+    def drain(self):
+        data = b''.join(self.buffers)
+        self.buffers = []
+        return data
+
+# Yields a zip archive of files (name, sha256), built as the blobs are
+# read. The entries are stored uncompressed, in the order of the files,
+# with the same date and permissions.
+def iterate_archive(engine, files):
+    buffer = ArchiveBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for file_name, sha256 in files:
+            info = zipfile.ZipInfo(file_name, ARCHIVE_DATE_TIME)
+            info.create_system = 3
+            info.external_attr = 0o644 << 16
+            with engine.retrieve(sha256) as stream, \
+                    archive.open(info, 'w', force_zip64=True) as entry:
+                for data in iter(lambda: stream.read(BUFFER_SIZE), b''):
+                    ts_m.DATASTORE_READ_BYTES.inc(amount=len(data))
+                    entry.write(data)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+# Returns the strong ETag of the archive of files (name, sha256), which
+# only depends on the files.
+def archive_etag(files):
+    digest = hashlib.sha256(b'zip\n')
+    for file_name, sha256 in files:
+        digest.update(('%s %s\n' % (file_name, sha256)).encode())
+    return digest.hexdigest()
 
 # Base class for WSGI apps.
+# The templates are compiled at startup. Their bytecode is cached on disk
+# if a directory is specified, so that the workers do not compile them
+# again after a restart.
+# The pages endpoints get a weak ETag from the data generation, and their
+# responses are cached if a cache size is specified. The ETag also changes
+# with the time period, for the pages showing relative times.
+# The metrics are shared with the other processes through a directory if
+# specified.
 class BaseApp:
 
-    def __init__(self, base_url):
+    def __init__(
+            self, base_url, bytecode_cache_dir=None,
+            page_cache_size=0, page_cache_period=60, metrics_dir=None):
         # Initializes the base URL.
         self.base_url = base_url
+        # Initializes the metrics directory.
+        if metrics_dir is not None:
+            ts_m.REGISTRY.configure(metrics_dir)
         # Initializes the Jinja2 environment.
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(
+                bytecode_cache_dir)
         self.jinja2_environment = jinja2.Environment(
             trim_blocks=True,
-            loader=jinja2.FileSystemLoader('views'))
-        # Initializes the URL map.
-        self.url_map = werkzeug.routing.Map([])
+            loader=jinja2.FileSystemLoader('views'),
+            bytecode_cache=bytecode_cache)
+        # Compiles the templates.
+        self.templates = {
+            template_file: self.jinja2_environment.get_template(
+                template_file)
+            for template_file in self.jinja2_environment.list_templates()}
+        # Initializes the pages cache.
+        self.page_cache = ts_c.LruCache(page_cache_size)
+        self.page_cache_period = page_cache_period
+        self.page_endpoints = set()
+        # Initializes the URL map with the metrics route.
+        self.url_map = werkzeug.routing.Map([
+            werkzeug.routing.Rule(
+                '/metrics',
+                methods=['GET'],
+                endpoint='metrics')])
 
     # WSGI entry point.
     def __call__(self, environ, start_response):
@@ -29,22 +215,69 @@ class BaseApp:
         return response(environ, start_response)
 
     # Routes the requests according to the URL map.
+    # Counts and times the requests by endpoint, the body excluded.
     def route(self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
+        endpoint = 'unknown'
+        start_time = time.monotonic()
         try:
             endpoint, values = adapter.match()
-            return getattr(self, endpoint)(request, **values)
+            if endpoint in self.page_endpoints:
+                response = self.route_page(request, endpoint, values)
+            else:
+                response = getattr(self, endpoint)(request, **values)
         # Catches routing exceptions.
         except werkzeug.exceptions.NotFound:
-            return werkzeug.wrappers.Response(status=404)
+            response = werkzeug.wrappers.Response(status=404)
         # Catches other exceptions.
         except Exception as e:
             traceback.print_exc()
-            return werkzeug.wrappers.Response(status=500)
+            response = werkzeug.wrappers.Response(status=500)
+        record_request(endpoint, response.status_code, start_time)
+        return response
+
+    # Metrics URL.
+    # Returns the metrics of all the processes in the Prometheus text
+    # format.
+    def metrics(self, request):
+        return werkzeug.wrappers.Response(
+            ts_m.REGISTRY.expose(),
+            mimetype='text/plain; version=0.0.4')
+
+    # Returns the generation of the data shown in the pages, or None if
+    # unknown. Meant to be overridden.
+    def page_generation(self):
+        return None
+
+    # Routes the requests to a page endpoint. Not modified if the client
+    # has the page of the current generation and period, otherwise
+    # serves the page from the cache if possible.
+    def route_page(self, request, endpoint, values):
+        generation = self.page_generation()
+        if generation is None:
+            return getattr(self, endpoint)(request, **values)
+        period = int(time.time()) // self.page_cache_period
+        etag = '%s-%d' % (generation, period)
+        headers = {'ETag': 'W/"%s"' % etag, 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains_weak(etag):
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+        key = (request.path, request.query_string, etag)
+        body = self.page_cache.get(key)
+        if body is None:
+            epoch = self.page_cache.epoch
+            response = getattr(self, endpoint)(request, **values)
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            self.page_cache.put(key, body, epoch)
+        return werkzeug.wrappers.Response(
+            body, mimetype='text/html', headers=headers)
 
     # Returns a response instantiated from a template and parameters.
     def response_template(self, template_file, **kwargs):
-        template = self.jinja2_environment.get_template(template_file)
+        template = self.templates.get(template_file)
+        if template is None:
+            template = self.jinja2_environment.get_template(template_file)
         kwargs['base_url'] = self.base_url
         return werkzeug.wrappers.Response(
             template.render(**kwargs), mimetype='text/html')
@@ -53,13 +286,208 @@ class BaseApp:
     def response_redirect(self, url):
         return werkzeug.utils.redirect(self.base_url + url)
 
+# Serves the downloads from the app. Uses the server wsgi.file_wrapper
+# if any, e.g.: gunicorn sends the files with sendfile.
+DOWNLOAD_DIRECT = 'direct'
+# Offloads the downloads to nginx with an X-Accel-Redirect header to
+# an internal location serving the datastore directory.
+DOWNLOAD_X_ACCEL_REDIRECT = 'x-accel-redirect'
+# Offloads the downloads to the front server with an X-Sendfile header
+# holding the absolute path of the blob.
+DOWNLOAD_X_SENDFILE = 'x-sendfile'
+
+# Passes a request body to a body consumer as it is read.
+# Returns the consumer response.
+def consume_body(stream, consumer):
+    try:
+        for buffer in iter(lambda: stream.read(BUFFER_SIZE), b''):
+            consumer.feed(buffer)
+        return consumer.finish()
+    except Exception:
+        consumer.abort()
+        raise
+
+# Returns whether the body of a request is readable as a whole. Without a
+# Content-Length, e.g.: a chunked body, the WSGI server passes the body
+# only if it marks the input as terminated, otherwise it reads as empty.
+def has_readable_body(request):
+    return request.content_length is not None or \
+        bool(request.environ.get('wsgi.input_terminated'))
+
+# Consumes a multipart/form-data upload body as it is received. Writes
+# the 'upload' file part straight into a datastore blob while hashing
+# it. The 'project' and 'version' parts are the form fields. In batch
+# mode, accepts several 'upload' file parts and creates all or none of
+# the files.
+class MultipartUpload:
+
+    def __init__(self, engine, boundary, response, batch=False):
+        self.engine = engine
+        self.parser = ts_mp.MultipartParser(boundary)
+        self.response = response
+        self.batch = batch
+        self.fields = {}
+        self.field_name = None
+        self.files = []
+        self.writer = None
+
+    # Feeds a chunk of the body.
+    def feed(self, buffer):
+        for event, value in self.parser.feed(buffer):
+            if event == ts_mp.PART_BEGIN:
+                self.begin_part(value)
+            elif event == ts_mp.PART_DATA:
+                self.write_part(value)
+            elif event == ts_mp.PART_END:
+                self.field_name = None
+                self.writer = None
+
+    # Starts a form field or the file.
+    def begin_part(self, headers):
+        disposition, options = ts_mp.parse_options_header(
+            headers.get('content-disposition', ''))
+        name = options.get('name')
+        if 'filename' in options:
+            if name != 'upload' or (self.files and not self.batch):
+                raise ts_mp.MultipartException('Unexpected file')
+            self.writer = self.engine.create_blob_writer()
+            self.files.append((options['filename'], self.writer))
+        elif name is not None:
+            self.field_name = name
+            self.fields[name] = b''
+
+    # Writes data to the current form field or file.
+    def write_part(self, buffer):
+        if self.field_name is not None:
+            value = self.fields[self.field_name] + buffer
+            if len(value) > MAX_FIELD_SIZE:
+                raise ts_mp.MultipartException('Field too large')
+            self.fields[self.field_name] = value
+        elif self.writer is not None:
+            self.writer.write(buffer)
+
+    # Completes the upload. Returns the response.
+    def finish(self):
+        self.parser.close()
+        if not self.files:
+            raise ts_mp.MultipartException('Missing file')
+        files = self.files
+        self.files = []
+        self.engine.commit_uploads(
+            self.fields.get('project', b'').decode('utf-8'),
+            self.fields.get('version', b'').decode('utf-8'),
+            files)
+        return self.response
+
+    # Discards the upload.
+    def abort(self):
+        for file_name, writer in self.files:
+            writer.abort()
+        self.files = []
+
+# Consumes a raw upload body as it is received. Writes it straight into
+# a datastore blob while hashing it.
+class RawUpload:
+
+    def __init__(
+            self, engine, project_name, version_name, file_name, response):
+        self.engine = engine
+        self.project_name = project_name
+        self.version_name = version_name
+        self.file_name = file_name
+        self.response = response
+        self.writer = engine.create_blob_writer()
+
+    # Feeds a chunk of the body.
+    def feed(self, buffer):
+        self.writer.write(buffer)
+
+    # Completes the upload. Returns the response.
+    def finish(self):
+        writer = self.writer
+        self.writer = None
+        self.engine.commit_upload(
+            self.project_name, self.version_name, self.file_name, writer)
+        return self.response
+
+    # Discards the upload.
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+# Consumes the body of a resumable upload request as it is received.
+# Appends it to the upload session data at the offset of the request.
+# The data received is kept if the request is interrupted, the client
+# resumes from the offset of the session.
+class UploadSessionAppend:
+
+    def __init__(self, engine, session_id, offset):
+        self.session = None
+        self.status = 204
+        try:
+            session = engine.open_upload_session(session_id)
+        except ts_ds.DatastoreException:
+            self.status = 404
+            return
+        # Conflicts if the session is held by another request, or if the
+        # client missed the offset.
+        if offset is None or not session.begin(offset):
+            self.status = 409
+            self.offset = session.retrieve_offset()
+            return
+        self.session = session
+
+    # Feeds a chunk of the body.
+    def feed(self, buffer):
+        if self.session is not None:
+            self.session.write(buffer)
+
+    # Completes the request. Returns the response, with the new offset.
+    def finish(self):
+        if self.session is not None:
+            self.offset = self.session.end()
+            self.session = None
+        if self.status == 404:
+            return werkzeug.wrappers.Response(status=404)
+        return werkzeug.wrappers.Response(
+            status=self.status,
+            headers={'Upload-Offset': str(self.offset)})
+
+    # Keeps the data received so far.
+    def abort(self):
+        if self.session is not None:
+            self.session.end()
+            self.session = None
+
 class App(BaseApp):
 
-    def __init__(self, engine, base_url):
+    # The offload location is the internal URL prefix mapped to the
+    # datastore directory with X-Accel-Redirect, or the datastore
+    # directory itself with X-Sendfile.
+    def __init__(
+            self, engine, base_url,
+            download_mode=DOWNLOAD_DIRECT, offload_location=None,
+            page_size=100, bytecode_cache_dir=None, page_cache_size=0,
+            metrics_dir=None):
         # Calls the parent constructor.
-        BaseApp.__init__(self, base_url)
+        BaseApp.__init__(
+            self, base_url, bytecode_cache_dir, page_cache_size,
+            metrics_dir=metrics_dir)
         # Initializes the engine.
         self.engine = engine
+        # Initializes the number of items per page.
+        self.page_size = page_size
+        # Initializes the download mode.
+        if download_mode not in (
+                DOWNLOAD_DIRECT,
+                DOWNLOAD_X_ACCEL_REDIRECT,
+                DOWNLOAD_X_SENDFILE):
+            raise ValueError('Invalid download mode')
+        self.download_mode = download_mode
+        if offload_location is None:
+            offload_location = os.path.abspath(engine.datastore.data_dir)
+        self.offload_location = offload_location
         # Adds the common routes to the URL map.
         self.url_map.add(werkzeug.routing.Rule(
             '/',
@@ -73,10 +501,22 @@ class App(BaseApp):
             '/version/<project_name>/<version_name>',
             methods=['GET'],
             endpoint='version'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/search',
+            methods=['GET'],
+            endpoint='search'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/api/search',
+            methods=['GET'],
+            endpoint='search_api'))
         self.url_map.add(werkzeug.routing.Rule(
             '/download/<project_name>/<version_name>/<file_name>',
             methods=['GET'],
             endpoint='download'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/archive/<project_name>/<version_name>.zip',
+            methods=['GET'],
+            endpoint='archive'))
         self.url_map.add(werkzeug.routing.Rule(
             '/admin/star/<project_name>/<version_name>',
             methods=['GET'],
@@ -89,46 +529,275 @@ class App(BaseApp):
             '/upload',
             methods=['POST'],
             endpoint='upload'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload/<project_name>/<version_name>/<file_name>',
+            methods=['PUT'],
+            endpoint='upload_raw'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-batch',
+            methods=['POST'],
+            endpoint='upload_batch'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-session/<project_name>/<version_name>/<file_name>',
+            methods=['POST'],
+            endpoint='create_upload_session'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-session/<session_id>',
+            methods=['GET'],
+            endpoint='upload_session_offset'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-session/<session_id>',
+            methods=['PATCH'],
+            endpoint='append_upload_session'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-session/<session_id>/commit',
+            methods=['POST'],
+            endpoint='commit_upload_session'))
+        self.url_map.add(werkzeug.routing.Rule(
+            '/upload-session/<session_id>',
+            methods=['DELETE'],
+            endpoint='abort_upload_session'))
+        # Endpoints consuming the request body as it is received, mapped
+        # to the methods creating their body consumers.
+        self.streaming_endpoints = {
+            'upload': self.create_multipart_upload,
+            'upload_raw': self.create_raw_upload,
+            'upload_batch': self.create_batch_upload,
+            'append_upload_session': self.create_upload_session_append}
+        # Endpoints showing the data as pages.
+        self.page_endpoints = {'index', 'project', 'version', 'search'}
+
+    # Returns the generation of the projects, versions, and files.
+    def page_generation(self):
+        return self.engine.current_generation()
 
     # Home page.
-    # Shows the projects list.
+    # Shows a page of the projects list.
     def index(self, request):
-        projects = self.engine.list_projects()
+        projects = self.engine.list_projects(
+            request.args.get('after'), self.page_size + 1)
+        projects, after = self.paginate(projects, 'name')
         return self.response_template(
             template_file='index.html',
-            projects=projects)
+            projects=projects,
+            after=after)
 
     # Project page.
-    # Shows the project versions.
+    # Shows a page of the project versions.
     def project(self, request, project_name):
-        versions = self.engine.list_versions(project_name)
+        versions = self.engine.list_versions(
+            project_name, request.args.get('after'), self.page_size + 1)
+        versions, after = self.paginate(versions, 'cursor')
         return self.response_template(
             template_file='project.html',
             project=project_name,
-            versions=versions)
+            versions=versions,
+            after=after)
 
     # Version page.
-    # Shows the version files.
+    # Shows a page of the version files.
     def version(self, request, project_name, version_name):
-        files = self.engine.list_files(project_name, version_name)
+        files = self.engine.list_files(
+            project_name, version_name,
+            request.args.get('after'), self.page_size + 1)
+        files, after = self.paginate(files, 'name')
         return self.response_template(
             template_file='version.html',
             project=project_name,
             version=version_name,
-            files=files)
+            files=files,
+            after=after)
+
+    # Search page.
+    # Shows a page of the projects, versions, or files whose name contains
+    # the query, if any.
+    def search(self, request):
+        kind = request.args.get('kind', 'files')
+        query = request.args.get('q')
+        results, after = [], None
+        if query is not None:
+            try:
+                results = self.engine.search(
+                    kind, query, request.args.get('after'),
+                    self.page_size + 1)
+            except ts_db.DatabaseException:
+                return werkzeug.wrappers.Response(status=400)
+            results, after = self.paginate(results, 'cursor')
+        return self.response_template(
+            template_file='search.html',
+            kind=kind,
+            query=query,
+            results=results,
+            after=after)
+
+    # Search API URL.
+    # Returns a page of the search results and the cursor of the next page
+    # as JSON.
+    def search_api(self, request):
+        try:
+            results = self.engine.search(
+                request.args.get('kind', 'files'),
+                request.args.get('q', ''),
+                request.args.get('after'),
+                self.page_size + 1)
+        except ts_db.DatabaseException:
+            return werkzeug.wrappers.Response(status=400)
+        results, after = self.paginate(results, 'cursor')
+        return werkzeug.wrappers.Response(
+            json.dumps({'results': results, 'after': after}),
+            mimetype='application/json')
+
+    # Truncates a list retrieved with one extra item to the page size.
+    # Returns the page and the cursor of the next page, if any.
+    def paginate(self, items, cursor_key):
+        if len(items) <= self.page_size:
+            return items, None
+        items = items[:self.page_size]
+        return items, items[-1][cursor_key]
 
     # Download URL.
-    # Passes the requested file to the client.
+    # Passes the requested file to the client. The blobs are immutable
+    # and content-addressed, so their SHA-256 hash is a strong ETag.
+    # Supports the conditional and the byte ranges requests.
+    # The compressed blobs are passed as they are to the clients accepting
+    # their encoding, decompressed otherwise, without the ranges.
     def download(
             self, request,
             project_name, version_name, file_name):
-        stream = self.engine.download(
+        sha256 = self.engine.lookup(
             project_name, version_name, file_name)
+        stream, codec = self.engine.retrieve_stored(sha256)
+        if codec is not None:
+            return self.response_compressed(request, sha256, stream, codec)
+        headers = {'ETag': '"%s"' % sha256, 'Accept-Ranges': 'bytes'}
+        # Not modified if the client already has the file.
+        if request.if_none_match.contains_weak(sha256):
+            stream.close()
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+        # Lets the front server pass the file, ranges included, unless
+        # the blob is not stored as a single file.
+        if self.download_mode != DOWNLOAD_DIRECT and \
+                hasattr(stream, 'fileno'):
+            stream.close()
+            return self.response_offload(sha256, headers)
+        length = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+        # Ignores the ranges if the client has another file.
+        ranges = None
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) \
+                or if_range.etag == sha256:
+            ranges = resolve_ranges(request.range, length)
+        # Passes the whole file.
+        if ranges is None:
+            headers['Content-Length'] = str(length)
+            return werkzeug.wrappers.Response(
+                werkzeug.wsgi.wrap_file(
+                    request.environ, CountedStream(stream)),
+                headers=headers,
+                direct_passthrough=True,
+                mimetype='application/octet-stream')
+        # None of the ranges is satisfiable.
+        if not ranges:
+            stream.close()
+            headers['Content-Range'] = 'bytes */%d' % length
+            return werkzeug.wrappers.Response(status=416, headers=headers)
+        # Passes a single range. The server file wrapper is not used, as
+        # it may pass the file up to its end, whatever the content length.
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            headers['Content-Length'] = str(stop - start)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, stop - 1, length)
+            return werkzeug.wrappers.Response(
+                iterate_single_range(stream, start, stop),
+                status=206,
+                headers=headers,
+                direct_passthrough=True,
+                mimetype='application/octet-stream')
+        # Passes multiple ranges.
+        boundary = uuid.uuid4().hex
+        content_length = len('--%s--\r\n' % boundary)
+        for start, stop in ranges:
+            content_length += len(multipart_range_header(
+                start, stop, length, boundary))
+            content_length += stop - start + 2
+        headers['Content-Length'] = str(content_length)
+        return werkzeug.wrappers.Response(
+            iterate_ranges(stream, ranges, length, boundary),
+            status=206,
+            headers=headers,
+            direct_passthrough=True,
+            mimetype='multipart/byteranges; boundary=' + boundary)
+
+    # Returns a response passing a compressed blob, encoded if the client
+    # accepts the codec encoding. The encoded and decoded representations
+    # have distinct ETags.
+    def response_compressed(self, request, sha256, stream, codec):
+        encoding = codec.content_encoding
+        encoded = encoding is not None and \
+            request.accept_encodings[encoding] > 0
+        etag = sha256 + '-' + encoding if encoded else sha256
+        headers = {'ETag': '"%s"' % etag, 'Vary': 'Accept-Encoding'}
+        # Not modified if the client already has the file.
+        if request.if_none_match.contains_weak(etag):
+            stream.close()
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+        # Both representations count the compressed bytes read.
+        size = os.fstat(stream.fileno()).st_size
+        counted_stream = CountedStream(stream)
+        # Passes the compressed file.
+        if encoded:
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(size)
+            return werkzeug.wrappers.Response(
+                werkzeug.wsgi.wrap_file(request.environ, counted_stream),
+                headers=headers,
+                direct_passthrough=True,
+                mimetype='application/octet-stream')
+        # Passes the decompressed file, its length is unknown.
+        stream = ts_ds.DecompressedBlob(counted_stream, codec)
         return werkzeug.wrappers.Response(
             werkzeug.wsgi.wrap_file(request.environ, stream),
+            headers=headers,
             direct_passthrough=True,
             mimetype='application/octet-stream')
 
+    # Returns a response which lets the front server pass a blob.
+    def response_offload(self, sha256, headers):
+        path = self.engine.locate(sha256).replace(os.sep, '/')
+        if self.download_mode == DOWNLOAD_X_ACCEL_REDIRECT:
+            headers['X-Accel-Redirect'] = \
+                self.offload_location.rstrip('/') + '/' + path
+        else:
+            headers['X-Sendfile'] = os.path.join(
+                self.offload_location, path)
+        return werkzeug.wrappers.Response(
+            headers=headers,
+            mimetype='application/octet-stream')
+
+    # Archive URL.
+    # Passes a zip archive of all the version files, built on the fly
+    # from the blobs. The archive only depends on the files, so its ETag
+    # is a hash of their names and SHA-256 hashes. Its length is unknown.
+    def archive(self, request, project_name, version_name):
+        files = [
+            (file['name'], file['sha256']) for file in
+            self.engine.list_files(project_name, version_name)]
+        etag = archive_etag(files)
+        headers = {
+            'ETag': '"%s"' % etag,
+            'Content-Disposition': 'attachment; filename="%s-%s.zip"' % (
+                project_name, version_name)}
+        # Not modified if the client already has the archive.
+        if request.if_none_match.contains_weak(etag):
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+        return werkzeug.wrappers.Response(
+            (data for data in iterate_archive(self.engine, files) if data),
+            headers=headers,
+            direct_passthrough=True,
+            mimetype='application/zip')
+
     # Star URL.
     # Processes the star and redirects to the project page.
     def star(self, request, project_name, version_name):
@@ -143,13 +812,120 @@ class App(BaseApp):
 
     # Upload URL.
     # Processes the file upload and redirects to the home page.
+    # The multipart body is parsed as it is read, without spooling it.
     def upload(self, request):
-        # Extracts the parameters from the POST request.
-        project_name = request.form.get('project')
-        version_name = request.form.get('version')
-        upload = request.files.get('upload')
-        file_name = upload.filename
-        # Performs the upload.
-        self.engine.upload(
-            project_name, version_name, file_name, upload)
-        return self.response_redirect('/')
+        upload = self.create_multipart_upload(request)
+        return consume_body(request.stream, upload)
+
+    # Batch upload URL.
+    # Processes the upload of several files in a version and redirects
+    # to the home page. Creates all or none of the files.
+    def upload_batch(self, request):
+        upload = self.create_batch_upload(request)
+        return consume_body(request.stream, upload)
+
+    # Raw upload URL.
+    # Processes the file upload from the PUT request body. Requires the
+    # body length unless the server terminates the input, rather than
+    # creating an empty file.
+    def upload_raw(
+            self, request,
+            project_name, version_name, file_name):
+        if not has_readable_body(request):
+            return werkzeug.wrappers.Response(status=411)
+        upload = self.create_raw_upload(
+            request, project_name, version_name, file_name)
+        return consume_body(request.stream, upload)
+
+    # Upload session creation URL.
+    # Creates a resumable upload session of a file. Returns its URL in the
+    # Location header, and its ID as the body.
+    def create_upload_session(
+            self, request,
+            project_name, version_name, file_name):
+        session_id = self.engine.create_upload_session(
+            project_name, version_name, file_name)
+        return werkzeug.wrappers.Response(
+            session_id,
+            status=201,
+            headers={
+                'Location': self.base_url + '/upload-session/' + session_id,
+                'Upload-Offset': '0'},
+            mimetype='text/plain')
+
+    # Upload session URL.
+    # Returns the offset to resume the upload from.
+    def upload_session_offset(self, request, session_id):
+        try:
+            offset = self.engine.open_upload_session(
+                session_id).retrieve_offset()
+        except ts_ds.DatastoreException:
+            return werkzeug.wrappers.Response(status=404)
+        return werkzeug.wrappers.Response(
+            status=204,
+            headers={
+                'Upload-Offset': str(offset),
+                'Cache-Control': 'no-store'})
+
+    # Upload session append URL.
+    # Appends the PATCH request body at the Upload-Offset header offset.
+    # Requires the body length unless the server terminates the input.
+    def append_upload_session(self, request, session_id):
+        if not has_readable_body(request):
+            return werkzeug.wrappers.Response(status=411)
+        append = self.create_upload_session_append(request, session_id)
+        return consume_body(request.stream, append)
+
+    # Upload session commit URL.
+    # Completes the upload and creates the file. Conflicts if another
+    # request holds the session. Accepted if the completion is still in
+    # progress, the client then commits again later.
+    def commit_upload_session(self, request, session_id):
+        try:
+            self.engine.open_upload_session(session_id)
+        except ts_ds.DatastoreException:
+            return werkzeug.wrappers.Response(status=404)
+        try:
+            committed = self.engine.commit_upload_session(session_id)
+        except ts_ds.UploadSessionBusy:
+            return werkzeug.wrappers.Response(status=409)
+        if not committed:
+            return werkzeug.wrappers.Response(
+                status=202, headers={'Retry-After': '1'})
+        return werkzeug.wrappers.Response(status=201)
+
+    # Upload session abort URL.
+    # Discards the upload.
+    def abort_upload_session(self, request, session_id):
+        try:
+            self.engine.abort_upload_session(session_id)
+        except ts_ds.DatastoreException:
+            return werkzeug.wrappers.Response(status=404)
+        return werkzeug.wrappers.Response(status=204)
+
+    # Creates the body consumer of a multipart upload.
+    def create_multipart_upload(self, request, batch=False):
+        mimetype, options = ts_mp.parse_options_header(
+            request.headers.get('Content-Type', ''))
+        if mimetype != 'multipart/form-data':
+            raise ts_mp.MultipartException('Invalid content type')
+        return MultipartUpload(
+            self.engine, options.get('boundary'),
+            self.response_redirect('/'), batch)
+
+    # Creates the body consumer of a batch upload.
+    def create_batch_upload(self, request):
+        return self.create_multipart_upload(request, True)
+
+    # Creates the body consumer of a raw upload.
+    def create_raw_upload(
+            self, request,
+            project_name, version_name, file_name):
+        return RawUpload(
+            self.engine, project_name, version_name, file_name,
+            werkzeug.wrappers.Response(status=201))
+
+    # Creates the body consumer of a resumable upload request.
+    def create_upload_session_append(self, request, session_id):
+        offset = request.headers.get('Upload-Offset', type=int)
+        return UploadSessionAppend(self.engine, session_id, offset)
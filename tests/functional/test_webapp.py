@@ -0,0 +1,669 @@
+import tempstore.asgiapp as ts_aa
+import tempstore.datastore as ts_ds
+import tempstore.engine as ts_e
+import tempstore.metrics as ts_m
+import tempstore.webapp as ts_wa
+
+import werkzeug.datastructures
+import werkzeug.test
+import werkzeug.wsgi
+
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import time
+import unittest
+import zipfile
+
+DATASTORE_DIR = 'datastore-test'
+DATABASE_DIR = 'database-test'
+BYTECODE_CACHE_DIR = 'bytecode-cache-test'
+BASE_URL = 'http://localhost'
+
+# 1 Mb of test content.
+CONTENT_TEST = bytes(range(256)) * 4 * 1024
+
+# Returns a multipart/form-data body and its content type.
+# The files are (name, content) tuples.
+def multipart_body(fields, files):
+    boundary = 'TestBoundary'
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write((
+            '--%s\r\n'
+            'Content-Disposition: form-data; name="%s"\r\n'
+            '\r\n'
+            '%s\r\n' % (boundary, name, value)).encode())
+    for file_name, content in files:
+        body.write((
+            '--%s\r\n'
+            'Content-Disposition: form-data; name="upload"; '
+            'filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n'
+            '\r\n' % (boundary, file_name)).encode())
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(('--%s--\r\n' % boundary).encode())
+    content_type = 'multipart/form-data; boundary=' + boundary
+    return body.getvalue(), content_type
+
+class TestApp(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(DATASTORE_DIR, DATABASE_DIR, 60)
+        self.engine.create()
+        self.app = ts_wa.App(self.engine, BASE_URL)
+
+    def tearDown(self):
+        self.engine.delete()
+
+    # Performs a request. Returns the status, headers, and body.
+    def request(self, method, path, headers=None, body=b''):
+        environ = werkzeug.test.create_environ(
+            path, BASE_URL, method=method,
+            headers=headers, data=body)
+        app_iter, status, headers = werkzeug.test.run_wsgi_app(
+            self.app, environ, buffered=True)
+        return int(status.split(' ')[0]), headers, b''.join(app_iter)
+
+    # Uploads a file. Returns the status.
+    def upload(self, project_name, version_name, file_name, content):
+        body, content_type = multipart_body(
+            {'project': project_name, 'version': version_name},
+            [(file_name, content)])
+        status, headers, body = self.request(
+            'POST', '/upload', {'Content-Type': content_type}, body)
+        return status
+
+    def test_upload_download(self):
+
+        # Uploads a file, redirects to the home page.
+        self.assertEqual(
+            self.upload('ProjectX', '1.0', 'fileA', CONTENT_TEST), 302)
+
+        # Downloads the file.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, CONTENT_TEST)
+        self.assertEqual(
+            headers.get('Content-Length'), str(len(CONTENT_TEST)))
+
+        # Downloads the file again, it was not modified.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'If-None-Match': headers.get('ETag')})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+        # Downloads a range of the file.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'Range': 'bytes=1000-1999'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, CONTENT_TEST[1000:2000])
+
+        # Fails to download a non-existent file.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileB')
+        self.assertEqual(status, 500)
+
+    def test_download_range_file_wrapper(self):
+
+        # Uploads a file.
+        self.upload('ProjectX', '1.0', 'fileA', CONTENT_TEST)
+
+        # Downloads a range of the file from a server whose file wrapper
+        # passes the files up to their end.
+        environ = werkzeug.test.create_environ(
+            '/download/ProjectX/1.0/fileA', BASE_URL,
+            headers={'Range': 'bytes=1000-1999'})
+        environ['wsgi.file_wrapper'] = werkzeug.wsgi.FileWrapper
+        app_iter, status, headers = werkzeug.test.run_wsgi_app(
+            self.app, environ, buffered=True)
+        self.assertEqual(status, '206 PARTIAL CONTENT')
+        self.assertEqual(b''.join(app_iter), CONTENT_TEST[1000:2000])
+
+    def test_archive(self):
+
+        # Uploads three files, two of them with the same content.
+        self.upload('ProjectX', '1.0', 'fileB', CONTENT_TEST)
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+        self.upload('ProjectX', '1.0', 'fileC', b'foo')
+
+        # Downloads the archive of the version, in the files order.
+        status, headers, body = self.request(
+            'GET', '/archive/ProjectX/1.0.zip')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers.get('Content-Type'), 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            infos = archive.infolist()
+            self.assertEqual(
+                [info.filename for info in infos],
+                ['fileA', 'fileB', 'fileC'])
+            self.assertEqual(
+                [info.compress_type for info in infos],
+                [zipfile.ZIP_STORED] * 3)
+            self.assertEqual(archive.read('fileB'), CONTENT_TEST)
+            self.assertEqual(archive.read('fileC'), b'foo')
+
+        # Downloads the archive again, it is the same.
+        etag = headers.get('ETag')
+        status, headers, body_again = self.request(
+            'GET', '/archive/ProjectX/1.0.zip')
+        self.assertEqual(body_again, body)
+        self.assertEqual(headers.get('ETag'), etag)
+        status, headers, body = self.request(
+            'GET', '/archive/ProjectX/1.0.zip', {'If-None-Match': etag})
+        self.assertEqual(status, 304)
+
+        # The archive changes with the files.
+        self.upload('ProjectX', '1.0', 'fileD', b'bar')
+        status, headers, body = self.request(
+            'GET', '/archive/ProjectX/1.0.zip', {'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers.get('ETag'), etag)
+
+        # Fails to download the archive of a non-existent version.
+        status, headers, body = self.request(
+            'GET', '/archive/ProjectX/2.0.zip')
+        self.assertEqual(status, 500)
+
+    def test_upload_raw(self):
+
+        # Uploads a file from a raw body.
+        status, headers, body = self.request(
+            'PUT', '/upload/ProjectX/1.0/fileA', {}, CONTENT_TEST)
+        self.assertEqual(status, 201)
+
+        # Downloads the file.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, CONTENT_TEST)
+
+        # Fails to upload the same file again.
+        status, headers, body = self.request(
+            'PUT', '/upload/ProjectX/1.0/fileA', {}, CONTENT_TEST)
+        self.assertEqual(status, 500)
+
+    def test_upload_raw_chunked(self):
+
+        # Fails to upload a file from a body of unknown length.
+        environ = werkzeug.test.create_environ(
+            '/upload/ProjectX/1.0/fileA', BASE_URL, method='PUT',
+            headers={'Transfer-Encoding': 'chunked'}, data=CONTENT_TEST)
+        del environ['CONTENT_LENGTH']
+        app_iter, status, headers = werkzeug.test.run_wsgi_app(
+            self.app, environ, buffered=True)
+        self.assertEqual(status, '411 LENGTH REQUIRED')
+        self.assertEqual(self.engine.list_projects(), [])
+
+        # Uploads the file if the server terminates the input.
+        environ = werkzeug.test.create_environ(
+            '/upload/ProjectX/1.0/fileA', BASE_URL, method='PUT',
+            headers={'Transfer-Encoding': 'chunked'}, data=CONTENT_TEST)
+        del environ['CONTENT_LENGTH']
+        environ['wsgi.input_terminated'] = True
+        app_iter, status, headers = werkzeug.test.run_wsgi_app(
+            self.app, environ, buffered=True)
+        self.assertEqual(status, '201 CREATED')
+        with self.engine.download('ProjectX', '1.0', 'fileA') as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST)
+
+    def test_upload_batch(self):
+
+        # Uploads two files at once.
+        body, content_type = multipart_body(
+            {'project': 'ProjectX', 'version': '1.0'},
+            [('fileA', b'foo'), ('fileB', CONTENT_TEST)])
+        status, headers, body = self.request(
+            'POST', '/upload-batch', {'Content-Type': content_type}, body)
+        self.assertEqual(status, 302)
+
+        # Downloads the second file.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileB')
+        self.assertEqual(body, CONTENT_TEST)
+
+        # Fails to upload two files at once, one of them exists.
+        body, content_type = multipart_body(
+            {'project': 'ProjectX', 'version': '1.0'},
+            [('fileC', b'bar'), ('fileA', b'baz')])
+        status, headers, body = self.request(
+            'POST', '/upload-batch', {'Content-Type': content_type}, body)
+        self.assertEqual(status, 500)
+
+        # None of the files was created.
+        files = self.engine.list_files('ProjectX', '1.0')
+        self.assertEqual(
+            [file['name'] for file in files], ['fileA', 'fileB'])
+
+        # Fails to upload two files at once with the single upload.
+        body, content_type = multipart_body(
+            {'project': 'ProjectX', 'version': '2.0'},
+            [('fileA', b'foo'), ('fileB', b'bar')])
+        status, headers, body = self.request(
+            'POST', '/upload', {'Content-Type': content_type}, body)
+        self.assertEqual(status, 500)
+
+    def test_upload_errors(self):
+
+        # Fails to upload without a file.
+        body, content_type = multipart_body(
+            {'project': 'ProjectX', 'version': '1.0'}, [('fileA', b'')])
+        body = body.replace(b'name="upload"', b'name="other"')
+        status, headers, body = self.request(
+            'POST', '/upload', {'Content-Type': content_type}, body)
+        self.assertEqual(status, 500)
+
+        # Fails to upload a truncated body.
+        body, content_type = multipart_body(
+            {'project': 'ProjectX', 'version': '1.0'}, [('fileA', b'foo')])
+        status, headers, body = self.request(
+            'POST', '/upload', {'Content-Type': content_type}, body[:-10])
+        self.assertEqual(status, 500)
+
+        # No temporary file is left behind.
+        for dir_path, dir_names, file_names in os.walk(DATASTORE_DIR):
+            self.assertEqual(file_names, [])
+
+    def test_pages(self):
+
+        # Uploads a file.
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+
+        # The home page lists the project.
+        status, headers, body = self.request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/project/ProjectX', body)
+
+        # The project page lists the version.
+        status, headers, body = self.request('GET', '/project/ProjectX')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/version/ProjectX/1.0', body)
+
+        # The version page lists the file.
+        status, headers, body = self.request(
+            'GET', '/version/ProjectX/1.0')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/download/ProjectX/1.0/fileA', body)
+
+        # Fails to show a non-existent page.
+        status, headers, body = self.request('GET', '/unknown')
+        self.assertEqual(status, 404)
+
+    def test_search(self):
+
+        # Uploads files in two versions.
+        self.upload('ProjectX', '1.0', 'libfoo-1.2.3.so', b'foo')
+        self.upload('ProjectX', '2.0', 'libfoo-1.2.4.so', b'bar')
+
+        # The search page lists the matching files.
+        status, headers, body = self.request(
+            'GET', '/search?q=libfoo-1.2.3')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/download/ProjectX/1.0/libfoo-1.2.3.so', body)
+        self.assertNotIn(b'libfoo-1.2.4.so', body)
+        status, headers, body = self.request(
+            'GET', '/search?q=2.0&kind=versions')
+        self.assertEqual(status, 200)
+        self.assertIn(b'/version/ProjectX/2.0', body)
+
+        # The search API returns the results and the next page cursor.
+        self.app.page_size = 1
+        status, headers, body = self.request(
+            'GET', '/api/search?q=libfoo')
+        self.assertEqual(status, 200)
+        page = json.loads(body.decode())
+        self.assertEqual(
+            [result['file'] for result in page['results']],
+            ['libfoo-1.2.4.so'])
+        status, headers, body = self.request(
+            'GET', '/api/search?q=libfoo&after=' + page['after'])
+        page = json.loads(body.decode())
+        self.assertEqual(
+            [result['file'] for result in page['results']],
+            ['libfoo-1.2.3.so'])
+        self.assertIsNone(page['after'])
+
+        # Fails to search an invalid query.
+        status, headers, body = self.request('GET', '/search?q=li')
+        self.assertEqual(status, 400)
+        status, headers, body = self.request(
+            'GET', '/api/search?q=libfoo&kind=blobs')
+        self.assertEqual(status, 400)
+
+    def test_pages_etag(self):
+
+        # Uploads a file, shows the project page.
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+        status, headers, body = self.request('GET', '/project/ProjectX')
+        self.assertEqual(status, 200)
+        etag = headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+
+        # Shows the page again, it was not modified.
+        status, headers, body = self.request(
+            'GET', '/project/ProjectX', {'If-None-Match': etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+        # Uploads a version, the page was modified.
+        self.upload('ProjectX', '2.0', 'fileA', b'foo')
+        status, headers, body = self.request(
+            'GET', '/project/ProjectX', {'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertIn(b'/version/ProjectX/2.0', body)
+        self.assertNotEqual(headers.get('ETag'), etag)
+
+    def test_upload_session(self):
+
+        # Creates an upload session.
+        status, headers, body = self.request(
+            'POST', '/upload-session/ProjectX/1.0/fileA')
+        self.assertEqual(status, 201)
+        path = '/upload-session/' + body.decode()
+        self.assertEqual(headers.get('Location'), BASE_URL + path)
+
+        # Uploads the first part of the file.
+        status, headers, body = self.request(
+            'PATCH', path, {'Upload-Offset': '0'}, CONTENT_TEST[:300000])
+        self.assertEqual(status, 204)
+        self.assertEqual(headers.get('Upload-Offset'), '300000')
+
+        # Fails to upload at another offset, retrieves the offset.
+        status, headers, body = self.request(
+            'PATCH', path, {'Upload-Offset': '0'}, CONTENT_TEST)
+        self.assertEqual(status, 409)
+        self.assertEqual(headers.get('Upload-Offset'), '300000')
+        status, headers, body = self.request('GET', path)
+        self.assertEqual(status, 204)
+        self.assertEqual(headers.get('Upload-Offset'), '300000')
+
+        # Fails to commit the file while another request holds the
+        # session.
+        session = self.engine.open_upload_session(path.split('/')[-1])
+        self.assertTrue(session.begin(300000))
+        status, headers, body = self.request('POST', path + '/commit')
+        self.assertEqual(status, 409)
+        session.end()
+
+        # Uploads the rest of the file, commits it.
+        status, headers, body = self.request(
+            'PATCH', path, {'Upload-Offset': '300000'},
+            CONTENT_TEST[300000:])
+        self.assertEqual(status, 204)
+        status, headers, body = self.request('POST', path + '/commit')
+        self.assertEqual(status, 201)
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA')
+        self.assertEqual(body, CONTENT_TEST)
+
+        # The session does not exist anymore.
+        status, headers, body = self.request('GET', path)
+        self.assertEqual(status, 404)
+        status, headers, body = self.request(
+            'PATCH', path, {'Upload-Offset': '0'}, b'foo')
+        self.assertEqual(status, 404)
+
+    def test_upload_session_accepted(self):
+
+        # Uploads a file in a session.
+        status, headers, body = self.request(
+            'POST', '/upload-session/ProjectX/1.0/fileA')
+        path = '/upload-session/' + body.decode()
+        status, headers, body = self.request(
+            'PATCH', path, {'Upload-Offset': '0'}, CONTENT_TEST)
+        self.assertEqual(status, 204)
+
+        # Accepts the commit without waiting for the completion, the
+        # commit is then polled until the file is created.
+        timeout = ts_ds.UPLOAD_COMMIT_TIMEOUT
+        ts_ds.UPLOAD_COMMIT_TIMEOUT = 0
+        try:
+            status, headers, body = self.request('POST', path + '/commit')
+            self.assertEqual(status, 202)
+            self.assertEqual(headers.get('Retry-After'), '1')
+            for i in range(100):
+                if status != 202:
+                    break
+                time.sleep(0.05)
+                status, headers, body = self.request(
+                    'POST', path + '/commit')
+        finally:
+            ts_ds.UPLOAD_COMMIT_TIMEOUT = timeout
+        self.assertEqual(status, 201)
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA')
+        self.assertEqual(body, CONTENT_TEST)
+        status, headers, body = self.request('POST', path + '/commit')
+        self.assertEqual(status, 404)
+
+    def test_upload_session_abort(self):
+
+        # Creates an upload session, discards it.
+        status, headers, body = self.request(
+            'POST', '/upload-session/ProjectX/1.0/fileA')
+        path = '/upload-session/' + body.decode()
+        status, headers, body = self.request('DELETE', path)
+        self.assertEqual(status, 204)
+        status, headers, body = self.request('POST', path + '/commit')
+        self.assertEqual(status, 404)
+
+    def test_metrics(self):
+
+        # Uploads and downloads a file.
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA')
+        self.assertEqual(status, 200)
+
+        # Exposes the requests and the datastore metrics.
+        status, headers, body = self.request('GET', '/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers.get('Content-Type').startswith('text/plain'))
+        lines = body.decode().splitlines()
+        self.assertTrue(any(
+            line.startswith(
+                'tempstore_http_requests_total'
+                '{endpoint="download",status="200"} ')
+            for line in lines))
+        self.assertTrue(any(
+            line.startswith(
+                'tempstore_http_request_duration_seconds_count'
+                '{endpoint="download"} ')
+            for line in lines))
+        self.assertIn(
+            '# TYPE tempstore_datastore_written_bytes_total counter', lines)
+
+    def test_metrics_read_bytes(self):
+        key = ('tempstore_datastore_read_bytes_total', ())
+
+        # Uploads a file.
+        self.upload('ProjectX', '1.0', 'fileA', CONTENT_TEST)
+
+        # Counts the bytes of a range as they are read.
+        count = ts_m.REGISTRY.values.get(key, 0)
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'Range': 'bytes=1000-1999'})
+        self.assertEqual(status, 206)
+        self.assertEqual(ts_m.REGISTRY.values.get(key, 0), count + 1000)
+
+        # Counts only the bytes read of an interrupted download.
+        count = ts_m.REGISTRY.values.get(key, 0)
+        environ = werkzeug.test.create_environ(
+            '/download/ProjectX/1.0/fileA', BASE_URL)
+        app_iter, status, headers = werkzeug.test.run_wsgi_app(
+            self.app, environ)
+        self.assertTrue(next(iter(app_iter)))
+        app_iter.close()
+        self.assertGreater(ts_m.REGISTRY.values.get(key, 0), count)
+        self.assertLess(
+            ts_m.REGISTRY.values.get(key, 0), count + len(CONTENT_TEST))
+
+    def test_star(self):
+
+        # Uploads a file.
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+
+        # Stars the version, redirects to the project page.
+        status, headers, body = self.request(
+            'GET', '/admin/star/ProjectX/1.0')
+        self.assertEqual(status, 302)
+        self.assertTrue(self.engine.list_versions('ProjectX')[0]['star'])
+
+        # Unstars the version, redirects to the project page.
+        status, headers, body = self.request(
+            'GET', '/admin/unstar/ProjectX/1.0')
+        self.assertEqual(status, 302)
+        self.assertFalse(self.engine.list_versions('ProjectX')[0]['star'])
+
+class TestAppCache(TestApp):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(
+            DATASTORE_DIR, DATABASE_DIR, 60, cache_size=100)
+        self.engine.create()
+        self.app = ts_wa.App(
+            self.engine, BASE_URL,
+            bytecode_cache_dir=BYTECODE_CACHE_DIR, page_cache_size=100)
+
+    def tearDown(self):
+        TestApp.tearDown(self)
+        shutil.rmtree(BYTECODE_CACHE_DIR)
+
+    def test_cache(self):
+
+        # The templates bytecode is cached.
+        self.assertTrue(os.listdir(BYTECODE_CACHE_DIR))
+
+        # Shows the home page twice, the second time from the cache.
+        self.upload('ProjectX', '1.0', 'fileA', b'foo')
+        status, headers, body = self.request('GET', '/')
+        self.assertEqual(self.app.page_cache.hits, 0)
+        status, headers, cached_body = self.request('GET', '/')
+        self.assertEqual(self.app.page_cache.hits, 1)
+        self.assertEqual(cached_body, body)
+
+        # The error pages are not cached.
+        status, headers, body = self.request('GET', '/project/ProjectY')
+        self.assertEqual(status, 500)
+        status, headers, body = self.request('GET', '/project/ProjectY')
+        self.assertEqual(status, 500)
+        self.assertEqual(self.app.page_cache.hits, 1)
+
+class TestAppCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(
+            DATASTORE_DIR, DATABASE_DIR, 60, datastore_compression='gzip')
+        self.engine.create()
+        self.app = ts_wa.App(self.engine, BASE_URL)
+
+    def tearDown(self):
+        self.engine.delete()
+
+    request = TestApp.request
+    upload = TestApp.upload
+
+    def test_download_compressed(self):
+
+        # Uploads a file which compresses.
+        content = b'foo bar baz\n' * 100000
+        self.assertEqual(
+            self.upload('ProjectX', '1.0', 'fileA', content), 302)
+
+        # Downloads the file compressed.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(headers.get('Content-Length'), str(len(body)))
+        self.assertEqual(gzip.decompress(body), content)
+        etag = headers.get('ETag')
+
+        # Downloads the file compressed again, it was not modified.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(status, 304)
+
+        # Downloads the file decompressed, ignoring the range.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'If-None-Match': etag, 'Range': 'bytes=0-9'})
+        self.assertEqual(status, 200)
+        self.assertIsNone(headers.get('Content-Encoding'))
+        self.assertEqual(body, content)
+        self.assertNotEqual(headers.get('ETag'), etag)
+
+class TestAppChunking(TestApp):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(
+            DATASTORE_DIR, DATABASE_DIR, 60, datastore_chunking=True)
+        self.engine.create()
+        self.app = ts_wa.App(self.engine, BASE_URL)
+
+    def test_download_ranges(self):
+
+        # Uploads a file.
+        self.upload('ProjectX', '1.0', 'fileA', CONTENT_TEST)
+
+        # Downloads two ranges of the file, across the chunks.
+        status, headers, body = self.request(
+            'GET', '/download/ProjectX/1.0/fileA',
+            {'Range': 'bytes=1000-99999,500000-'})
+        self.assertEqual(status, 206)
+        self.assertIn(CONTENT_TEST[1000:100000], body)
+        self.assertIn(CONTENT_TEST[500000:], body)
+
+class TestAsgiApp(TestApp):
+
+    def setUp(self):
+        TestApp.setUp(self)
+        self.asgi_app = ts_aa.AsgiApp(self.app, 4)
+
+    # Performs a request through the ASGI app, sending the body in
+    # several messages. Returns the status, headers, and body.
+    def request(self, method, path, headers=None, body=b''):
+        path, _, query_string = path.partition('?')
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'query_string': query_string.encode(),
+            'root_path': '',
+            'headers': [
+                (name.lower().encode(), value.encode())
+                for name, value in (headers or {}).items()],
+            'server': ('localhost', 80),
+            'client': ('127.0.0.1', 12345)}
+        messages = []
+        for i in range(0, len(body), 65536):
+            messages.append({
+                'type': 'http.request',
+                'body': body[i:i+65536],
+                'more_body': True})
+        messages.append({'type': 'http.request', 'body': b''})
+        async def receive():
+            return messages.pop(0)
+        sent = []
+        async def send(message):
+            sent.append(message)
+        asyncio.run(self.asgi_app(scope, receive, send))
+        status = sent[0]['status']
+        headers = werkzeug.datastructures.Headers([
+            (name.decode(), value.decode())
+            for name, value in sent[0]['headers']])
+        body = b''.join(message.get('body', b'') for message in sent[1:])
+        return status, headers, body
@@ -25,8 +25,10 @@ class TestDatabaseParallel(unittest.TestCase):
 
         def __init__(
                 self, total_counter, success_counter,
-                project_name, version_name, file_name):
+                project_name, version_name, file_name,
+                database=None):
             threading.Thread.__init__(self)
+            self.database = database
             self.total_counter = total_counter
             self.success_counter = success_counter
             self.project_name = project_name
@@ -35,7 +37,9 @@ class TestDatabaseParallel(unittest.TestCase):
 
         def run(self):
             self.total_counter.increment()
-            database = ts_db.Database(DATABASE_DIR)
+            database = self.database
+            if database is None:
+                database = ts_db.Database(DATABASE_DIR)
             database.create_file(
                 self.project_name,
                 self.version_name,
@@ -46,8 +50,14 @@ class TestDatabaseParallel(unittest.TestCase):
     # Thread to delete the obsolete versions.
     class DeleteVersionsThread(threading.Thread):
 
+        def __init__(self, database=None):
+            threading.Thread.__init__(self)
+            self.database = database
+
         def run(self):
-            database = ts_db.Database(DATABASE_DIR)
+            database = self.database
+            if database is None:
+                database = ts_db.Database(DATABASE_DIR)
             database.delete_obsolete_versions()
 
     # Tests that deleting versions does not interfere with creating files.
@@ -73,3 +83,31 @@ class TestDatabaseParallel(unittest.TestCase):
             # Verifies all attempts to create a file were successful.
             self.assertEqual(
                 success_counter.value(), total_counter.value())
+
+    # Tests that threads sharing a pooled database do not interfere.
+    def test_parallel_create_delete_pool(self):
+        database = ts_db.Database(DATABASE_DIR, pool_size=8)
+        total_counter = util.Counter()
+        success_counter = util.Counter()
+        # Try 10 times.
+        for i in range(10):
+            threads = []
+            # Try 100 parallel threads.
+            for j in range(50):
+                # Creates a file.
+                threads.append(self.CreateFileThread(
+                    total_counter, success_counter,
+                    'Project', 'v' + str(j), 'file' + str(i),
+                    database))
+                # Deletes the obsolete versions.
+                threads.append(self.DeleteVersionsThread(database))
+            # Runs the 100 operations in parallel.
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            # Verifies all attempts to create a file were successful.
+            self.assertEqual(
+                success_counter.value(), total_counter.value())
+        # The pool never holds more than its size.
+        self.assertLessEqual(len(database.pool.connections), 8)
@@ -62,3 +62,25 @@ class TestDatastoreParallel(unittest.TestCase):
             sha256 = ts_ds.sha256_sum(io.BytesIO(CONTENT_TEST))
             with datastore.retrieve_blob(sha256) as stream:
                 self.assertEqual(stream.read(-1), CONTENT_TEST)
+
+    # Tests that parallel threads creating distinct blobs with batched
+    # flushes all get their blobs.
+    def test_parallel_group_sync(self):
+        datastore = ts_ds.Datastore(
+            DATASTORE_DIR, fanout=2, durability=ts_ds.DURABILITY_GROUP)
+        contents = [CONTENT_TEST[:i] for i in range(200)]
+        sha256s = {}
+        def create_blob(content):
+            sha256s[content] = datastore.create_blob(io.BytesIO(content))
+        threads = [
+            threading.Thread(target=create_blob, args=(content,))
+            for content in contents]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Verifies all the blobs.
+        self.assertEqual(len(sha256s), len(contents))
+        for content, sha256 in sha256s.items():
+            with datastore.retrieve_blob(sha256) as stream:
+                self.assertEqual(stream.read(-1), content)
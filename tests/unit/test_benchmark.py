@@ -0,0 +1,22 @@
+import benchmarks.benchmark as ts_b
+
+import unittest
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare(self):
+        baseline = {
+            'datastore.create_blob': {'value': 100, 'unit': 'MB/s'},
+            'database.create_file': {'value': 1000, 'unit': 'ops/s'},
+            'http.version_page': {'value': 50, 'unit': 'requests/s'}}
+        results = {
+            'datastore.create_blob': {'value': 85, 'unit': 'MB/s'},
+            'database.create_file': {'value': 700, 'unit': 'ops/s'},
+            'cleanup.cleanup': {'value': 10, 'unit': 'blobs/s'}}
+
+        # Only the results slower than the tolerance are regressions,
+        # the results missing from the baseline are ignored.
+        self.assertEqual(
+            ts_b.compare(results, baseline, 0.2),
+            [('database.create_file', 1000, 700)])
+        self.assertEqual(ts_b.compare(results, baseline, 0.5), [])
@@ -0,0 +1,44 @@
+import tempstore.cache as ts_c
+
+import unittest
+
+class TestLruCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = ts_c.LruCache(2)
+
+        # Caches two values.
+        cache.put('a', 1, cache.epoch)
+        cache.put('b', 2, cache.epoch)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # Evicts the least recently used value.
+        cache.get('a')
+        cache.put('c', 3, cache.epoch)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_clear(self):
+        cache = ts_c.LruCache(2)
+
+        # Removes all the values.
+        cache.put('a', 1, cache.epoch)
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+
+        # Drops a value retrieved before the cache was cleared.
+        epoch = cache.epoch
+        cache.clear()
+        cache.put('a', 1, epoch)
+        self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+
+        # Never keeps anything.
+        cache = ts_c.LruCache(0)
+        cache.put('a', 1, cache.epoch)
+        self.assertIsNone(cache.get('a'))
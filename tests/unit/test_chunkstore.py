@@ -0,0 +1,232 @@
+import tempstore.chunkstore as ts_cs
+import tempstore.datastore as ts_ds
+
+import io
+import os
+import tempfile
+import unittest
+
+DATASTORE_DIR = 'datastore-test'
+
+# 1 Mb of test content, and a copy with a few bytes inserted.
+CONTENT_TEST1 = os.urandom(1 * 1024 * 1024)
+CONTENT_TEST2 = CONTENT_TEST1[:500000] + b'foo' + CONTENT_TEST1[500000:]
+
+# Splits content fed by buffers of a given size into chunks.
+def split(content, buffer_size):
+    chunker = ts_cs.Chunker()
+    chunks = []
+    for i in range(0, len(content), buffer_size):
+        chunks += chunker.feed(content[i:i+buffer_size])
+    return chunks + chunker.finish()
+
+class TestChunker(unittest.TestCase):
+
+    def test_split(self):
+
+        # The chunks sizes are within the limits, the last one excepted.
+        chunks = split(CONTENT_TEST1, len(CONTENT_TEST1))
+        self.assertEqual(b''.join(chunks), CONTENT_TEST1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), ts_cs.CHUNK_MIN_SIZE)
+            self.assertLessEqual(len(chunk), ts_cs.CHUNK_MAX_SIZE)
+
+        # The chunks do not depend on the buffers sizes.
+        self.assertEqual(split(CONTENT_TEST1, 1000), chunks)
+
+        # Inserting bytes only changes the chunks around the insertion.
+        other_chunks = split(CONTENT_TEST2, 65536)
+        self.assertGreaterEqual(
+            len(set(chunks) & set(other_chunks)), len(chunks) - 2)
+
+        # Splits content which never matches a boundary.
+        chunks = split(bytes(1000000), 65536)
+        self.assertEqual(
+            [len(chunk) for chunk in chunks[:-1]],
+            [ts_cs.CHUNK_MAX_SIZE] * 3)
+
+class TestChunkedDatastore(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore = ts_cs.ChunkedDatastore(DATASTORE_DIR, fanout=2)
+        self.datastore.create()
+
+    def tearDown(self):
+        self.datastore.delete()
+
+    # Returns the total size of the chunks.
+    def chunks_size(self):
+        size = 0
+        for dir_path, dir_names, file_names in os.walk(
+                self.datastore.chunks_dir):
+            for file_name in file_names:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+        return size
+
+    def test_create_blob(self):
+
+        # Creates two similar blobs, they share most of their chunks.
+        sha256_1 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        sha256_2 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST2))
+        self.assertEqual(
+            sha256_2, ts_ds.sha256_sum(io.BytesIO(CONTENT_TEST2)))
+        self.assertLess(self.chunks_size(), len(CONTENT_TEST1) * 1.5)
+        self.assertGreater(self.datastore.chunk_dedup_hits, 0)
+
+        # Retrieves and verifies the blobs.
+        with self.datastore.retrieve_blob(sha256_1) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+        with self.datastore.retrieve_blob(sha256_2) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST2)
+
+        # Creates the first blob again, it is deduplicated.
+        self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        self.assertEqual(self.datastore.dedup_hits, 1)
+
+        # Creates an empty blob.
+        sha256 = self.datastore.create_blob(io.BytesIO(b''))
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), b'')
+
+    def test_blob_writer(self):
+
+        # The new chunks are only installed when the blob is committed.
+        writer = self.datastore.create_blob_writer()
+        writer.write(CONTENT_TEST1)
+        self.assertTrue(writer.temp_chunk_paths)
+        for chunk_path in writer.temp_chunk_paths:
+            self.assertFalse(os.path.exists(chunk_path))
+        writer.commit()
+        for chunk_path in writer.chunk_paths:
+            self.assertTrue(os.path.isfile(chunk_path))
+        self.assertEqual(self.chunks_size(), len(CONTENT_TEST1))
+
+        # Aborting a blob discards its new chunks.
+        writer = self.datastore.create_blob_writer()
+        writer.write(CONTENT_TEST2)
+        writer.abort()
+        self.assertEqual(self.chunks_size(), len(CONTENT_TEST1))
+
+    def test_upload_session(self):
+
+        # Commits an upload session, the blob is chunked.
+        session_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(session_id)
+        session.begin(0)
+        session.write(CONTENT_TEST1)
+        session.end()
+        sha256 = session.commit()
+        session.abort()
+        self.assertGreater(self.chunks_size(), 0)
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+
+    def test_import_file(self):
+
+        # Imports a file, it is split into chunks and kept.
+        with tempfile.NamedTemporaryFile(dir='.') as f:
+            f.write(CONTENT_TEST1)
+            f.flush()
+            sha256 = ts_ds.sha256_file(f.name)
+            self.assertEqual(
+                self.datastore.import_file(f.name, sha256), 'copy')
+            self.assertEqual(
+                self.datastore.import_file(f.name, sha256), 'existing')
+            self.assertTrue(os.path.isfile(f.name))
+        self.assertGreater(self.chunks_size(), 0)
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+
+    def test_retrieve_blob_seek(self):
+
+        # Reads a blob across its chunks from various offsets.
+        sha256 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(
+                stream.seek(0, os.SEEK_END), len(CONTENT_TEST1))
+            for start in [0, 100000, 500000, len(CONTENT_TEST1) - 10]:
+                stream.seek(start)
+                self.assertEqual(
+                    stream.read(200000),
+                    CONTENT_TEST1[start:start+200000])
+
+        # Fails to retrieve a blob whose chunk is missing.
+        with open(self.datastore.blob_path(sha256)) as f:
+            chunk_sha256, size = ts_cs.parse_manifest(f.read())[0]
+        os.unlink(self.datastore.chunk_path(chunk_sha256))
+        with self.assertRaises(ts_ds.DatastoreException) as e:
+            with self.datastore.retrieve_blob(sha256) as stream:
+                stream.read(-1)
+        self.assertEqual('Chunk not found', str(e.exception))
+
+    def test_delete_unreferenced_blobs(self):
+
+        # Creates two similar blobs.
+        sha256_1 = self.datastore.create_blob(
+            io.BytesIO(CONTENT_TEST1), 120)
+        sha256_2 = self.datastore.create_blob(
+            io.BytesIO(CONTENT_TEST2), 120)
+        chunks_size = self.chunks_size()
+
+        # Deletes the first blob, only its own chunks are freed.
+        statistics = self.datastore.delete_unreferenced_blobs(
+            set([sha256_2]))
+        self.assertEqual(statistics['deleted'], 1)
+        self.assertLess(self.chunks_size(), chunks_size)
+        self.assertGreater(self.chunks_size(), len(CONTENT_TEST2) - 1)
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.datastore.retrieve_blob(sha256_1)
+        with self.datastore.retrieve_blob(sha256_2) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST2)
+
+        # Deletes the second blob, all the chunks are freed.
+        self.datastore.delete_unreferenced_blobs(set())
+        self.assertEqual(self.chunks_size(), 0)
+
+    def test_delete_unreferenced_blobs_writing(self):
+
+        # Keeps the chunks of a blob being written, even if they are old.
+        writer = self.datastore.create_blob_writer()
+        writer.write(CONTENT_TEST1)
+        self.assertTrue(writer.temp_chunk_paths)
+        for temp_chunk_path in writer.temp_chunk_paths.values():
+            os.utime(temp_chunk_path, (0, 0))
+        os.utime(writer.temp_file_path, (0, 0))
+        self.datastore.delete_stale_temp_files(0)
+        self.datastore.delete_unreferenced_blobs(set())
+        sha256 = writer.commit()
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+
+    def test_migrate(self):
+
+        # Creates a blob with the flat layout.
+        datastore = ts_cs.ChunkedDatastore(DATASTORE_DIR)
+        sha256 = datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+
+        # Retrieves the blob before and after the migration.
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+        self.assertGreater(self.datastore.migrate(), 1)
+        self.assertEqual(self.datastore.migrate(), 0)
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+
+    def test_scrub(self):
+
+        # Creates a blob, corrupts one of its chunks.
+        sha256 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        with open(self.datastore.blob_path(sha256)) as f:
+            chunk_sha256, size = ts_cs.parse_manifest(f.read())[0]
+        with open(self.datastore.chunk_path(chunk_sha256), 'r+b') as f:
+            f.write(b'foo')
+
+        # Reports and quarantines the corrupted chunk.
+        statistics = self.datastore.scrub(quarantine=True)
+        self.assertEqual(statistics['corrupted'], [chunk_sha256])
+        self.assertGreater(statistics['scanned'], 1)
+        self.assertFalse(self.datastore.has_blob(sha256))
+
+        # Creates the blob again, the chunk is restored.
+        self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        self.assertTrue(self.datastore.has_blob(sha256))
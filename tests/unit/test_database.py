@@ -1,5 +1,9 @@
 import tempstore.database as ts_db
+import tempstore.metrics as ts_m
 
+import os
+import threading
+import time
 import unittest
 
 DATABASE_DIR = 'database-test'
@@ -57,6 +61,37 @@ class TestDatabase(unittest.TestCase):
                 'ProjectX', '1.0', 'fileA', SHA256_TEST1)
         self.assertEqual('Unable to create file', str(e.exception))
 
+    def test_create_files(self):
+
+        # Fails to create no file.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.create_files('ProjectX', '1.0', [])
+        self.assertEqual('No file', str(e.exception))
+
+        # Fails to create files with an invalid file name.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.create_files(
+                'ProjectX', '1.0',
+                [('fileA', SHA256_TEST1), ('file?', SHA256_TEST2)])
+        self.assertEqual('Invalid name', str(e.exception))
+
+        # Succeeds to create two files at once.
+        self.database.create_files(
+            'ProjectX', '1.0',
+            [('fileA', SHA256_TEST1), ('fileB', SHA256_TEST2)])
+
+        # Fails to create two files at once, one of them exists.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.create_files(
+                'ProjectX', '1.0',
+                [('fileC', SHA256_TEST1), ('fileA', SHA256_TEST2)])
+        self.assertEqual('Unable to create file', str(e.exception))
+
+        # None of the files was created.
+        files = self.database.retrieve_files('ProjectX', '1.0')
+        files_names = [file['name'] for file in files]
+        self.assertEqual(files_names, ['fileA', 'fileB'])
+
     def test_retrieve_file_sha256(self):
 
         # Fails to retrieve a file with an invalid project name.
@@ -220,6 +255,137 @@ class TestDatabase(unittest.TestCase):
             files_sha256s,
             [SHA256_TEST1, SHA256_TEST2, SHA256_TEST1])
 
+    def test_pagination(self):
+
+        # Creates three projects, versions, and files.
+        for i, name in enumerate(['A', 'B', 'C']):
+            self.database.create_file(
+                'Project' + name, '1.0', 'fileA', SHA256_TEST1)
+            self.database.create_file(
+                'ProjectX', name, 'fileA', SHA256_TEST1, 60 * i)
+            self.database.create_file(
+                'ProjectY', '1.0', 'file' + name, SHA256_TEST1)
+
+        # Fails to paginate with an invalid cursor or limit.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.retrieve_projects('Project?')
+        self.assertEqual('Invalid name', str(e.exception))
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.retrieve_versions('ProjectX', 'A')
+        self.assertEqual('Invalid cursor', str(e.exception))
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.retrieve_files('ProjectY', '1.0', None, -1)
+        self.assertEqual('Invalid limit', str(e.exception))
+
+        # Paginates the projects.
+        projects = self.database.retrieve_projects(None, 2)
+        projects_names = [project['name'] for project in projects]
+        self.assertEqual(projects_names, ['ProjectA', 'ProjectB'])
+        projects = self.database.retrieve_projects('ProjectB', 2)
+        projects_names = [project['name'] for project in projects]
+        self.assertEqual(projects_names, ['ProjectC', 'ProjectX'])
+
+        # Paginates the versions.
+        versions = self.database.retrieve_versions('ProjectX', None, 2)
+        versions_names = [version['name'] for version in versions]
+        self.assertEqual(versions_names, ['A', 'B'])
+        versions = self.database.retrieve_versions(
+            'ProjectX', versions[-1]['cursor'], 2)
+        versions_names = [version['name'] for version in versions]
+        self.assertEqual(versions_names, ['C'])
+
+        # Paginates the files.
+        files = self.database.retrieve_files('ProjectY', '1.0', None, 1)
+        files_names = [file['name'] for file in files]
+        self.assertEqual(files_names, ['fileA'])
+        files = self.database.retrieve_files('ProjectY', '1.0', 'fileA')
+        files_names = [file['name'] for file in files]
+        self.assertEqual(files_names, ['fileB', 'fileC'])
+
+    def test_search(self):
+        self.check_search()
+
+    def test_search_scan(self):
+
+        # Searches by scanning the tables if SQLite does not support the
+        # search indexes.
+        self.database.delete()
+        supported = ts_db.SEARCH_INDEXES_SUPPORTED
+        ts_db.SEARCH_INDEXES_SUPPORTED = False
+        try:
+            self.database.create()
+        finally:
+            ts_db.SEARCH_INDEXES_SUPPORTED = supported
+        self.check_search()
+
+        # The underscores are not wildcards.
+        self.assertEqual(self.database.search('files', 'lib_'), [])
+
+        # Upgrading with SQLite supporting them creates the indexes.
+        if supported:
+            self.database.migrate()
+            files = self.database.search('files', 'libfoo')
+            self.assertEqual(
+                [file['file'] for file in files], ['libfoo-1.2.4.so'])
+
+    # Checks the search of the names.
+    def check_search(self):
+
+        # Creates files in three versions of two projects.
+        self.database.create_file(
+            'ProjectX', '1.0', 'libfoo-1.2.3.so', SHA256_TEST1, 60)
+        self.database.create_file(
+            'ProjectX', '2.0', 'libfoo-1.2.4.so', SHA256_TEST2)
+        self.database.create_file(
+            'ProjectY', '1.0-rc', 'libbar.so', SHA256_TEST1)
+
+        # Searches a part of the names, case-insensitively, the most
+        # recent results first.
+        files = self.database.search('files', 'LIBFOO')
+        self.assertEqual(
+            [(file['version'], file['file']) for file in files],
+            [('2.0', 'libfoo-1.2.4.so'), ('1.0', 'libfoo-1.2.3.so')])
+        self.assertEqual(files[0]['project'], 'ProjectX')
+        self.assertEqual(files[0]['sha256'], SHA256_TEST2)
+        files = self.database.search('files', '1.2.3')
+        self.assertEqual(
+            [file['file'] for file in files], ['libfoo-1.2.3.so'])
+        self.assertEqual(self.database.search('files', 'libbaz'), [])
+        versions = self.database.search('versions', '1.0')
+        self.assertEqual(
+            [(version['project'], version['version'])
+                for version in versions],
+            [('ProjectY', '1.0-rc'), ('ProjectX', '1.0')])
+        projects = self.database.search('projects', 'ject')
+        self.assertEqual(
+            [project['project'] for project in projects],
+            ['ProjectY', 'ProjectX'])
+
+        # Paginates the results.
+        files = self.database.search('files', '.so', None, 2)
+        self.assertEqual(len(files), 2)
+        files = self.database.search('files', '.so', files[-1]['cursor'], 2)
+        self.assertEqual(
+            [file['file'] for file in files], ['libfoo-1.2.3.so'])
+
+        # The deleted versions are no longer found.
+        self.database.delete_obsolete_versions(40)
+        files = self.database.search('files', 'libfoo')
+        self.assertEqual(
+            [file['file'] for file in files], ['libfoo-1.2.4.so'])
+
+        # Fails to search an invalid or too short query.
+        for query in ['lib"', 'so', '']:
+            with self.assertRaises(ts_db.DatabaseException) as e:
+                self.database.search('files', query)
+            self.assertEqual('Invalid search query', str(e.exception))
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.search('blobs', 'libfoo')
+        self.assertEqual('Invalid search kind', str(e.exception))
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.search('files', 'libfoo', 'A')
+        self.assertEqual('Invalid cursor', str(e.exception))
+
     def test_retrieve_sha256s(self):
 
         # Creates a file.
@@ -240,6 +406,171 @@ class TestDatabase(unittest.TestCase):
         self.assertTrue(SHA256_TEST1 in sha256s)
         self.assertTrue(SHA256_TEST2 in sha256s)
 
+    def test_unreferenced_sha256s(self):
+
+        # Creates three files, two of them share a hash.
+        self.database.create_file(
+            'ProjectX', '1.0', 'fileA', SHA256_TEST1, 60)
+        self.database.create_file(
+            'ProjectX', '2.0', 'fileA', SHA256_TEST1, 20)
+        self.database.create_file(
+            'ProjectY', '1.0', 'fileA', SHA256_TEST2, 60)
+
+        # No blob is unreferenced.
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(), [])
+
+        # Deletes the versions older than 40 seconds.
+        # The second hash is no longer referenced.
+        self.database.delete_obsolete_versions(40)
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(),
+            [SHA256_TEST2])
+
+        # References the second hash again, it leaves the queue.
+        self.database.create_file(
+            'ProjectY', '2.0', 'fileA', SHA256_TEST2)
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(), [])
+
+        # Deletes all the versions. Both hashes are unreferenced.
+        self.database.delete_obsolete_versions()
+        self.assertEqual(
+            sorted(self.database.retrieve_unreferenced_sha256s()),
+            sorted([SHA256_TEST1, SHA256_TEST2]))
+
+        # Forgets the deleted blobs.
+        self.database.delete_blobs([SHA256_TEST1, SHA256_TEST2])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(), [])
+
+    def test_create_blob(self):
+
+        # Fails to create a blob with an invalid SHA-256 hash.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.create_blob('abcd')
+        self.assertEqual('Invalid SHA-256 hash', str(e.exception))
+
+        # Creates an unreferenced blob, it is queued for deletion.
+        self.database.create_blob(SHA256_TEST1)
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(),
+            [SHA256_TEST1])
+
+        # Creating a referenced blob does not queue it.
+        self.database.create_file(
+            'ProjectX', '1.0', 'fileA', SHA256_TEST2)
+        self.database.create_blob(SHA256_TEST2)
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(),
+            [SHA256_TEST1])
+
+        # Defers the next check of the unreferenced blob, it leaves the
+        # queue until due. The referenced blob is not deferred.
+        self.database.defer_blobs([
+            (SHA256_TEST1, int(time.time()) + 60),
+            (SHA256_TEST2, int(time.time()) + 60)])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(), [])
+        self.database.defer_blobs([(SHA256_TEST1, 0)])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(),
+            [SHA256_TEST1])
+
+    def test_unreferenced_chunk_sha256s(self):
+
+        # Creates two files of chunked blobs sharing a chunk. A manifest
+        # is only counted once.
+        manifest1 = (SHA256_TEST1, [SHA256_TEST1, SHA256_TEST2])
+        manifest2 = (SHA256_TEST2, [SHA256_TEST2, SHA256_TEST2])
+        self.database.create_file(
+            'ProjectX', '1.0', 'fileA', SHA256_TEST1, 60, [manifest1])
+        self.database.create_file(
+            'ProjectX', '2.0', 'fileA', SHA256_TEST2, 20, [manifest2])
+        self.database.create_manifests([manifest1, manifest2])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_chunk_sha256s(), [])
+
+        # Forgets the first blob, only its own chunk is unreferenced.
+        self.database.delete_obsolete_versions(40)
+        self.database.delete_blobs([SHA256_TEST1], [manifest1])
+        self.database.delete_blobs([SHA256_TEST1], [manifest1])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_chunk_sha256s(),
+            [SHA256_TEST1])
+
+        # Forgets the deleted chunk.
+        self.database.delete_chunks([SHA256_TEST1])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_chunk_sha256s(), [])
+
+        # Fails to count a manifest with an invalid chunk hash.
+        with self.assertRaises(ts_db.DatabaseException) as e:
+            self.database.create_blob(SHA256_TEST1, [(SHA256_TEST1, ['abcd'])])
+        self.assertEqual('Invalid SHA-256 hash', str(e.exception))
+
+        # Counts the manifest of an unreferenced blob, then forgets it.
+        self.database.create_blob(SHA256_TEST1, [manifest1])
+        self.database.delete_blobs([SHA256_TEST1], [manifest1])
+        self.assertEqual(
+            self.database.retrieve_unreferenced_chunk_sha256s(),
+            [SHA256_TEST1])
+
+    def test_retrieve_generation(self):
+
+        # Every change of the projects, versions, and files increments
+        # the generation.
+        generation = self.database.retrieve_generation()
+        self.database.create_file(
+            'ProjectX', '1.0', 'fileA', SHA256_TEST1)
+        self.assertGreater(self.database.retrieve_generation(), generation)
+        generation = self.database.retrieve_generation()
+        self.database.update_star('ProjectX', '1.0', True)
+        self.assertGreater(self.database.retrieve_generation(), generation)
+
+        # Reads do not change the generation.
+        generation = self.database.retrieve_generation()
+        self.database.retrieve_versions('ProjectX')
+        self.assertEqual(self.database.retrieve_generation(), generation)
+
+        # The generation is incremented once per transaction, whatever
+        # the number of rows changed.
+        self.database.create_files(
+            'ProjectY', '1.0',
+            [('fileA', SHA256_TEST1), ('fileB', SHA256_TEST2)], age=3600)
+        self.assertEqual(
+            self.database.retrieve_generation(), generation + 1)
+
+        # Deleting no version does not change the generation, deleting
+        # a version and its files increments it once.
+        self.database.delete_obsolete_versions(age=7200)
+        self.assertEqual(
+            self.database.retrieve_generation(), generation + 1)
+        self.database.delete_obsolete_versions(age=1800)
+        self.assertEqual(
+            self.database.retrieve_generation(), generation + 2)
+
+    def test_busy(self):
+        key = ('tempstore_database_busy_total', ('update_star',))
+        self.database.create_file('ProjectX', '1.0', 'fileA', SHA256_TEST1)
+
+        # Another connection holds the write lock for a while. Stars a
+        # version once it is released, counting the attempts which found
+        # the database locked.
+        count = ts_m.REGISTRY.values.get(key, 0)
+        connection = ts_db.connect(self.database.database_file)
+        connection.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.5, connection.execute, ['ROLLBACK'])
+        timer.start()
+        try:
+            self.database.update_star('ProjectX', '1.0', True)
+        finally:
+            timer.join()
+            connection.close()
+        self.assertGreater(ts_m.REGISTRY.values.get(key, 0), count)
+        versions = self.database.retrieve_versions('ProjectX')
+        self.assertTrue(versions[0]['star'])
+
     def test_update_star(self):
 
         # Fails to star an invalid project name.
@@ -305,3 +636,149 @@ class TestDatabase(unittest.TestCase):
         versions_stars = [version['star'] for version in versions]
         self.assertEqual(versions_names, ['2.0'])
         self.assertEqual(versions_stars, [False])
+
+    # Returns the query plan details of a SQL statement.
+    def explain(self, sql, params):
+        self.database.open()
+        try:
+            rows = self.database.cursor.execute(
+                'EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[3] for row in rows]
+        finally:
+            self.database.close()
+
+    def test_query_plans(self):
+
+        # Deleting the obsolete versions searches an index.
+        details = self.explain(
+            'DELETE FROM versions WHERE star=? AND timestamp<=?', [False, 0])
+        self.assertIn('USING COVERING INDEX obsolete_versions', details[0])
+
+        # Retrieving the versions of a project searches a covering index,
+        # already in order.
+        details = self.explain(
+            '''
+            SELECT name, timestamp, star FROM versions
+            WHERE project_id=? AND (timestamp, name)<(?, ?)
+            ORDER BY timestamp DESC, name DESC LIMIT ?
+            ''', [1, 0, '', -1])
+        self.assertEqual(len(details), 1)
+        self.assertIn(
+            'USING COVERING INDEX chronological_versions', details[0])
+
+        # Retrieving the distinct hashes scans a covering index.
+        details = self.explain('SELECT DISTINCT sha256 FROM files', [])
+        self.assertEqual(len(details), 1)
+        self.assertIn('USING COVERING INDEX files_sha256s', details[0])
+
+        # Searching the files reads a page of the trigrams index, already
+        # in order, then the rows by their IDs.
+        details = self.explain(
+            ts_db.SEARCH_QUERIES['files'], ['"foo"', 0, -1])
+        self.assertIn('VIRTUAL TABLE INDEX', details[2])
+        self.assertFalse(any('TEMP B-TREE' in detail for detail in details))
+        self.assertTrue(all(
+            'INTEGER PRIMARY KEY' in detail
+            for detail in details if detail.startswith('SEARCH')))
+
+    def test_migrate(self):
+
+        # The schema is at the latest version.
+        self.database.open()
+        version = list(self.database.cursor.execute('PRAGMA user_version'))
+        self.database.close()
+        self.assertEqual(version[0][0], len(ts_db.MIGRATIONS))
+
+        # Migrating again does nothing.
+        self.database.create_file(
+            'ProjectX', '1.0', 'fileA', SHA256_TEST1)
+        self.database.migrate()
+        self.assertEqual(self.database.retrieve_sha256s(), {SHA256_TEST1})
+
+    def test_migrate_legacy(self):
+
+        # Recreates an unversioned database, with the tables created
+        # before the migrations, and a file.
+        self.database.delete()
+        os.mkdir(DATABASE_DIR)
+        self.database.open()
+        for sql in ts_db.MIGRATIONS[0]:
+            self.database.cursor.execute(sql)
+        for sql in [
+                "INSERT INTO projects(id, name) VALUES(1, 'ProjectX')",
+                "INSERT INTO versions(id, project_id, name, timestamp) "
+                "VALUES(1, 1, '1.0', 0)",
+                "INSERT INTO files(version_id, name, sha256) "
+                "VALUES(1, 'fileA', '%s')" % SHA256_TEST1]:
+            self.database.cursor.execute(sql)
+        self.database.close()
+
+        # Upgrades the schema in place, the existing file is counted.
+        self.database.migrate()
+        self.assertEqual(
+            self.database.retrieve_sha256s(), {SHA256_TEST1})
+        self.database.delete_obsolete_versions()
+        self.assertEqual(
+            self.database.retrieve_unreferenced_sha256s(), [SHA256_TEST1])
+        details = self.explain('SELECT DISTINCT sha256 FROM files', [])
+        self.assertIn('USING COVERING INDEX files_sha256s', details[0])
+
+        # The existing names are indexed for the searches.
+        self.database.create_file('ProjectX', '2.0', 'fileA', SHA256_TEST1)
+        projects = self.database.search('projects', 'ProjectX')
+        self.assertEqual(len(projects), 1)
+
+    def test_synchronous(self):
+
+        # Configures the connections with the synchronous setting.
+        database_file = os.path.join(DATABASE_DIR, 'packages.db')
+        for synchronous, value in [('FULL', 2), ('NORMAL', 1), ('OFF', 0)]:
+            connection = ts_db.connect(database_file, synchronous)
+            self.assertEqual(
+                connection.execute('PRAGMA synchronous').fetchone()[0],
+                value)
+            connection.close()
+
+        # Fails to use an unknown setting.
+        with self.assertRaises(ts_db.DatabaseException):
+            ts_db.Database(DATABASE_DIR, synchronous='foo')
+
+class TestDatabasePool(TestDatabase):
+
+    def setUp(self):
+        self.database = ts_db.Database(DATABASE_DIR, pool_size=2)
+        self.database.create()
+
+    def test_reuse_connection(self):
+
+        # The connection is returned to the pool after use.
+        self.database.retrieve_projects()
+        self.assertEqual(len(self.database.pool.connections), 1)
+        connection = self.database.pool.connections[0]
+
+        # The same connection is reused by the next call.
+        self.database.retrieve_projects()
+        self.assertEqual(self.database.pool.connections, [connection])
+
+        # The connection is returned to the pool after a failed call,
+        # without any transaction left open.
+        with self.assertRaises(ts_db.DatabaseException):
+            self.database.retrieve_versions('ProjectX')
+        self.assertEqual(self.database.pool.connections, [connection])
+        self.assertFalse(connection.in_transaction)
+
+    def test_fork(self):
+
+        # Opens a connection in the pool.
+        self.database.retrieve_projects()
+        connection = self.database.pool.connections[0]
+
+        # Simulates a fork by changing the pool process ID.
+        self.database.pool.pid = -1
+
+        # The inherited connection is not reused.
+        self.database.retrieve_projects()
+        self.assertEqual(len(self.database.pool.connections), 1)
+        self.assertIsNot(self.database.pool.connections[0], connection)
+        self.assertEqual(
+            self.database.pool.inherited_connections, [connection])
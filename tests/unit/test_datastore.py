@@ -1,7 +1,12 @@
 import tempstore.datastore as ts_ds
 
+import gzip
 import io
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 DATASTORE_DIR = 'datastore-test'
@@ -14,6 +19,15 @@ SHA256_EMPTY = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855
 CONTENT_TEST1 = os.urandom(1 * 1024 * 1024)
 CONTENT_TEST2 = os.urandom(1 * 1024 * 1024)
 
+# Stream which can only be read once, like a raw WSGI input.
+class NonSeekableStream:
+
+    def __init__(self, content):
+        self.stream = io.BytesIO(content)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
 class TestSHA256Sum(unittest.TestCase):
 
     def test_sha256_sum(self):
@@ -35,6 +49,16 @@ class TestDatastore(unittest.TestCase):
     def tearDown(self):
         self.datastore.delete()
 
+    # Lists the files of the datastore, checking that no temporary file
+    # is left behind.
+    def list_files(self):
+        temp_dir = os.path.join(DATASTORE_DIR, ts_ds.TEMP_DIR)
+        if os.path.isdir(temp_dir):
+            self.assertEqual(os.listdir(temp_dir), [])
+        return [
+            file_name for file_name in os.listdir(DATASTORE_DIR)
+            if file_name != ts_ds.TEMP_DIR]
+
     def test_create_blob(self):
 
         # Creates a blob twice, the SHA-256 hashes match.
@@ -44,6 +68,224 @@ class TestDatastore(unittest.TestCase):
             io.BytesIO(CONTENT_TEST1))
         self.assertEqual(sha256_1a, sha256_1b)
 
+        # Creates a blob from a non-seekable stream.
+        sha256_1c = self.datastore.create_blob(
+            NonSeekableStream(CONTENT_TEST1))
+        self.assertEqual(sha256_1a, sha256_1c)
+
+        # No temporary file is left behind.
+        self.assertEqual(self.list_files(), [sha256_1a])
+
+        # The second and third blobs were deduplicated.
+        self.assertEqual(self.datastore.dedup_hits, 2)
+        self.assertEqual(self.datastore.dedup_bytes, 2 * len(CONTENT_TEST1))
+
+    def test_create_blob_dedup(self):
+
+        # Creates an old blob.
+        sha256 = self.datastore.create_blob(io.BytesIO(b'foo'), 120)
+        file_path = os.path.join(DATASTORE_DIR, sha256)
+        inode = os.stat(file_path).st_ino
+
+        # Creates the same blob again. The existing file is kept, but
+        # its timestamp is refreshed.
+        self.datastore.create_blob(io.BytesIO(b'foo'))
+        self.assertEqual(os.stat(file_path).st_ino, inode)
+        self.assertGreater(os.stat(file_path).st_mtime, time.time() - 60)
+        self.assertEqual(self.datastore.dedup_hits, 1)
+        self.assertEqual(self.datastore.dedup_bytes, 3)
+
+    def test_create_blob_writer(self):
+
+        # Writes a blob incrementally.
+        writer = self.datastore.create_blob_writer()
+        writer.write(b'f')
+        writer.write(b'oo')
+        self.assertEqual(writer.commit(), SHA256_FOO)
+        with self.datastore.retrieve_blob(SHA256_FOO) as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+
+        # Aborts a blob, nothing is left behind.
+        writer = self.datastore.create_blob_writer()
+        writer.write(b'bar')
+        writer.abort()
+        self.assertEqual(self.list_files(), [SHA256_FOO])
+
+    def test_upload_session(self):
+
+        # Appends the data at the session offset.
+        session_id = self.datastore.create_upload_session({'file': 'fileA'})
+        session = self.datastore.open_upload_session(session_id)
+        self.assertEqual(session.metadata, {'file': 'fileA'})
+        self.assertTrue(session.begin(0))
+        session.write(CONTENT_TEST1[:1000])
+        self.assertEqual(session.end(), 1000)
+
+        # Refuses another offset, or a session held by another request.
+        self.assertFalse(session.begin(0))
+        self.assertTrue(session.begin(1000))
+        other_session = self.datastore.open_upload_session(session_id)
+        self.assertFalse(other_session.begin(1000))
+        session.write(CONTENT_TEST1[1000:5000])
+        self.assertEqual(session.end(), 5000)
+
+        # Resumes in another process, which does not know the hash: the
+        # data is hashed when the upload is completed.
+        datastore = ts_ds.Datastore(DATASTORE_DIR)
+        session = datastore.open_upload_session(session_id)
+        self.assertEqual(session.retrieve_offset(), 5000)
+        self.assertTrue(session.begin(5000))
+        self.assertIsNone(session.sha256)
+
+        # Refuses to commit while another request holds the session.
+        with self.assertRaises(ts_ds.UploadSessionBusy):
+            self.datastore.open_upload_session(session_id).commit()
+        session.write(CONTENT_TEST1[5000:])
+        session.end()
+
+        # Commits the blob, the session is locked until deleted.
+        sha256 = session.commit()
+        self.assertEqual(sha256, ts_ds.sha256_sum(io.BytesIO(CONTENT_TEST1)))
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+        other_session = self.datastore.open_upload_session(session_id)
+        self.assertIsNone(other_session.commit())
+        session.abort()
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.datastore.open_upload_session(session_id)
+
+    def test_upload_session_background(self):
+
+        # Appends the data in another process, which does not know the
+        # hash.
+        session_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(session_id)
+        session.begin(0)
+        session.write(CONTENT_TEST1)
+        session.end()
+        self.datastore.upload_hashes.clear()
+
+        # Does not wait for the completion, which is polled until done.
+        timeout = ts_ds.UPLOAD_COMMIT_TIMEOUT
+        ts_ds.UPLOAD_COMMIT_TIMEOUT = 0
+        try:
+            session = self.datastore.open_upload_session(session_id)
+            sha256 = session.commit()
+            for i in range(100):
+                if sha256 is not None:
+                    break
+                time.sleep(0.05)
+                session = self.datastore.open_upload_session(session_id)
+                sha256 = session.commit()
+        finally:
+            ts_ds.UPLOAD_COMMIT_TIMEOUT = timeout
+        self.assertEqual(sha256, ts_ds.sha256_sum(io.BytesIO(CONTENT_TEST1)))
+        session.abort()
+
+        # Resumes an interrupted completion with the recorded hash,
+        # without hashing the data again: the blob takes the recorded
+        # hash.
+        session_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(session_id)
+        session.begin(0)
+        session.write(CONTENT_TEST2)
+        session.end()
+        self.datastore.upload_hashes.clear()
+        with open(session.sha256_path, 'w') as f:
+            f.write('%d %s' % (len(CONTENT_TEST2), SHA256_FOO))
+        session = self.datastore.open_upload_session(session_id)
+        self.assertEqual(session.commit(), SHA256_FOO)
+        session.abort()
+
+        # Ignores a hash recorded for another data size.
+        session_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(session_id)
+        session.begin(0)
+        session.write(CONTENT_TEST2)
+        session.end()
+        self.datastore.upload_hashes.clear()
+        with open(session.sha256_path, 'w') as f:
+            f.write('%d %s' % (len(CONTENT_TEST2) - 1, SHA256_FOO))
+        session = self.datastore.open_upload_session(session_id)
+        self.assertEqual(
+            session.commit(), ts_ds.sha256_sum(io.BytesIO(CONTENT_TEST2)))
+        session.abort()
+
+    def test_delete_stale_upload_sessions(self):
+
+        # Creates a recent and an abandoned session.
+        recent_id = self.datastore.create_upload_session({})
+        stale_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(stale_id)
+        session.begin(0)
+        session.write(b'foo')
+        session.end()
+        timestamp = time.time() - 7200
+        os.utime(session.data_path, (timestamp, timestamp))
+
+        # Only deletes the abandoned session, which the GC ignores.
+        statistics = self.datastore.delete_unreferenced_blobs(set())
+        self.assertEqual(statistics['deleted'], 0)
+        self.assertEqual(
+            self.datastore.delete_stale_upload_sessions(3600), 3)
+        self.datastore.open_upload_session(recent_id)
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.datastore.open_upload_session(stale_id)
+
+        # Deletes a session whose data was moved to its blob but which
+        # was abandoned before being finished, once unlocked.
+        session = self.datastore.open_upload_session(recent_id)
+        session.commit()
+        os.utime(session.sha256_path, (timestamp, timestamp))
+        self.datastore.delete_stale_upload_sessions(3600)
+        self.datastore.open_upload_session(recent_id)
+        session.sha256_file.close()
+        self.datastore.delete_stale_upload_sessions(3600)
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.datastore.open_upload_session(recent_id)
+
+    def test_import_file(self):
+
+        # Imports a file, the blob shares its data and the file is kept.
+        source_dir = tempfile.mkdtemp(dir='.')
+        self.addCleanup(shutil.rmtree, source_dir)
+        file_path = os.path.join(source_dir, 'fileA')
+        with open(file_path, 'wb') as f:
+            f.write(b'foo')
+        os.utime(file_path, (0, 0))
+        method = self.datastore.import_file(file_path, SHA256_FOO)
+        self.assertIn(method, ['reflink', 'link'])
+        with self.datastore.retrieve_blob(SHA256_FOO) as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+        self.assertTrue(os.path.isfile(file_path))
+
+        # Keeps the existing blob, without modifying the file.
+        self.assertEqual(
+            self.datastore.import_file(file_path, SHA256_FOO), 'existing')
+        self.assertEqual(self.list_files(), [SHA256_FOO])
+        self.assertEqual(os.stat(file_path).st_mtime, 0)
+
+        # Keeps the blob while it is hard-linked to the file, even if old
+        # and unreferenced.
+        if method == 'link':
+            statistics = self.datastore.delete_unreferenced_blobs(set())
+            self.assertEqual(statistics['linked'], 1)
+            self.assertEqual(
+                self.datastore.delete_blob(SHA256_FOO), ('linked', 0))
+            os.unlink(file_path)
+            self.assertEqual(
+                self.datastore.delete_blob(SHA256_FOO), ('deleted', 3))
+
+        # Never hard-links the file unless allowed.
+        file_path = os.path.join(source_dir, 'fileB')
+        open(file_path, 'wb').close()
+        method = self.datastore.import_file(
+            file_path, SHA256_EMPTY, link=False)
+        self.assertIn(method, ['reflink', 'copy'])
+        self.assertNotEqual(
+            os.stat(file_path).st_ino,
+            os.stat(self.datastore.blob_path(SHA256_EMPTY)).st_ino)
+
     def test_retrieve_blob(self):
 
         # Fails to retrieve blob for an invalid SHA-256 hash.
@@ -80,7 +322,163 @@ class TestDatastore(unittest.TestCase):
 
         # Deletes the unreferenced blobs.
         sha256s = set([sha256_2, SHA256_EMPTY])
-        self.datastore.delete_unreferenced_blobs(sha256s)
+        statistics = self.datastore.delete_unreferenced_blobs(sha256s)
+        self.assertEqual(statistics, {
+            'scanned': 2,
+            'kept': 1,
+            'linked': 0,
+            'deleted': 1,
+            'bytes_freed': len(CONTENT_TEST1)})
+
+        # Fails to retrieve the first blob, it was deleted.
+        with self.assertRaises(ts_ds.DatastoreException) as e:
+            self.datastore.retrieve_blob(sha256_1)
+        self.assertEqual('Blob not found', str(e.exception))
+
+        # Retrieves and verifies the second blob.
+        with self.datastore.retrieve_blob(sha256_2) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST2)
+
+    def test_delete_unreferenced_blobs_checkpoint(self):
+
+        # Creates three blobs, sorted by SHA-256 hash.
+        sha256s = sorted(
+            self.datastore.create_blob(io.BytesIO(content), 120)
+            for content in [b'foo', b'bar', b'baz'])
+
+        # Simulates an interrupted run which stopped after the first blob.
+        checkpoint_path = os.path.join(
+            DATASTORE_DIR, ts_ds.GC_CHECKPOINT_FILE)
+        with open(checkpoint_path, 'w') as f:
+            f.write(sha256s[0])
+
+        # Resumes the run, the first blob is not scanned again.
+        statistics = self.datastore.delete_unreferenced_blobs(set())
+        self.assertEqual(statistics['scanned'], 2)
+        self.assertEqual(statistics['deleted'], 2)
+        self.assertEqual(self.list_files(), [sha256s[0]])
+
+        # A complete run starts from the beginning.
+        statistics = self.datastore.delete_unreferenced_blobs(set())
+        self.assertEqual(statistics['deleted'], 1)
+        self.assertEqual(self.list_files(), [])
+
+    def test_delete_unreferenced_blobs_writing(self):
+
+        # Keeps the temporary file of a blob being written, even if old.
+        writer = self.datastore.create_blob_writer()
+        writer.write(b'foo')
+        os.utime(writer.temp_file_path, (0, 0))
+        self.assertEqual(self.datastore.delete_stale_temp_files(0), 0)
+        statistics = self.datastore.delete_unreferenced_blobs(set())
+        self.assertEqual(statistics['bytes_freed'], 0)
+        self.assertEqual(writer.commit(), SHA256_FOO)
+        with self.datastore.retrieve_blob(SHA256_FOO) as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+
+        # Keeps the temporary file of an interrupted write until it is
+        # old, then deletes it.
+        writer = self.datastore.create_blob_writer()
+        writer.write(b'bar')
+        writer.file.close()
+        self.assertEqual(self.datastore.delete_stale_temp_files(), 0)
+        self.assertTrue(os.path.isfile(writer.temp_file_path))
+        self.assertEqual(self.datastore.delete_stale_temp_files(0), 3)
+        self.assertEqual(self.list_files(), [SHA256_FOO])
+
+    def test_scrub(self):
+
+        # Creates two blobs, corrupts the first one.
+        sha256_1 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        sha256_2 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST2))
+        with open(self.datastore.blob_path(sha256_1), 'r+b') as f:
+            f.write(b'foo')
+
+        # Reports the corrupted blob.
+        statistics = self.datastore.scrub(2, batch_size=1)
+        self.assertEqual(statistics, {
+            'scanned': 2,
+            'bytes': len(CONTENT_TEST1) + len(CONTENT_TEST2),
+            'corrupted': [sha256_1]})
+
+        # Resumes from a checkpoint, skipping the first blob in order.
+        checkpoint = min(sha256_1, sha256_2)
+        with open(os.path.join(
+                DATASTORE_DIR, ts_ds.SCRUB_CHECKPOINT_FILE), 'w') as f:
+            f.write(checkpoint)
+        statistics = self.datastore.scrub()
+        self.assertEqual(statistics['scanned'], 1)
+
+        # Quarantines the corrupted blob, then creates it again.
+        statistics = self.datastore.scrub(quarantine=True)
+        self.assertEqual(statistics['corrupted'], [sha256_1])
+        self.assertFalse(self.datastore.has_blob(sha256_1))
+        self.assertTrue(os.path.isfile(os.path.join(
+            DATASTORE_DIR, ts_ds.QUARANTINE_DIR, sha256_1)))
+        self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        statistics = self.datastore.scrub()
+        self.assertEqual(statistics['scanned'], 2)
+        self.assertEqual(statistics['corrupted'], [])
+
+    def test_scrub_rate(self):
+
+        # Limits the reads rate.
+        self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        start_time = time.monotonic()
+        self.datastore.scrub(rate=4 * len(CONTENT_TEST1))
+        self.assertGreater(time.monotonic() - start_time, 0.2)
+
+class TestDatastoreFanout(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore = ts_ds.Datastore(DATASTORE_DIR, fanout=2)
+        self.datastore.create()
+
+    def tearDown(self):
+        self.datastore.delete()
+
+    def test_create_blob(self):
+
+        # Creates a blob, it is stored in nested directories.
+        sha256 = self.datastore.create_blob(io.BytesIO(b'foo'))
+        self.assertTrue(os.path.isfile(os.path.join(
+            DATASTORE_DIR, sha256[0:2], sha256[2:4], sha256)))
+
+        # Retrieves and verifies the blob.
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+
+    def test_migrate(self):
+
+        # Creates two blobs with the flat layout.
+        datastore = ts_ds.Datastore(DATASTORE_DIR)
+        sha256_1 = datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        sha256_2 = datastore.create_blob(io.BytesIO(CONTENT_TEST2))
+
+        # Retrieves and verifies the first blob before the migration.
+        with self.datastore.retrieve_blob(sha256_1) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST1)
+
+        # Migrates the blobs, a second migration does nothing.
+        self.assertEqual(self.datastore.migrate(), 2)
+        self.assertEqual(self.datastore.migrate(), 0)
+        self.assertTrue(os.path.isfile(self.datastore.blob_path(sha256_1)))
+        self.assertFalse(os.path.exists(datastore.blob_path(sha256_1)))
+
+        # Retrieves and verifies the second blob after the migration.
+        with self.datastore.retrieve_blob(sha256_2) as stream:
+            self.assertEqual(stream.read(-1), CONTENT_TEST2)
+
+    def test_delete_unreferenced_blobs(self):
+
+        # Creates two blobs.
+        sha256_1 = self.datastore.create_blob(
+            io.BytesIO(CONTENT_TEST1), 120)
+        sha256_2 = self.datastore.create_blob(
+            io.BytesIO(CONTENT_TEST2), 120)
+
+        # Deletes the unreferenced blobs in batches of one blob.
+        self.datastore.delete_unreferenced_blobs(set([sha256_2]), 1)
 
         # Fails to retrieve the first blob, it was deleted.
         with self.assertRaises(ts_ds.DatastoreException) as e:
@@ -90,3 +488,190 @@ class TestDatastore(unittest.TestCase):
         # Retrieves and verifies the second blob.
         with self.datastore.retrieve_blob(sha256_2) as stream:
             self.assertEqual(stream.read(-1), CONTENT_TEST2)
+
+class TestDatastoreDurability(unittest.TestCase):
+
+    def tearDown(self):
+        ts_ds.Datastore(DATASTORE_DIR).delete()
+
+    def test_durabilities(self):
+
+        # Creates and retrieves a blob with each durability.
+        for durability in ts_ds.DURABILITIES:
+            datastore = ts_ds.Datastore(
+                DATASTORE_DIR, fanout=2, durability=durability)
+            datastore.create()
+            sha256 = datastore.create_blob(io.BytesIO(b'foo'))
+            with datastore.retrieve_blob(sha256) as stream:
+                self.assertEqual(stream.read(-1), b'foo')
+
+        # Fails to use an unknown durability.
+        with self.assertRaises(ts_ds.DatastoreException):
+            ts_ds.Datastore(DATASTORE_DIR, durability='foo')
+
+    def test_group_sync(self):
+        group_sync = ts_ds.GroupSync()
+
+        # Flushes a file at once.
+        with tempfile.TemporaryFile() as f:
+            group_sync.fsync(f.fileno())
+        self.assertEqual(group_sync.flushes, 1)
+
+        # Batches the flushes requested while a flush is in progress.
+        group_sync.flushing = True
+        files = [tempfile.TemporaryFile() for i in range(3)]
+        threads = [
+            threading.Thread(target=group_sync.fsync, args=(f.fileno(),))
+            for f in files]
+        for thread in threads:
+            thread.start()
+        while len(group_sync.batch.fds) < 3:
+            time.sleep(0.01)
+        with group_sync.condition:
+            group_sync.flushing = False
+            group_sync.condition.notify_all()
+        for thread in threads:
+            thread.join()
+        for f in files:
+            f.close()
+        self.assertEqual(group_sync.flushes, 2)
+
+        # Flushes the batch with a single call.
+        if ts_ds.SYNCFS is not None:
+            self.assertEqual(group_sync.calls, 2)
+
+class TestDatastoreCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore = ts_ds.Datastore(
+            DATASTORE_DIR, fanout=2, compression='gzip')
+        self.datastore.create()
+
+    def tearDown(self):
+        self.datastore.delete()
+
+    def test_create_blob(self):
+
+        # Creates a blob which compresses, it is stored compressed.
+        content = b'foo bar baz\n' * 100000
+        sha256 = self.datastore.create_blob(io.BytesIO(content))
+        self.assertEqual(sha256, ts_ds.sha256_sum(io.BytesIO(content)))
+        file_path = self.datastore.blob_path(sha256) + '.gz'
+        self.assertLess(os.path.getsize(file_path), len(content) // 10)
+
+        # Retrieves and verifies the blob.
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), content)
+
+        # Retrieves the blob as stored.
+        stream, codec = self.datastore.open_blob(sha256)
+        with stream:
+            self.assertEqual(codec.content_encoding, 'gzip')
+            self.assertEqual(gzip.decompress(stream.read()), content)
+
+        # Creates the same blob again, it is deduplicated.
+        self.datastore.create_blob(NonSeekableStream(content))
+        self.assertEqual(self.datastore.dedup_hits, 1)
+
+    def test_upload_session(self):
+
+        # Commits an upload session, the blob is compressed.
+        content = b'foo bar baz\n' * 100000
+        session_id = self.datastore.create_upload_session({})
+        session = self.datastore.open_upload_session(session_id)
+        session.begin(0)
+        session.write(content)
+        session.end()
+        sha256 = session.commit()
+        session.abort()
+        file_path = self.datastore.blob_path(sha256) + '.gz'
+        self.assertLess(os.path.getsize(file_path), len(content) // 10)
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), content)
+
+    def test_import_file(self):
+
+        # Imports a file which compresses, it is copied compressed.
+        content = b'foo bar baz\n' * 100000
+        with tempfile.NamedTemporaryFile(dir='.') as f:
+            f.write(content)
+            f.flush()
+            sha256 = ts_ds.sha256_file(f.name)
+            self.assertEqual(
+                self.datastore.import_file(f.name, sha256), 'copy')
+        file_path = self.datastore.blob_path(sha256) + '.gz'
+        self.assertLess(os.path.getsize(file_path), len(content) // 10)
+
+    def test_create_blob_incompressible(self):
+
+        # Creates a blob which does not compress, it is stored as is.
+        sha256 = self.datastore.create_blob(io.BytesIO(CONTENT_TEST1))
+        self.assertTrue(os.path.isfile(self.datastore.blob_path(sha256)))
+        stream, codec = self.datastore.open_blob(sha256)
+        with stream:
+            self.assertIsNone(codec)
+            self.assertEqual(stream.read(), CONTENT_TEST1)
+
+    def test_codecs(self):
+
+        # Creates a blob with another codec, it stays readable.
+        content = b'foo bar baz\n' * 1000
+        datastore = ts_ds.Datastore(DATASTORE_DIR, compression='lzma')
+        sha256 = datastore.create_blob(io.BytesIO(content), 120)
+        with self.datastore.retrieve_blob(sha256) as stream:
+            self.assertEqual(stream.read(-1), content)
+
+        # Migrates the blob to the configured layout.
+        self.assertEqual(self.datastore.migrate(), 1)
+        self.assertTrue(os.path.isfile(
+            self.datastore.blob_path(sha256) + '.xz'))
+
+        # Deletes the blob unless referenced.
+        statistics = self.datastore.delete_unreferenced_blobs(set([sha256]))
+        self.assertEqual(statistics['kept'], 1)
+        outcome, freed_bytes = self.datastore.delete_blob(sha256)
+        self.assertEqual(outcome, 'deleted')
+        self.assertGreater(freed_bytes, 0)
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.datastore.retrieve_blob(sha256)
+
+        # Fails to use an unknown codec.
+        with self.assertRaises(ts_ds.DatastoreException) as e:
+            ts_ds.Datastore(DATASTORE_DIR, compression='unknown')
+        self.assertEqual('Invalid compression', str(e.exception))
+
+    def test_compression_level(self):
+
+        # Compresses at the default level of the codec.
+        self.assertEqual(self.datastore.compression_level, 6)
+
+        # Compresses at a specified level, the blob stays readable.
+        content = bytes(range(256)) * 1000 + os.urandom(100000)
+        for compression, level in [('gzip', 1), ('lzma', 0)]:
+            datastore = ts_ds.Datastore(
+                DATASTORE_DIR, fanout=2, compression=compression,
+                compression_level=level)
+            sha256 = datastore.create_blob(io.BytesIO(content), 120)
+            with datastore.retrieve_blob(sha256) as stream:
+                self.assertEqual(stream.read(-1), content)
+            datastore.delete_blob(sha256)
+
+        # Fails to use a level out of the codec levels, or without codec.
+        for compression, level in [('gzip', 0), ('lzma', 10), (None, 1)]:
+            with self.assertRaises(ts_ds.DatastoreException) as e:
+                ts_ds.Datastore(
+                    DATASTORE_DIR, compression=compression,
+                    compression_level=level)
+            self.assertEqual('Invalid compression level', str(e.exception))
+
+    def test_scrub(self):
+
+        # Creates a blob which compresses, truncates it.
+        content = b'foo bar baz\n' * 100000
+        sha256 = self.datastore.create_blob(io.BytesIO(content))
+        with open(self.datastore.blob_path(sha256) + '.gz', 'r+b') as f:
+            f.truncate(100)
+
+        # Reports the corrupted blob.
+        statistics = self.datastore.scrub()
+        self.assertEqual(statistics['corrupted'], [sha256])
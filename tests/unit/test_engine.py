@@ -1,12 +1,378 @@
+import tempstore.database as ts_db
+import tempstore.datastore as ts_ds
 import tempstore.engine as ts_e
 
+import io
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+DATASTORE_DIR = 'datastore-test'
+DATABASE_DIR = 'database-test'
+
 SECONDS = 1
 MINUTES = 60 * SECONDS
 HOURS = 60 * MINUTES
 DAYS = 24 * HOURS
 
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(DATASTORE_DIR, DATABASE_DIR, 40)
+        self.engine.create()
+
+    def tearDown(self):
+        self.engine.delete()
+
+    def test_cleanup(self):
+
+        # Uploads two versions, with one shared file.
+        self.engine.upload(
+            'ProjectX', '1.0', 'fileA', io.BytesIO(b'foo'), 120)
+        self.engine.upload(
+            'ProjectX', '1.0', 'fileB', io.BytesIO(b'bar'), 120)
+        self.engine.upload(
+            'ProjectX', '2.0', 'fileA', io.BytesIO(b'foo'), 120)
+        self.engine.star_version('ProjectX', '2.0')
+
+        # Fails to upload a duplicate file, the blob is orphaned.
+        with self.assertRaises(ts_db.DatabaseException):
+            self.engine.upload(
+                'ProjectX', '2.0', 'fileA', io.BytesIO(b'baz'), 120)
+
+        # Cleans up: the 1.0 version is obsolete. Only the blobs of the
+        # 'bar' file and of the failed upload are deleted.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics, {
+            'scanned': 2,
+            'kept': 0,
+            'linked': 0,
+            'deleted': 2,
+            'bytes_freed': 6})
+
+        # The shared file is still available.
+        with self.engine.download('ProjectX', '2.0', 'fileA') as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+
+        # A second cleanup has nothing left to do.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['scanned'], 0)
+
+    def test_commit_uploads(self):
+
+        # Uploads two files at once.
+        files = []
+        for file_name, content in [('fileA', b'foo'), ('fileB', b'bar')]:
+            writer = self.engine.create_blob_writer()
+            writer.write(content)
+            files.append((file_name, writer))
+        self.engine.commit_uploads('ProjectX', '1.0', files)
+        files = self.engine.list_files('ProjectX', '1.0')
+        self.assertEqual(
+            [file['name'] for file in files], ['fileA', 'fileB'])
+
+        # Fails to upload two files at once, one of them exists.
+        files = []
+        for file_name, content in [('fileC', b'baz'), ('fileA', b'qux')]:
+            writer = self.engine.create_blob_writer()
+            writer.write(content)
+            files.append((file_name, writer))
+        with self.assertRaises(ts_db.DatabaseException):
+            self.engine.commit_uploads('ProjectX', '1.0', files)
+
+        # The blobs of the failed upload are queued for deletion.
+        self.assertEqual(
+            sorted(self.engine.database.retrieve_unreferenced_sha256s()),
+            sorted([
+                ts_ds.sha256_sum(io.BytesIO(b'baz')),
+                ts_ds.sha256_sum(io.BytesIO(b'qux'))]))
+
+        # Fails to commit the second of three blobs, it is discarded with
+        # the third one.
+        files = []
+        for file_name, content in [
+                ('fileD', b'foo1'), ('fileE', b'foo2'), ('fileF', b'foo3')]:
+            writer = self.engine.create_blob_writer()
+            writer.write(content)
+            files.append((file_name, writer))
+        def fail_commit(age=0):
+            raise OSError('Commit failed')
+        files[1][1].commit = fail_commit
+        with self.assertRaises(OSError):
+            self.engine.commit_uploads('ProjectX', '1.0', files)
+        for file_name, writer in files[1:]:
+            self.assertFalse(os.path.exists(writer.temp_file_path))
+        self.assertIn(
+            ts_ds.sha256_sum(io.BytesIO(b'foo1')),
+            self.engine.database.retrieve_unreferenced_sha256s())
+
+    def test_cleanup_recent_blob(self):
+
+        # Uploads an obsolete version whose blob was just written.
+        self.engine.upload(
+            'ProjectX', '1.0', 'fileA', io.BytesIO(b'foo'), 120)
+        self.engine.datastore.create_blob(io.BytesIO(b'foo'))
+
+        # The recent blob is kept and stays queued.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['kept'], 1)
+        self.assertEqual(
+            self.engine.database.retrieve_unreferenced_sha256s(),
+            [ts_ds.sha256_sum(io.BytesIO(b'foo'))])
+
+    def test_upload_session(self):
+
+        # Uploads a file in two parts, commits it.
+        session_id = self.engine.create_upload_session(
+            'ProjectX', '1.0', 'fileA')
+        session = self.engine.open_upload_session(session_id)
+        session.begin(0)
+        session.write(b'fo')
+        session.end()
+        session.begin(2)
+        session.write(b'o')
+        session.end()
+        self.engine.commit_upload_session(session_id)
+        with self.engine.download('ProjectX', '1.0', 'fileA') as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+
+        # Refuses a session with an invalid name.
+        with self.assertRaises(ts_db.DatabaseException):
+            self.engine.create_upload_session('ProjectX', '1.0', '../fileA')
+
+    def test_cleanup_upload_session(self):
+
+        # Abandons an upload session.
+        session_id = self.engine.create_upload_session(
+            'ProjectX', '1.0', 'fileA')
+        session = self.engine.open_upload_session(session_id)
+        session.begin(0)
+        session.write(b'foo')
+        session.end()
+        timestamp = time.time() - ts_e.UPLOAD_SESSION_AGE - 60
+        os.utime(session.data_path, (timestamp, timestamp))
+
+        # Cleans up, the session is deleted.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['bytes_freed'], 3)
+        with self.assertRaises(ts_ds.DatastoreException):
+            self.engine.open_upload_session(session_id)
+
+    def test_import_tree(self):
+
+        # Creates a tree with two versions, and invalid entries.
+        root_dir = tempfile.mkdtemp(dir='.')
+        self.addCleanup(shutil.rmtree, root_dir)
+        files = {
+            'ProjectX/1.0/fileA': b'foo',
+            'ProjectX/1.0/fileB': b'bar',
+            'ProjectX/1.0/fileC': b'foo',
+            'ProjectX/2.0/fileA': b'baz',
+            'ProjectX/2.0/file A': b'invalid',
+            'ProjectX/fileA': b'misplaced'}
+        for i, (path, content) in enumerate(sorted(files.items())):
+            file_path = os.path.join(root_dir, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            timestamp = 1000000000 + i
+            os.utime(file_path, (timestamp, timestamp))
+
+        # Imports the files in batches, the blobs are deduplicated.
+        statistics = self.engine.import_tree(
+            root_dir, workers=2, batch_size=2)
+        self.assertEqual(statistics['files'], 4)
+        self.assertEqual(statistics['bytes'], 12)
+        self.assertEqual(statistics['existing'], 1)
+        self.assertEqual(statistics['skipped'], 2)
+        with self.engine.download('ProjectX', '1.0', 'fileC') as stream:
+            self.assertEqual(stream.read(-1), b'foo')
+        with self.engine.download('ProjectX', '2.0', 'fileA') as stream:
+            self.assertEqual(stream.read(-1), b'baz')
+
+        # The versions take the timestamp of their most recent file.
+        versions = self.engine.database.retrieve_versions('ProjectX')
+        self.assertEqual(
+            sorted(version['timestamp'] for version in versions),
+            [1000000002, 1000000004])
+
+        # Imports again, the existing files are skipped.
+        statistics = self.engine.import_tree(root_dir, workers=2)
+        self.assertEqual(statistics['files'], 0)
+        self.assertEqual(statistics['skipped'], 6)
+
+    def test_cleanup_imported_blobs(self):
+
+        # Imports an obsolete version whose blobs are hard-linked to the
+        # imported files, when the file system allows it.
+        root_dir = tempfile.mkdtemp(dir='.')
+        self.addCleanup(shutil.rmtree, root_dir)
+        version_dir = os.path.join(root_dir, 'ProjectX', '1.0')
+        os.makedirs(version_dir)
+        for file_name, content in [('fileA', b'foo'), ('fileB', b'bar')]:
+            file_path = os.path.join(version_dir, file_name)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            os.utime(file_path, (1000000000, 1000000000))
+        statistics = self.engine.import_tree(root_dir, workers=2)
+        if statistics['link'] != 2:
+            self.skipTest('Hard links not used')
+
+        # The linked blobs are kept, and leave the cleanup queue.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['scanned'], 2)
+        self.assertEqual(statistics['kept'], 0)
+        self.assertEqual(statistics['linked'], 2)
+        self.assertEqual(statistics['deleted'], 0)
+        self.assertEqual(
+            self.engine.database.retrieve_unreferenced_sha256s(), [])
+
+        # The next cleanups do not check them again.
+        for i in range(3):
+            statistics = self.engine.cleanup()
+            self.assertEqual(statistics['scanned'], 0)
+
+        # Once due, they are checked again, and deleted if no longer
+        # linked.
+        shutil.rmtree(version_dir)
+        sha256s = [
+            ts_ds.sha256_sum(io.BytesIO(content))
+            for content in [b'foo', b'bar']]
+        self.engine.database.defer_blobs(
+            [(sha256, 0) for sha256 in sha256s])
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['scanned'], 2)
+        self.assertEqual(statistics['deleted'], 2)
+        for sha256 in sha256s:
+            self.assertFalse(self.engine.datastore.has_blob(sha256))
+
+    def test_scrub(self):
+
+        # Uploads two files, deletes the blob of the first one.
+        self.engine.upload('ProjectX', '1.0', 'fileA', io.BytesIO(b'foo'))
+        self.engine.upload('ProjectX', '1.0', 'fileB', io.BytesIO(b'bar'))
+        sha256 = self.engine.lookup('ProjectX', '1.0', 'fileA')
+        os.unlink(self.engine.datastore.blob_path(sha256))
+
+        # Reports the missing blob.
+        statistics = self.engine.scrub()
+        self.assertEqual(statistics['scanned'], 1)
+        self.assertEqual(statistics['corrupted'], [])
+        self.assertEqual(statistics['missing'], [sha256])
+
+class TestEngineCache(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(
+            DATASTORE_DIR, DATABASE_DIR, 40, cache_size=100)
+        self.engine.create()
+
+    def tearDown(self):
+        self.engine.delete()
+
+    def test_cache(self):
+
+        # Uploads a file, then looks it up twice.
+        self.engine.upload('ProjectX', '1.0', 'fileA', io.BytesIO(b'foo'))
+        sha256 = self.engine.lookup('ProjectX', '1.0', 'fileA')
+        self.assertEqual(
+            self.engine.lookup('ProjectX', '1.0', 'fileA'), sha256)
+        self.assertEqual(self.engine.cache.hits, 1)
+
+        # The writes of the engine invalidate the cache.
+        self.assertFalse(self.engine.list_versions('ProjectX')[0]['star'])
+        self.engine.star_version('ProjectX', '1.0')
+        self.assertTrue(self.engine.list_versions('ProjectX')[0]['star'])
+        self.engine.upload('ProjectX', '1.0', 'fileB', io.BytesIO(b'bar'))
+        files = self.engine.list_files('ProjectX', '1.0')
+        self.assertEqual(
+            [file['name'] for file in files], ['fileA', 'fileB'])
+
+    def test_cache_generation(self):
+
+        # Uploads a file and lists the versions.
+        self.engine.upload('ProjectX', '1.0', 'fileA', io.BytesIO(b'foo'))
+        self.engine.list_versions('ProjectX')
+
+        # The cached versions are listed without querying the database.
+        def fail_open():
+            raise ts_db.DatabaseException('Database queried')
+        self.engine.database.open = fail_open
+        self.assertFalse(self.engine.list_versions('ProjectX')[0]['star'])
+        del self.engine.database.open
+
+        # Another process stars the version, which changes the database
+        # generation.
+        database = ts_db.Database(DATABASE_DIR)
+        database.update_star('ProjectX', '1.0', True)
+        self.assertTrue(self.engine.list_versions('ProjectX')[0]['star'])
+
+class TestEngineChunking(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ts_e.Engine(
+            DATASTORE_DIR, DATABASE_DIR, 40, datastore_chunking=True)
+        self.engine.create()
+
+    def tearDown(self):
+        self.engine.delete()
+
+    def test_cleanup(self):
+
+        # Uploads two versions of a file, the first one is obsolete.
+        content = os.urandom(1024 * 1024)
+        self.engine.upload(
+            'ProjectX', '1.0', 'fileA', io.BytesIO(b'foo' + content), 120)
+        self.engine.upload(
+            'ProjectX', '2.0', 'fileA', io.BytesIO(b'bar' + content), 20)
+
+        # Cleans up: only the first chunk of the obsolete file is freed.
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['deleted'], 1)
+        self.assertGreater(statistics['bytes_freed'], 0)
+        self.assertLess(statistics['bytes_freed'], 300000)
+        with self.engine.download('ProjectX', '2.0', 'fileA') as stream:
+            self.assertEqual(stream.read(-1), b'bar' + content)
+
+        # Deletes the second version: all the chunks are freed.
+        database = ts_db.Database(DATABASE_DIR)
+        database.delete_obsolete_versions()
+        for dir_path, dir_names, file_names in os.walk(DATASTORE_DIR):
+            for file_name in file_names:
+                os.utime(os.path.join(dir_path, file_name), (0, 0))
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['deleted'], 1)
+        self.assertGreater(statistics['bytes_freed'], len(content))
+        self.assertEqual(
+            os.listdir(self.engine.datastore.chunks_dir), [])
+
+    def test_upgrade(self):
+
+        # Uploads a file, then forgets the counts of its chunks as if it
+        # was uploaded before they were counted.
+        content = os.urandom(1024 * 1024)
+        self.engine.upload(
+            'ProjectX', '1.0', 'fileA', io.BytesIO(content), 120)
+        database = ts_db.Database(DATABASE_DIR)
+        database.open()
+        database.cursor.execute('DELETE FROM chunks')
+        database.cursor.execute('DELETE FROM manifests')
+        database.close()
+
+        # Upgrades, the chunks are counted once.
+        self.engine.upgrade(batch_size=1)
+        self.engine.upgrade()
+        self.assertEqual(
+            database.retrieve_unreferenced_chunk_sha256s(), [])
+
+        # The chunks are freed with the file.
+        database.delete_obsolete_versions()
+        statistics = self.engine.cleanup()
+        self.assertEqual(statistics['deleted'], 1)
+        self.assertGreater(statistics['bytes_freed'], len(content))
+
 class TestFormatExpiry(unittest.TestCase):
 
     def test_format_expiry(self):
@@ -0,0 +1,115 @@
+import tempstore.metrics as ts_m
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+
+    def test_expose(self):
+        registry = ts_m.Registry()
+        counter = registry.counter('test_total', 'Test.', ['kind'])
+        histogram = registry.histogram(
+            'test_seconds', 'Test.', buckets=[1, 10, float('inf')])
+
+        # Exposes the counters by labels and the cumulative buckets.
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"')
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = registry.expose().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{kind="a"} 3', lines)
+        self.assertIn('test_total{kind="b\\""} 1', lines)
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="10"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_sum 5.5', lines)
+        self.assertIn('test_seconds_count 2', lines)
+
+    def test_multiprocess(self):
+        # Sums the values of the processes sharing the directory.
+        registries = []
+        for i in range(2):
+            registry = ts_m.Registry()
+            registry.configure(self.metrics_dir)
+            counter = registry.counter('test_total', 'Test.')
+            histogram = registry.histogram('test_seconds', 'Test.')
+            counter.inc(amount=i + 1)
+            histogram.observe(1)
+            registry.flush(force=True)
+            registries.append(registry)
+        self.assertEqual(len(os.listdir(self.metrics_dir)), 2)
+        lines = registries[0].expose().splitlines()
+        self.assertIn('test_total 3', lines)
+        self.assertIn('test_seconds_count 2', lines)
+
+    def test_fork(self):
+        registry = ts_m.Registry()
+        registry.configure(self.metrics_dir)
+        counter = registry.counter('test_total', 'Test.')
+        counter.inc()
+        registry.flush(force=True)
+
+        # Starts over in a child process, in its own file.
+        registry.pid = -1
+        counter.inc(amount=2)
+        registry.flush(force=True)
+        self.assertEqual(registry.values, {('test_total', ()): 2})
+        self.assertEqual(len(os.listdir(self.metrics_dir)), 2)
+        self.assertIn('test_total 3', registry.expose().splitlines())
+
+    def test_dead_processes(self):
+        registry = ts_m.Registry()
+        registry.configure(self.metrics_dir)
+        counter = registry.counter('test_total', 'Test.')
+        histogram = registry.histogram('test_seconds', 'Test.')
+        counter.inc()
+        registry.flush(force=True)
+
+        # Writes the files of two terminated processes.
+        for i in range(2):
+            process = subprocess.Popen([sys.executable, '-c', ''])
+            process.wait()
+            file_name = 'metrics-%d-%d.json' % (process.pid, i)
+            with open(os.path.join(self.metrics_dir, file_name), 'w') as f:
+                json.dump([
+                    ['test_total', [], 2],
+                    ['test_seconds', [], histogram.zero()[:-1] + [1]]], f)
+
+        # Merges the files of the terminated processes when exposed, the
+        # values are kept.
+        for i in range(2):
+            lines = registry.expose().splitlines()
+            self.assertIn('test_total 5', lines)
+            self.assertIn('test_seconds_count 2', lines)
+            self.assertEqual(
+                sorted(os.listdir(self.metrics_dir)),
+                sorted([
+                    registry.file_name, ts_m.DEAD_FILE_NAME,
+                    ts_m.LOCK_FILE_NAME]))
+
+        # Does not count again a merged file which was not deleted.
+        dead_path = os.path.join(self.metrics_dir, ts_m.DEAD_FILE_NAME)
+        with open(dead_path) as f:
+            dead = json.load(f)
+        dead['merged'] = ['metrics-%d-0.json' % process.pid]
+        with open(dead_path, 'w') as f:
+            json.dump(dead, f)
+        with open(os.path.join(
+                self.metrics_dir, dead['merged'][0]), 'w') as f:
+            json.dump([['test_total', [], 2]], f)
+        self.assertIn('test_total 5', registry.expose().splitlines())
+        self.assertNotIn(dead['merged'][0], os.listdir(self.metrics_dir))
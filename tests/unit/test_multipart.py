@@ -0,0 +1,99 @@
+import tempstore.multipart as ts_mp
+
+import os
+import unittest
+
+# 64 Kb of test content.
+CONTENT_TEST = os.urandom(64 * 1024)
+
+# Sample multipart/form-data body.
+BODY_TEST = (
+    b'preamble\r\n'
+    b'--boundary\r\n'
+    b'Content-Disposition: form-data; name="project"\r\n'
+    b'\r\n'
+    b'ProjectX\r\n'
+    b'--boundary\r\n'
+    b'Content-Disposition: form-data; name="upload"; filename="fileA"\r\n'
+    b'Content-Type: application/octet-stream\r\n'
+    b'\r\n' +
+    CONTENT_TEST +
+    b'\r\n--boundary--\r\n'
+    b'epilogue')
+
+# Feeds a body to a parser by chunks of a given size.
+# Returns the parts as (headers, data) tuples.
+def parse(body, chunk_size):
+    parser = ts_mp.MultipartParser('boundary')
+    parts = []
+    for i in range(0, len(body), chunk_size):
+        for event, value in parser.feed(body[i:i+chunk_size]):
+            if event == ts_mp.PART_BEGIN:
+                parts.append((value, []))
+            elif event == ts_mp.PART_DATA:
+                parts[-1][1].append(value)
+    parser.close()
+    return [(headers, b''.join(data)) for headers, data in parts]
+
+class TestParseOptionsHeader(unittest.TestCase):
+
+    def test_parse_options_header(self):
+
+        # Parses a value with quoted and unquoted options.
+        self.assertEqual(
+            ts_mp.parse_options_header(
+                'form-data; name="upload"; filename="a \\"b\\"; c"'),
+            ('form-data', {'name': 'upload', 'filename': 'a "b"; c'}))
+        self.assertEqual(
+            ts_mp.parse_options_header(
+                'multipart/form-data; Boundary=abc'),
+            ('multipart/form-data', {'boundary': 'abc'}))
+
+        # Parses a value without options.
+        self.assertEqual(
+            ts_mp.parse_options_header('form-data'),
+            ('form-data', {}))
+
+class TestMultipartParser(unittest.TestCase):
+
+    def test_parse(self):
+
+        # Parses the body fed by chunks of various sizes.
+        for chunk_size in [1, 7, 65536, len(BODY_TEST)]:
+            parts = parse(BODY_TEST, chunk_size)
+            self.assertEqual(len(parts), 2)
+            self.assertEqual(
+                parts[0][0]['content-disposition'],
+                'form-data; name="project"')
+            self.assertEqual(parts[0][1], b'ProjectX')
+            self.assertEqual(
+                parts[1][0]['content-type'],
+                'application/octet-stream')
+            self.assertEqual(parts[1][1], CONTENT_TEST)
+
+    def test_parse_errors(self):
+
+        # Fails to create a parser without boundary.
+        with self.assertRaises(ts_mp.MultipartException) as e:
+            ts_mp.MultipartParser('')
+        self.assertEqual('Missing boundary', str(e.exception))
+
+        # Fails to parse a truncated body.
+        with self.assertRaises(ts_mp.MultipartException) as e:
+            parse(BODY_TEST[:1000], 100)
+        self.assertEqual('Truncated body', str(e.exception))
+
+        # Fails to parse an invalid delimiter.
+        with self.assertRaises(ts_mp.MultipartException) as e:
+            parse(b'--boundary!!', 100)
+        self.assertEqual('Invalid delimiter', str(e.exception))
+
+        # Fails to parse an invalid header.
+        with self.assertRaises(ts_mp.MultipartException) as e:
+            parse(b'--boundary\r\nInvalid\r\n\r\n', 100)
+        self.assertEqual('Invalid header', str(e.exception))
+
+        # Fails to parse headers which are too large.
+        with self.assertRaises(ts_mp.MultipartException) as e:
+            parse(b'--boundary\r\n' + b'a' * 20000, 100)
+        self.assertEqual('Headers too large', str(e.exception))